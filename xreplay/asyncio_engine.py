@@ -0,0 +1,779 @@
+import asyncio
+from datetime import datetime
+import telemetry
+import metrics
+from time import monotonic
+from itertools import count
+from copy import deepcopy
+import methods
+import deadletters
+from methods import (
+    get_limiter,
+    get_breaker,
+    retry_after_seconds,
+    backoff_seconds,
+    encode_body,
+    loads,
+    log_failure,
+)
+from threads import (
+    next_page_query,
+    flatten_record,
+    strip_deferred_links,
+    batch_size,
+    batch_request,
+    report_key,
+    partition_probe,
+    scroll_queries,
+    store_scroll,
+    queue_slots,
+    table_rank,
+    backfill_modes,
+    split_batches,
+    encoded_size,
+    split_codes,
+    repeated_rejection,
+    resumed_reports,
+)
+from attachments import copy_files
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+async def report(reporting_queue, status_report):
+    # The reporting queue is shared with the reporter thread, it is unbounded so a put never blocks the event loop
+    reporting_queue.put_nowait(status_report)
+
+
+def client_timeout():
+    return aiohttp.ClientTimeout(
+        sock_connect=methods.CONNECT_TIMEOUT, sock_read=methods.READ_TIMEOUT
+    )
+
+
+async def request(
+    session,
+    inflight,
+    method,
+    apikey,
+    urlPath,
+    payload=None,
+    expect_codes=[],
+    ERROR_FILE="",
+    host_header="",
+):
+    headers = {}
+    headers["Authorization"] = f"Bearer {apikey}"
+    body = None
+    if payload is not None:
+        # Serializing and compressing a batch takes longer than a scheduling slice, it is done in a thread so that the other tables keep going
+        body, body_headers = await asyncio.to_thread(encode_body, payload)
+        headers.update(body_headers)
+    if host_header != "":
+        headers["Host"] = host_header
+    limiter = get_limiter(urlPath, host_header)
+    breaker = get_breaker(urlPath, host_header)
+    status = None
+    # Status of the last attempt for the telemetry, see methods.request
+    last_status = None
+    content = b""
+    run = True
+    errors = {}
+    attempt = 0
+    throttle_wait = 0
+    latency = 0
+    start = monotonic()
+    while run == True:
+        if not breaker.allow():
+            errors["circuit_open"] = errors.get("circuit_open", 0) + 1
+            log_failure(ERROR_FILE, method, urlPath, payload, "circuit_open", "too many consecutive failures")
+            status = None
+            last_status = "circuit_open"
+            break
+        try:
+            wait = limiter.reserve()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                throttle_wait += wait
+                wait = limiter.reserve()
+            async with inflight:
+                sent = monotonic()
+                async with session.request(
+                    method, urlPath, headers=headers, data=body, timeout=client_timeout()
+                ) as resp:
+                    status = resp.status
+                    content = await resp.read()
+                    retry_after = retry_after_seconds(resp)
+                latency = monotonic() - sent
+            last_status = status
+            run = False
+            if status > 499:
+                breaker.failure()
+            else:
+                breaker.success()
+            if status > 299:
+                # Track error
+                if status in errors:
+                    errors[status] += 1
+                else:
+                    errors[status] = 1
+                # Retry upon throttling and gateway errors
+                if status in methods.RETRY_STATUS_CODES and attempt < methods.MAX_RETRIES:
+                    wait = backoff_seconds(attempt)
+                    if status == 429:
+                        limiter.throttle(retry_after)
+                        wait = max(retry_after, wait)
+                        throttle_wait += wait
+                    await asyncio.sleep(wait)
+                    attempt += 1
+                    run = True
+                elif status not in expect_codes:
+                    log_failure(ERROR_FILE, method, urlPath, payload, status, content.decode("utf-8", "replace"))
+            else:
+                limiter.success()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.failure()
+            errors["connection"] = errors.get("connection", 0) + 1
+            status = None
+            last_status = "connection"
+            if attempt < methods.MAX_RETRIES:
+                await asyncio.sleep(backoff_seconds(attempt))
+                attempt += 1
+            else:
+                log_failure(ERROR_FILE, method, urlPath, payload, "connection", repr(e))
+                run = False
+    telemetry.record(
+        method,
+        urlPath,
+        last_status,
+        latency,
+        monotonic() - start,
+        len(body) if body is not None else 0,
+        len(content),
+        attempt,
+        throttle_wait,
+    )
+    return status, content, errors
+
+
+async def query_pages(
+    session,
+    inflight,
+    query_payload,
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
+    table,
+    ERROR_FILE,
+    host_header="",
+    mode="full",
+    fetch_records="all",
+):
+    query_payload = deepcopy(query_payload)
+    while query_payload is not None:
+        status, content, errors = await request(
+            session,
+            inflight,
+            "POST",
+            apikey=from_XATA_API_KEY,
+            urlPath=from_BRANCH_URL + "/tables/" + table + "/query",
+            payload=query_payload,
+            ERROR_FILE=ERROR_FILE,
+            host_header=host_header,
+        )
+        if status is None or status > 299:
+            # The scroll cannot continue without the cursor of the failed page
+            with open(ERROR_FILE, "a") as f:
+                f.writelines([str(datetime.now().isoformat()) + " Scroll of table " + table + " aborted at query ", str(query_payload), "\n"])
+            return
+        query_response = await asyncio.to_thread(loads, content)
+        query_payload = next_page_query(
+            query_payload, query_response, mode, fetch_records
+        )
+        yield query_response["records"], deepcopy(query_payload)
+
+
+async def read_ahead(pages, PREFETCH):
+    # Requests the next pages in a separate task while the current one is processed, up to PREFETCH pages ahead
+    buffer = asyncio.Queue(PREFETCH)
+
+    async def fetch():
+        try:
+            async for page in pages:
+                await buffer.put(page)
+        finally:
+            await buffer.put(None)
+
+    fetcher = asyncio.ensure_future(fetch())
+    while True:
+        page = await buffer.get()
+        if page is None:
+            break
+        yield page
+    await fetcher
+
+
+def flatten_page(records, table, schema_links, schema_files):
+    return [flatten_record(record, table, schema_links, schema_files) for record in records]
+
+
+async def scroll(
+    session,
+    inflight,
+    queue,
+    query_payload,
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
+    table,
+    schema_links,
+    schema_files,
+    ERROR_FILE,
+    host_header="",
+    mode="full",
+    fetch_records="all",
+    PREFETCH=0,
+    checkpoint=None,
+    phase="copy",
+    position=0,
+):
+    pages = query_pages(
+        session,
+        inflight,
+        query_payload,
+        from_XATA_API_KEY,
+        from_BRANCH_URL,
+        table,
+        ERROR_FILE,
+        host_header,
+        mode,
+        fetch_records,
+    )
+    if PREFETCH > 0:
+        pages = read_ahead(pages, PREFETCH)
+    async for records, next_query in pages:
+        ticket = None
+        if checkpoint is not None:
+            ticket = checkpoint.page(table, phase, position, next_query, len(records))
+        if len(records) > 0:
+            await queue.put(
+                await asyncio.to_thread(
+                    flatten_page, records, table, schema_links, schema_files
+                ),
+                ticket,
+            )
+
+
+async def producer(
+    session,
+    inflight,
+    queue,
+    PAGE_SIZE,
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
+    table,
+    schema_links,
+    schema_files,
+    ERROR_FILE,
+    host_header="",
+    mode="full",
+    fetch_records="all",
+    partitions=1,
+    PREFETCH=0,
+    schema_columns=None,
+    checkpoint=None,
+    phase="copy",
+    since=None,
+):
+    scrolls = None
+    if checkpoint is not None:
+        scrolls = checkpoint.scrolls(table, phase)
+    if scrolls is None:
+        partition_summary = None
+        if partitions > 1:
+            status, content, errors = await request(
+                session,
+                inflight,
+                "POST",
+                apikey=from_XATA_API_KEY,
+                urlPath=from_BRANCH_URL + "/tables/" + table + "/summarize",
+                payload=partition_probe(),
+                ERROR_FILE=ERROR_FILE,
+                host_header=host_header,
+            )
+            if status == 200:
+                partition_summary = loads(content)["summaries"][0]
+        scrolls = scroll_queries(
+            PAGE_SIZE,
+            table,
+            schema_links,
+            schema_files,
+            mode,
+            fetch_records,
+            partitions,
+            schema_columns,
+            partition_summary,
+            since,
+        )
+        if checkpoint is not None:
+            checkpoint.start(table, phase, scrolls)
+    # The other partitions finish their scroll when one fails, the records they read are written before the failure is raised
+    results = await asyncio.gather(
+        *[
+            scroll(
+                session,
+                inflight,
+                queue,
+                scrolls[position]["query"],
+                from_XATA_API_KEY,
+                from_BRANCH_URL,
+                table,
+                schema_links,
+                schema_files,
+                ERROR_FILE,
+                host_header,
+                mode,
+                fetch_records,
+                PREFETCH,
+                checkpoint,
+                phase,
+                position,
+            )
+            for position in range(len(scrolls))
+            if not scrolls[position]["done"]
+        ],
+        return_exceptions=True,
+    )
+    await queue.put(None)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+async def store_producer(queue, link_store, table, PAGE_SIZE, checkpoint=None, phase="backfill"):
+    # Coroutine counterpart of threads.store_producer, the pages are read from the local store in a thread so that the event loop does not wait for SQLite
+    store_position = store_scroll(checkpoint, table, phase)
+    if not store_position["done"]:
+        pages = link_store.pages(table, PAGE_SIZE, store_position["query"]["after"])
+        while True:
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            records, position = page
+            ticket = None
+            if checkpoint is not None:
+                ticket = checkpoint.page(table, phase, 0, {"after": position}, len(records))
+            await queue.put(records, ticket)
+        if checkpoint is not None:
+            checkpoint.page(table, phase, 0, None, 0)
+    await queue.put(None)
+
+
+class TableWriter:
+    # Coroutine counterpart of threads.TableWriter. Producers await put() with pages and None at the end of the scroll, the writer coroutines of the pool write the batches.
+    def __init__(
+        self,
+        pool,
+        table_counts,
+        MAX_QUEUE_SIZE,
+        session,
+        inflight,
+        reporting_queue,
+        BULK_SIZE,
+        to_XATA_API_KEY,
+        to_BRANCH_URL,
+        table,
+        deferred_links,
+        ERROR_FILE,
+        host_header="",
+        mode="full",
+        records_type="all",
+        DEAD_LETTER_FILE="",
+        BULK_BYTES=0,
+        link_store=None,
+        checkpoint=None,
+        upsert=False,
+    ):
+        self.pool = pool
+        self.table_counts = table_counts
+        self.session = session
+        self.inflight = inflight
+        self.reporting_queue = reporting_queue
+        self.BULK_SIZE = BULK_SIZE
+        self.to_XATA_API_KEY = to_XATA_API_KEY
+        self.to_BRANCH_URL = to_BRANCH_URL
+        self.table = table
+        self.deferred_links = deferred_links
+        self.ERROR_FILE = ERROR_FILE
+        self.host_header = host_header
+        self.mode = mode
+        self.records_type = records_type
+        self.DEAD_LETTER_FILE = DEAD_LETTER_FILE
+        self.BULK_BYTES = BULK_BYTES
+        self.link_store = link_store
+        self.checkpoint = checkpoint
+        self.upsert = upsert
+        self.slots = asyncio.Semaphore(
+            queue_slots(MAX_QUEUE_SIZE, batch_size(BULK_SIZE, mode))
+        )
+        self.records = []
+        self.sizes = []
+        self.tickets = []
+        self.pending = 0
+        self.closed = False
+        self.finished = asyncio.Event()
+
+    async def put(self, page, ticket=None):
+        if page is None:
+            batches = [self.records] if len(self.records) > 0 else []
+            self.records = []
+            self.sizes = []
+        else:
+            self.records.extend(page)
+            self.sizes.extend(await asyncio.to_thread(self.prepare, page))
+            self.tickets.extend([ticket] * len(page))
+            batches, self.records, self.sizes = split_batches(
+                self.records,
+                self.sizes,
+                batch_size(self.BULK_SIZE, self.mode),
+                self.BULK_BYTES,
+            )
+        batch_tickets = []
+        offset = 0
+        for batch in batches:
+            batch_tickets.append(self.tickets[offset : offset + len(batch)])
+            offset += len(batch)
+        self.tickets = self.tickets[offset:]
+        self.pending += len(batches)
+        for batch, tickets in zip(batches, batch_tickets):
+            await self.slots.acquire()
+            # Counts arrive while the tables are copied, a table is ranked by its count as soon as it is known
+            self.pool.put(table_rank(self.table, self.table_counts), self, (batch, tickets))
+        if page is None:
+            self.closed = True
+            if self.pending == 0:
+                await self.close()
+
+    def prepare(self, page):
+        # Storing the links and measuring the records are done in a thread, away from the event loop, and return the encoded sizes of the records
+        if self.mode == "no_links":
+            if self.link_store is not None:
+                self.link_store.add(self.table, page, self.deferred_links[self.table])
+            for record in page:
+                strip_deferred_links(record, self.table, self.deferred_links)
+        if self.BULK_BYTES > 0:
+            return [encoded_size(record) for record in page]
+        return [0] * len(page)
+
+    async def write(self, batch):
+        records, tickets = batch
+        self.slots.release()
+        try:
+            await self.flush(records)
+        except Exception as e:
+            # A failure the requests do not handle must not stop the writer nor lose the batch
+            await self.abandon(records, e)
+        finally:
+            if self.checkpoint is not None:
+                self.checkpoint.acknowledge(tickets)
+            self.pending -= 1
+            if self.closed and self.pending == 0:
+                await self.close()
+
+    async def abandon(self, records, error):
+        method, path, payload, key = batch_request(
+            self.table, records, self.mode, self.records_type, self.upsert
+        )
+        log_failure(self.ERROR_FILE, method, self.to_BRANCH_URL + path, payload, "exception", repr(error))
+        deadletters.write(
+            self.DEAD_LETTER_FILE, self.table, method, path, payload, {"exception": 1}
+        )
+        await report(
+            self.reporting_queue,
+            {self.table: {"errors": {"exception": 1}, "failed": len(records)}},
+        )
+
+    async def close(self):
+        await report(
+            self.reporting_queue,
+            {self.table: {report_key(self.mode, self.records_type): None}},
+        )
+        self.finished.set()
+
+    async def flush(self, records):
+        await self.settle(records, await self.send(records), 0)
+
+    async def send(self, records, depth=0):
+        method, path, payload, key = batch_request(
+            self.table, records, self.mode, self.records_type, self.upsert
+        )
+        status, content, errors = await request(
+            self.session,
+            self.inflight,
+            method,
+            apikey=self.to_XATA_API_KEY,
+            urlPath=self.to_BRANCH_URL + path,
+            payload=payload,
+            expect_codes=split_codes(records, depth),
+            ERROR_FILE=self.ERROR_FILE,
+            host_header=self.host_header,
+        )
+        return method, path, payload, key, status, content.decode("utf-8", "replace"), errors
+
+    async def settle(self, records, sent, depth):
+        method, path, payload, key, status, text, errors = sent
+        # Send both halves of a rejected batch again, see threads.TableWriter.settle
+        if status in split_codes(records, depth):
+            halves = [records[: len(records) // 2], records[len(records) // 2 :]]
+            sent_halves = [await self.send(half, depth + 1) for half in halves]
+            if not repeated_rejection([sent_half[4:6] for sent_half in sent_halves]):
+                errors.pop(status, None)
+                if errors != {}:
+                    await report(self.reporting_queue, {self.table: {"errors": errors}})
+                for half, sent_half in zip(halves, sent_halves):
+                    await self.settle(half, sent_half, depth + 1)
+                return
+            # Splitting further would only repeat the rejection, the batch is kept whole in the dead letters with the errors of its halves
+            for sent_half in sent_halves:
+                for error_code in sent_half[6]:
+                    errors[error_code] = errors.get(error_code, 0) + sent_half[6][error_code]
+            log_failure(self.ERROR_FILE, method, self.to_BRANCH_URL + path, payload, status, text)
+        if errors != {}:
+            await report(self.reporting_queue, {self.table: {"errors": errors}})
+        # Keep failed batches for replay instead of losing them, their records are counted apart from the records written
+        if status is None or status > 299:
+            deadletters.write(
+                self.DEAD_LETTER_FILE, self.table, method, path, payload, errors
+            )
+            await report(self.reporting_queue, {self.table: {"failed": len(records)}})
+            return
+        await report(self.reporting_queue, {self.table: {key: len(records)}})
+
+
+class WriterPool:
+    # Writer coroutines shared by all tables, batches are taken by rank like with threads.WriterPool
+    def __init__(self, writers):
+        self.batches = asyncio.PriorityQueue()
+        self.sequence = count()
+        self.tasks = [
+            asyncio.ensure_future(self.writer()) for writer_iterator in range(writers)
+        ]
+
+    def put(self, rank, table_writer, batch):
+        metrics.queued(table_writer.table, 1)
+        self.batches.put_nowait((rank, next(self.sequence), table_writer, batch))
+
+    async def writer(self):
+        while True:
+            rank, sequence, table_writer, batch = await self.batches.get()
+            if table_writer is None:
+                break
+            metrics.queued(table_writer.table, -1)
+            metrics.active(table_writer.table, 1)
+            try:
+                await table_writer.write(batch)
+            finally:
+                metrics.active(table_writer.table, -1)
+
+    async def stop(self):
+        for task in self.tasks:
+            self.batches.put_nowait((float("inf"), next(self.sequence), None, None))
+        await asyncio.gather(*self.tasks)
+
+
+async def replay_tables(
+    tables,
+    reporting_queue,
+    MAX_QUEUE_SIZE,
+    PAGE_SIZE,
+    BULK_SIZE,
+    WRITERS,
+    MAX_INFLIGHT_REQUESTS,
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
+    to_XATA_API_KEY,
+    to_BRANCH_URL,
+    schema_links,
+    schema_files,
+    table_dependencies,
+    deferred_links,
+    ERROR_FILE,
+    source_host_header="",
+    destination_host_header="",
+    BACKFILL="bulk_transaction",
+    DEAD_LETTER_FILE="",
+    PARTITIONS=1,
+    PREFETCH=0,
+    schema_columns=None,
+    BULK_BYTES=0,
+    table_counts={},
+    link_store=None,
+    checkpoint=None,
+    table_since={},
+    skipped_tables=(),
+    synced_at=None,
+    file_pool=None,
+    file_tables=(),
+    upsert=False,
+):
+    # Producers and writers of all tables run as coroutines on one event loop, the number of requests in flight is bounded by a single semaphore instead of the number of threads.
+    inflight = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit=MAX_INFLIGHT_REQUESTS)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout()) as session:
+        pool = WriterPool(WRITERS)
+        copied = {table: asyncio.Event() for table in tables}
+
+        async def run_table(
+            table,
+            phase="copy",
+            consumer_mode="full",
+            records_type="all",
+            producer_mode="full",
+            fetch_records="all",
+            links=schema_links,
+        ):
+            if table in skipped_tables:
+                return
+            for status_report in resumed_reports(
+                checkpoint, table, phase, report_key(consumer_mode, records_type)
+            ):
+                await report(reporting_queue, status_report)
+            if checkpoint is not None and checkpoint.done(table, phase):
+                return
+            table_writer = TableWriter(
+                pool,
+                table_counts,
+                MAX_QUEUE_SIZE,
+                session,
+                inflight,
+                reporting_queue,
+                BULK_SIZE,
+                to_XATA_API_KEY,
+                to_BRANCH_URL,
+                table,
+                deferred_links,
+                ERROR_FILE,
+                destination_host_header,
+                consumer_mode,
+                records_type,
+                DEAD_LETTER_FILE,
+                BULK_BYTES,
+                link_store,
+                checkpoint,
+                upsert,
+            )
+            try:
+                await produce(table_writer, table, phase, producer_mode, fetch_records, links)
+            except Exception:
+                # The pass is closed with the records read so far and left unfinished in the state, a resumed run scrolls it again
+                if not table_writer.closed:
+                    await table_writer.put(None)
+                await table_writer.finished.wait()
+                raise
+            await table_writer.finished.wait()
+            if checkpoint is not None:
+                checkpoint.finish(table, phase)
+            if synced_at is not None:
+                synced_at[table] = datetime.now()
+
+        async def produce(table_writer, table, phase, producer_mode, fetch_records, links):
+            if producer_mode == "only_links" and link_store is not None:
+                await store_producer(
+                    table_writer, link_store, table, PAGE_SIZE, checkpoint, phase
+                )
+            else:
+                await producer(
+                    session,
+                    inflight,
+                    table_writer,
+                    PAGE_SIZE,
+                    from_XATA_API_KEY,
+                    from_BRANCH_URL,
+                    table,
+                    links,
+                    schema_files,
+                    ERROR_FILE,
+                    source_host_header,
+                    producer_mode,
+                    fetch_records,
+                    PARTITIONS,
+                    PREFETCH,
+                    schema_columns,
+                    checkpoint,
+                    phase,
+                    table_since.get(table),
+                )
+
+        async def run_files(table):
+            # Files are streamed by the threads of the file pool, the pass waits for them in a thread of its own
+            if table in skipped_tables or table not in file_tables:
+                return
+            await asyncio.to_thread(
+                copy_files,
+                file_pool,
+                reporting_queue,
+                table,
+                PAGE_SIZE,
+                schema_links,
+                schema_files,
+                ERROR_FILE,
+                DEAD_LETTER_FILE,
+                checkpoint,
+                "files",
+                table_since.get(table),
+                PREFETCH,
+            )
+            if synced_at is not None:
+                synced_at[table] = datetime.now()
+
+        async def schedule_table(table):
+            # A table that fails is recorded on its own and its remaining passes are closed, the other tables on the event loop carry on
+            try:
+                await copy_table(table)
+            except Exception as e:
+                with open(ERROR_FILE, "a") as f:
+                    f.writelines([str(datetime.now().isoformat()) + " Copy of table " + table + " aborted: ", repr(e), "\n"])
+                await report(reporting_queue, {table: {"errors": {"exception": 1}}})
+                await report(reporting_queue, {table: table_passes(table)})
+            finally:
+                copied[table].set()
+
+        def table_passes(table):
+            # Closing reports of every pass of the table, a pass already closed is not affected by a second one
+            passes = {"records": None}
+            if len(deferred_links[table]) > 0:
+                passes["links"] = None
+            if table in file_tables:
+                passes["files"] = None
+            return passes
+
+        async def copy_table(table):
+            # Same schedule as the threads engine, see schedule_table in xreplay.py
+            for dependency in table_dependencies[table]:
+                await copied[dependency].wait()
+            if len(deferred_links[table]) == 0:
+                await run_table(table)
+                copied[table].set()
+                await run_files(table)
+                return
+            await run_table(table, "copy", "no_links")
+            copied[table].set()
+            for column in deferred_links[table]:
+                await copied[deferred_links[table][column]["link"]["table"]].wait()
+            consumer_mode, records_type, producer_mode, fetch_records = backfill_modes(
+                BACKFILL
+            )
+            await run_table(
+                table,
+                "backfill",
+                consumer_mode,
+                records_type,
+                producer_mode,
+                fetch_records,
+                deferred_links if producer_mode == "only_links" else schema_links,
+            )
+            await run_files(table)
+
+        await asyncio.gather(*[schedule_table(table) for table in tables])
+        await pool.stop()
@@ -0,0 +1,228 @@
+from queue import Queue
+from threading import Thread, Lock, Event
+from methods import request, transfer
+from threads import initial_query, query_pages, read_ahead, resumed_reports
+import deadletters
+
+# file and file[] columns are left out of the record writes. Once the passes of a table are done, its attachments are copied by a separate pass: the metadata of the files of each page is set on the target records, then the content of each file is streamed from the source files API to the target by the threads of the file pool.
+# Each file is acknowledged to the checkpoint once it is transferred, so that a resumed pass continues after the last page whose files were all copied.
+
+# Metadata kept when the files are written to the target, the content is uploaded separately
+FILE_METADATA = ["name", "mediaType", "enablePublicUrl", "signedUrlTimeout"]
+
+
+def file_query(PAGE_SIZE, table, schema_links, schema_files, since=None):
+    # Only the records with a file in one of the file columns, the files are returned with their metadata and without their content
+    return initial_query(
+        PAGE_SIZE,
+        table,
+        schema_links,
+        partition_filter={
+            "$any": [{"$exists": column} for column in schema_files[table]]
+        },
+        columns=list(schema_files[table]),
+        since=since,
+    )
+
+
+def file_metadata(value):
+    return {key: value[key] for key in FILE_METADATA if key in value}
+
+
+def file_fields(record, table, schema_files):
+    # Metadata of the files of a record as written to the target, and the files to transfer as (column, file id, media type). Files of file[] columns keep their id, the content is uploaded to the same id.
+    fields = {}
+    files = []
+    for column in schema_files[table]:
+        value = record.get(column)
+        if value is None:
+            continue
+        if schema_files[table][column]["type"] == "file":
+            fields[column] = file_metadata(value)
+            files.append((column, None, value.get("mediaType")))
+        else:
+            fields[column] = []
+            for item in value:
+                entry = file_metadata(item)
+                entry["id"] = item["id"]
+                fields[column].append(entry)
+                files.append((column, item["id"], item.get("mediaType")))
+    return fields, files
+
+
+def file_path(BRANCH_URL, table, record_id, column, file_id=None):
+    path = BRANCH_URL + "/tables/" + table + "/data/" + record_id + "/column/" + column + "/file"
+    if file_id is not None:
+        path += "/" + file_id
+    return path
+
+
+class TableFiles:
+    # Files of one table pass in the file pool. The pass is closed with a single report once the scroll is over and its last file is transferred.
+    def __init__(self, reporting_queue, table, checkpoint=None):
+        self.reporting_queue = reporting_queue
+        self.table = table
+        self.checkpoint = checkpoint
+        self.lock = Lock()
+        self.pending = 0
+        self.closed = False
+        self.finished = Event()
+
+    def add(self, files):
+        with self.lock:
+            self.pending += files
+
+    def done(self, ticket, resp, errors):
+        if errors != {}:
+            self.reporting_queue.put({self.table: {"errors": errors}})
+        if resp is not None and resp.status_code <= 299:
+            self.reporting_queue.put({self.table: {"files": 1}})
+        # Failed files are in the error log, the page counts as copied for the checkpoint
+        if self.checkpoint is not None:
+            self.checkpoint.acknowledge([ticket])
+        with self.lock:
+            self.pending -= 1
+            finished = self.closed and self.pending == 0
+        if finished:
+            self.close()
+
+    def end(self):
+        with self.lock:
+            self.closed = True
+            finished = self.pending == 0
+        if finished:
+            self.close()
+
+    def close(self):
+        self.reporting_queue.put({self.table: {"files": None}})
+        self.finished.set()
+
+
+class FilePool:
+    # Threads shared by all tables that stream the content of files from the source to the target. Files wait for a thread in a bounded queue, so that the scrolls of the file passes do not run ahead of the transfers.
+    def __init__(self, concurrency, source, target, ERROR_FILE):
+        self.source = source
+        self.target = target
+        self.ERROR_FILE = ERROR_FILE
+        self.files = Queue(concurrency * 2)
+        self.threads = [Thread(target=self.transferrer) for thread_iterator in range(concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, table_files, ticket, record_id, column, file_id, media_type):
+        self.files.put((table_files, ticket, record_id, column, file_id, media_type))
+
+    def transferrer(self):
+        while True:
+            item = self.files.get()
+            if item is None:
+                return
+            table_files, ticket, record_id, column, file_id, media_type = item
+            resp, errors = transfer(
+                self.source["key"],
+                file_path(self.source["url"], table_files.table, record_id, column, file_id),
+                self.target["key"],
+                file_path(self.target["url"], table_files.table, record_id, column, file_id),
+                media_type,
+                self.ERROR_FILE,
+                self.source["host_header"],
+                self.target["host_header"],
+            )
+            table_files.done(ticket, resp, errors)
+
+    def stop(self):
+        for thread in self.threads:
+            self.files.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def write_metadata(file_pool, reporting_queue, table, operations, DEAD_LETTER_FILE):
+    # Set the metadata of the files of a page on the target records, the content can only be uploaded to files that exist
+    payload = {"operations": operations}
+    resp, errors = request(
+        "POST",
+        apikey=file_pool.target["key"],
+        urlPath=file_pool.target["url"] + "/transaction",
+        payload=payload,
+        ERROR_FILE=file_pool.ERROR_FILE,
+        host_header=file_pool.target["host_header"],
+    )
+    if errors != {}:
+        reporting_queue.put({table: {"errors": errors}})
+    if resp is None or resp.status_code > 299:
+        deadletters.write(DEAD_LETTER_FILE, table, "POST", "/transaction", payload, errors)
+        return False
+    return True
+
+
+def copy_files(
+    file_pool,
+    reporting_queue,
+    table,
+    PAGE_SIZE,
+    schema_links,
+    schema_files,
+    ERROR_FILE,
+    DEAD_LETTER_FILE="",
+    checkpoint=None,
+    phase="files",
+    since=None,
+    PREFETCH=0,
+):
+    # Copy the attachments of a table and return once all of its files are transferred. A pass completed by an interrupted run is only reported.
+    for status_report in resumed_reports(checkpoint, table, phase, "files"):
+        reporting_queue.put(status_report)
+    if checkpoint is not None and checkpoint.done(table, phase):
+        return
+    scrolls = None
+    if checkpoint is not None:
+        scrolls = checkpoint.scrolls(table, phase)
+    if scrolls is None:
+        scrolls = [
+            {
+                "query": file_query(PAGE_SIZE, table, schema_links, schema_files, since),
+                "done": False,
+            }
+        ]
+        if checkpoint is not None:
+            checkpoint.start(table, phase, scrolls)
+    table_files = TableFiles(reporting_queue, table, checkpoint)
+    if not scrolls[0]["done"]:
+        pages = query_pages(
+            scrolls[0]["query"],
+            file_pool.source["key"],
+            file_pool.source["url"],
+            table,
+            ERROR_FILE,
+            file_pool.source["host_header"],
+        )
+        if PREFETCH > 0:
+            pages = read_ahead(pages, PREFETCH)
+        for records, next_query in pages:
+            operations = []
+            files = []
+            for record in records:
+                fields, record_files = file_fields(record, table, schema_files)
+                operations.append(
+                    {"update": {"table": table, "id": record["id"], "fields": fields}}
+                )
+                files.extend((record["id"],) + record_file for record_file in record_files)
+            # The checkpoint counts the files of the page instead of its records
+            ticket = None
+            if checkpoint is not None:
+                ticket = checkpoint.page(table, phase, 0, next_query, len(files))
+            if len(operations) > 0 and not write_metadata(
+                file_pool, reporting_queue, table, operations, DEAD_LETTER_FILE
+            ):
+                # The files of the page are skipped along with their metadata, which is in the dead letters
+                if checkpoint is not None:
+                    checkpoint.acknowledge([ticket] * len(files))
+                continue
+            table_files.add(len(files))
+            for record_id, column, file_id, media_type in files:
+                file_pool.put(table_files, ticket, record_id, column, file_id, media_type)
+    table_files.end()
+    table_files.finished.wait()
+    if checkpoint is not None:
+        checkpoint.finish(table, phase)
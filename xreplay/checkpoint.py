@@ -0,0 +1,163 @@
+import json
+import os
+from threading import Lock
+
+# Progress of a run is kept in a JSON state file, so that an interrupted run can be resumed with --resume.
+# Each pass of a table (copy, then backfill for the links of cycles) records the query of every scroll that follows the last page whose records have all been written, and whether the pass is done.
+# Pages are written by several writers out of order, a scroll only advances once all the pages before it have been written as well.
+# The pages written after the last save are written again by a resumed run, which upserts its records so that they replace the ones already written instead of failing as duplicates.
+
+
+def write_json(path, content):
+    # Write to a temporary file first, so that an interruption never leaves a truncated file
+    with open(path + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+
+def load_marks(path):
+    # High-water marks of the last completed run from the same source to the same target, None before the first one
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_marks(path, marks):
+    write_json(path, json.dumps(marks, indent=2))
+
+
+class PageTicket:
+    def __init__(self, table, phase, scroll, sequence, next_query, records):
+        self.table = table
+        self.phase = phase
+        self.scroll = scroll
+        self.sequence = sequence
+        self.next_query = next_query
+        self.records = records
+        self.remaining = records
+
+
+class Checkpoint:
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.lock = Lock()
+        # Saves from the saver thread and from finished passes share the temporary file
+        self.save_lock = Lock()
+        # Sequence numbers of the pages read and written in this run, per scroll
+        self.progress = {}
+
+    @classmethod
+    def create(cls, path, run):
+        checkpoint = cls(path, {"run": run, "completed": False, "tables": {}})
+        checkpoint.save()
+        return checkpoint
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls(path, json.load(f))
+
+    def phase_state(self, table, phase):
+        return self.state["tables"].get(table, {}).get(phase)
+
+    def done(self, table, phase):
+        with self.lock:
+            phase_state = self.phase_state(table, phase)
+            return phase_state is not None and phase_state["done"]
+
+    def records(self, table, phase):
+        with self.lock:
+            phase_state = self.phase_state(table, phase)
+            return phase_state["records"] if phase_state is not None else 0
+
+    def scrolls(self, table, phase):
+        # The scrolls of a pass started by a previous run, None when the pass has not started yet
+        with self.lock:
+            phase_state = self.phase_state(table, phase)
+            if phase_state is None:
+                return None
+            return [dict(scroll) for scroll in phase_state["scrolls"]]
+
+    def start(self, table, phase, scrolls):
+        with self.lock:
+            self.state["tables"].setdefault(table, {})[phase] = {
+                "done": False,
+                "records": 0,
+                "scrolls": [dict(scroll) for scroll in scrolls],
+            }
+        self.save()
+
+    def page(self, table, phase, scroll, next_query, records):
+        # Returns the ticket of a page read by a scroll, next_query is None for the last page
+        with self.lock:
+            progress = self.progress.setdefault(
+                (table, phase, scroll), {"next": 0, "committed": -1, "written": {}}
+            )
+            ticket = PageTicket(table, phase, scroll, progress["next"], next_query, records)
+            progress["next"] += 1
+            if records == 0:
+                self.commit(ticket)
+            return ticket
+
+    def acknowledge(self, tickets):
+        # Called with the ticket of each record of a batch once it is written
+        with self.lock:
+            for ticket in tickets:
+                if ticket is None:
+                    continue
+                ticket.remaining -= 1
+                if ticket.remaining == 0:
+                    self.commit(ticket)
+
+    def commit(self, ticket):
+        # Advance the scroll over all the contiguous pages written so far, called with the lock held
+        progress = self.progress[(ticket.table, ticket.phase, ticket.scroll)]
+        progress["written"][ticket.sequence] = ticket
+        phase_state = self.state["tables"][ticket.table][ticket.phase]
+        scroll_state = phase_state["scrolls"][ticket.scroll]
+        while progress["committed"] + 1 in progress["written"]:
+            progress["committed"] += 1
+            written = progress["written"].pop(progress["committed"])
+            phase_state["records"] += written.records
+            if written.next_query is None:
+                scroll_state["done"] = True
+            else:
+                scroll_state["query"] = written.next_query
+
+    def finish(self, table, phase):
+        # The pass is done once all of its scrolls reached their last page, a pass with an aborted scroll is resumed from its last written page
+        with self.lock:
+            phase_state = self.phase_state(table, phase)
+            if phase_state is not None:
+                phase_state["done"] = all(
+                    scroll["done"] for scroll in phase_state["scrolls"]
+                )
+        self.save()
+
+    def merge(self, tables):
+        # State of the tables of a worker process, which owns those tables for the run
+        with self.lock:
+            self.state["tables"].update(tables)
+
+    def complete(self):
+        with self.lock:
+            self.state["completed"] = all(
+                phase_state["done"]
+                for table in self.state["tables"]
+                for phase_state in self.state["tables"][table].values()
+            )
+        self.save()
+        return self.state["completed"]
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                content = json.dumps(self.state, indent=2)
+            write_json(self.path, content)
+
+    def saver(self, interval, stop):
+        # Periodically save the state until the stop event is set
+        while not stop.wait(interval):
+            self.save()
@@ -0,0 +1,127 @@
+from threading import Lock
+from datetime import datetime
+from methods import request, dumps, loads
+
+# Failed write batches are appended as one JSON object per line with the table, request and last status, so that they can be sent again with --replay_dead_letters.
+dead_letters_lock = Lock()
+dead_letters_count = 0
+
+
+def write(DEAD_LETTER_FILE, table, method, path, payload, errors):
+    global dead_letters_count
+    dead_letter = {
+        "time": datetime.now().isoformat(),
+        "table": table,
+        "method": method,
+        "path": path,
+        "payload": payload,
+        "status": list(errors)[-1] if len(errors) > 0 else None,
+        "errors": {str(error): errors[error] for error in errors},
+    }
+    with dead_letters_lock:
+        with open(DEAD_LETTER_FILE, "ab") as f:
+            f.write(dumps(dead_letter) + b"\n")
+        dead_letters_count += 1
+
+
+def count():
+    with dead_letters_lock:
+        return dead_letters_count
+
+
+def add_count(dead_letters):
+    # Batches written to the file by worker processes
+    global dead_letters_count
+    with dead_letters_lock:
+        dead_letters_count += dead_letters
+
+
+def reset_after_fork():
+    global dead_letters_lock, dead_letters_count
+    dead_letters_lock = Lock()
+    dead_letters_count = 0
+
+
+def read(path):
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip() != b"":
+                yield loads(line)
+
+
+def replay(
+    path,
+    to_XATA_API_KEY,
+    to_BRANCH_URL,
+    BULK_SIZE,
+    ERROR_FILE,
+    DEAD_LETTER_FILE,
+    host_header="",
+):
+    # Merge the failed bulk records per table and the failed transaction operations, and send them again in batches of BULK_SIZE. Atomic updates are sent as they are.
+    bulk_records = {}
+    transaction_operations = {}
+    other_requests = []
+    for dead_letter in read(path):
+        if dead_letter["path"].endswith("/bulk"):
+            bulk_records.setdefault(dead_letter["table"], []).extend(
+                dead_letter["payload"]["records"]
+            )
+        elif dead_letter["path"] == "/transaction":
+            transaction_operations.setdefault(dead_letter["table"], []).extend(
+                dead_letter["payload"]["operations"]
+            )
+        else:
+            other_requests.append(dead_letter)
+    batches = []
+    for table in bulk_records:
+        records = bulk_records[table]
+        for position in range(0, len(records), BULK_SIZE):
+            batches.append(
+                (
+                    table,
+                    "POST",
+                    "/tables/" + table + "/bulk",
+                    {"records": records[position : position + BULK_SIZE]},
+                    len(records[position : position + BULK_SIZE]),
+                )
+            )
+    for table in transaction_operations:
+        operations = transaction_operations[table]
+        for position in range(0, len(operations), BULK_SIZE):
+            batches.append(
+                (
+                    table,
+                    "POST",
+                    "/transaction",
+                    {"operations": operations[position : position + BULK_SIZE]},
+                    len(operations[position : position + BULK_SIZE]),
+                )
+            )
+    for dead_letter in other_requests:
+        batches.append(
+            (
+                dead_letter["table"],
+                dead_letter["method"],
+                dead_letter["path"],
+                dead_letter["payload"],
+                1,
+            )
+        )
+    replayed = 0
+    failed = 0
+    for table, method, batch_path, payload, size in batches:
+        resp, errors = request(
+            method,
+            apikey=to_XATA_API_KEY,
+            urlPath=to_BRANCH_URL + batch_path,
+            payload=payload,
+            ERROR_FILE=ERROR_FILE,
+            host_header=host_header,
+        )
+        if resp is None or resp.status_code > 299:
+            write(DEAD_LETTER_FILE, table, method, batch_path, payload, errors)
+            failed += size
+        else:
+            replayed += size
+    return replayed, failed
@@ -0,0 +1,71 @@
+import os
+import sqlite3
+from threading import Lock
+from methods import dumps, loads
+
+# The values of the links of cycles are captured while the records are copied without them, and read back from this local store to backfill the links, instead of scrolling the source tables a second time.
+
+
+def remove_store(path):
+    # The write-ahead log of a removed store must go with it, it would be replayed into a new store at the same path
+    for store_file in (path, path + "-wal", path + "-shm"):
+        if os.path.exists(store_file):
+            os.remove(store_file)
+
+
+class LinkStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        # A single connection shared by all threads, writes are serialized by the lock. Worker processes open their own connection and wait for the file lock of the others.
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # A resumed run backfills from the store of the interrupted one, which must survive a crash in the middle of a write. The write-ahead log keeps the file consistent without syncing each transaction.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS links (tbl TEXT NOT NULL, id TEXT NOT NULL, fields BLOB NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS links_tbl ON links (tbl)")
+        self.connection.commit()
+
+    def add(self, table, records, columns):
+        # Keep the id and the values of the given link columns of records that have any of them set
+        rows = []
+        for record in records:
+            fields = {}
+            for column in columns:
+                if record.get(column) is not None:
+                    fields[column] = record[column]
+            if len(fields) > 0:
+                rows.append((table, record["id"], dumps(fields)))
+        if len(rows) == 0:
+            return
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO links (tbl, id, fields) VALUES (?, ?, ?)", rows
+                )
+
+    def pages(self, table, PAGE_SIZE, position=0):
+        # Yields the stored links of the table as pages of records with their id, in insertion order, along with the position to resume after the page
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT rowid, id, fields FROM links WHERE tbl = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                    (table, position, PAGE_SIZE),
+                ).fetchall()
+            if len(rows) == 0:
+                return
+            records = []
+            for rowid, record_id, fields in rows:
+                record = loads(fields)
+                record["id"] = record_id
+                records.append(record)
+            position = rows[-1][0]
+            yield records, position
+
+    def close(self, remove=True):
+        with self.lock:
+            self.connection.close()
+        if remove:
+            remove_store(self.path)
@@ -1,123 +1,551 @@
-from time import sleep
+from time import sleep, monotonic
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from random import uniform
+from threading import Lock
+import gzip
+import json
 import requests
-from urllib.parse import urljoin
+import telemetry
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin, urlsplit
 
-def get(apikey, urlPath, headers={}, expect_codes=[],ERROR_FILE='',host_header=''):
-    headers={}
-    headers["Authorization"] = f"Bearer {apikey}"
-    if host_header != '':
-        headers["Host"] = host_header
-    run=True
-    errors={}
-    while run==True:
-        try:
-            resp = requests.request("GET", urlPath, headers=headers)
-            run = False
-            if resp.status_code > 299:
-                #Track error
-                if resp.status_code in errors:
-                    errors[resp.status_code]+=1
-                else:
-                    errors[resp.status_code]=1
-                #Retry upon throttling error
-                if resp.status_code == 429:
-                    sleep(0.05)
-                    run=True
-                else:
-                    if resp.status_code not in expect_codes:
-                        with open(ERROR_FILE, "a") as f:
-                            f.writelines([str(datetime.now().isoformat())+" GET request failed ",str(urlPath),"\n",str(resp.status_code)," ",str(resp.text),"\n"])
-        except requests.exceptions.ConnectionError as e:
-            run=True
-    return resp,errors
-
-def post(apikey, urlPath, headers={}, payload='', expect_codes=[],ERROR_FILE='',host_header=''):
-    headers={}
-    headers["Authorization"] = f"Bearer {apikey}"
-    headers["Content-Type"] = f"application/json"
-    if host_header != '':
-        headers["Host"] = host_header
-    run=True
-    errors={}
-    while run==True:
-        try:
-            resp = requests.request("POST", urlPath, headers=headers, json=payload)
-            run = False
-            if resp.status_code > 299:
-                #Track error
-                if resp.status_code in errors:
-                    errors[resp.status_code]+=1
-                else:
-                    errors[resp.status_code]=1
-                #Retry upon throttling error
-                if resp.status_code == 429:
-                    sleep(0.05)
-                    run=True
-                else:
-                    if resp.status_code not in expect_codes:
-                        with open(ERROR_FILE, "a") as f:
-                            f.writelines([str(datetime.now().isoformat())+" POST request failed ",str(urlPath),"\n",str(payload),"\n",str(resp.status_code)," ",str(resp.text),"\n"])
-        except requests.exceptions.ConnectionError as e:
-            run=True
-    return resp,errors
-
-def put(apikey, urlPath, headers={}, payload='', expect_codes=[],ERROR_FILE='',host_header=''):
-    headers={}
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Request and response bodies are encoded with orjson when it is installed. Request bodies above a minimum size can be compressed with gzip or zstd to reduce egress bytes.
+JSON_CODEC = "orjson" if orjson is not None else "json"
+COMPRESSION = "none"
+COMPRESSION_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+
+def configure_codec(json_codec="auto", compression="none"):
+    global JSON_CODEC, COMPRESSION
+    if json_codec == "auto":
+        JSON_CODEC = "orjson" if orjson is not None else "json"
+    else:
+        JSON_CODEC = json_codec
+    COMPRESSION = compression
+
+
+def dumps(payload):
+    if JSON_CODEC == "orjson":
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":"), allow_nan=False).encode("utf-8")
+
+
+def loads(data):
+    if JSON_CODEC == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def response_json(resp):
+    return loads(resp.content)
+
+
+def encode_body(payload):
+    body = dumps(payload)
+    headers = {}
+    headers["Content-Type"] = "application/json"
+    if COMPRESSION != "none" and len(body) >= COMPRESSION_MIN_BYTES:
+        if COMPRESSION == "gzip":
+            body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        elif COMPRESSION == "zstd":
+            body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+        headers["Content-Encoding"] = COMPRESSION
+    return body, headers
+
+# Keep-alive sessions are shared by all threads, one per base url and host header, so that consecutive requests reuse connections instead of paying a new TCP and TLS handshake each time.
+POOL_SIZE = 10
+sessions = {}
+sessions_lock = Lock()
+
+
+def configure_sessions(pool_size):
+    global POOL_SIZE
+    with sessions_lock:
+        POOL_SIZE = max(1, int(pool_size))
+        # Resize pools of sessions that were opened before the thread counts were known. The connections of the replaced adapter are closed, the ones in use are closed when they are released.
+        for base_url in sessions:
+            prefix = urlsplit(base_url[0]).scheme + "://"
+            replaced = sessions[base_url].adapters.get(prefix)
+            sessions[base_url].mount(
+                prefix, HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            )
+            if replaced is not None:
+                replaced.close()
+
+
+def get_session(urlPath, host_header=""):
+    url_parts = urlsplit(urlPath)
+    base_url = (url_parts.scheme + "://" + url_parts.netloc, host_header)
+    with sessions_lock:
+        if base_url not in sessions:
+            session = requests.Session()
+            session.mount(
+                url_parts.scheme + "://",
+                HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE),
+            )
+            sessions[base_url] = session
+        return sessions[base_url]
+
+
+def session_stats():
+    stats = []
+    with sessions_lock:
+        for base_url, host_header in sessions:
+            session = sessions[(base_url, host_header)]
+            pool_stats = {
+                "base_url": base_url,
+                "host_header": host_header,
+                "pool_size": POOL_SIZE,
+                "connections": 0,
+                "requests": 0,
+            }
+            for adapter in session.adapters.values():
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools[pool_key]
+                    pool_stats["connections"] += pool.num_connections
+                    pool_stats["requests"] += pool.num_requests
+            if pool_stats["requests"] > 0:
+                stats.append(pool_stats)
+    return stats
+
+
+# Request rate limits are shared by all threads per base url and host header. The rate is halved when the destination starts throttling and grows back additively on success (AIMD), so that writers settle just below the throttling ceiling instead of retrying in bursts.
+MAX_REQUEST_RATE = 1000.0
+MIN_REQUEST_RATE = 1.0
+RATE_INCREASE = 0.5
+RATE_DECREASE = 0.5
+RATE_DECREASE_INTERVAL = 1.0
+BACKOFF_BASE = 0.05
+BACKOFF_MAX = 10.0
+limiters = {}
+limiters_lock = Lock()
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.lock = Lock()
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = monotonic()
+        self.decreased = 0.0
+        self.paused_until = 0.0
+        self.throttled = 0
+
+    def reserve(self):
+        # Takes a token if one is available, otherwise returns how long to wait before trying again
+        with self.lock:
+            now = monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            # Allow short bursts of up to a tenth of a second worth of requests
+            burst = max(1.0, self.rate / 10)
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        waited = 0
+        wait = self.reserve()
+        while wait > 0:
+            sleep(wait)
+            waited += wait
+            wait = self.reserve()
+        return waited
+
+    def success(self):
+        with self.lock:
+            self.rate = min(MAX_REQUEST_RATE, self.rate + RATE_INCREASE)
+
+    def throttle(self, retry_after):
+        with self.lock:
+            now = monotonic()
+            self.throttled += 1
+            # Concurrent requests that were already in flight all see the same throttling, only decrease once per interval
+            if now - self.decreased > RATE_DECREASE_INTERVAL:
+                self.rate = max(MIN_REQUEST_RATE, self.rate * RATE_DECREASE)
+                self.decreased = now
+            if retry_after > 0:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+
+def configure_limiters(max_rate):
+    global MAX_REQUEST_RATE
+    with limiters_lock:
+        MAX_REQUEST_RATE = max(MIN_REQUEST_RATE, float(max_rate))
+        for base_url in limiters:
+            limiters[base_url].rate = min(limiters[base_url].rate, MAX_REQUEST_RATE)
+
+
+def get_limiter(urlPath, host_header=""):
+    url_parts = urlsplit(urlPath)
+    base_url = (url_parts.scheme + "://" + url_parts.netloc, host_header)
+    with limiters_lock:
+        if base_url not in limiters:
+            limiters[base_url] = RateLimiter(MAX_REQUEST_RATE)
+        return limiters[base_url]
+
+
+def limiter_stats():
+    stats = []
+    with limiters_lock:
+        for base_url, host_header in limiters:
+            limiter = limiters[(base_url, host_header)]
+            stats.append(
+                {
+                    "base_url": base_url,
+                    "host_header": host_header,
+                    "rate": round(limiter.rate, 1),
+                    "throttled": limiter.throttled,
+                }
+            )
+    return stats
+
+
+def retry_after_seconds(resp):
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after is None:
+        return 0
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0
+
+
+# Retries are bounded, and a circuit breaker per base url and host header stops sending requests to a target that keeps failing for a cooldown period, so that failed batches are handed back to the caller in seconds instead of hanging a thread.
+MAX_RETRIES = 10
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+# Seconds to open a connection and to wait between two reads of a response, a request that stalls is retried like a dropped connection
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 300.0
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+breakers = {}
+breakers_lock = Lock()
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.lock = Lock()
+        self.failures = 0
+        self.opened_until = 0.0
+        self.trips = 0
+
+    def allow(self):
+        # Once the cooldown has passed, requests are let through again and a single failure reopens the circuit
+        with self.lock:
+            return monotonic() >= self.opened_until
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= BREAKER_THRESHOLD:
+                self.opened_until = monotonic() + BREAKER_COOLDOWN
+                self.trips += 1
+
+
+def configure_retries(max_retries):
+    global MAX_RETRIES
+    MAX_RETRIES = int(max_retries)
+
+
+def get_breaker(urlPath, host_header=""):
+    url_parts = urlsplit(urlPath)
+    base_url = (url_parts.scheme + "://" + url_parts.netloc, host_header)
+    with breakers_lock:
+        if base_url not in breakers:
+            breakers[base_url] = CircuitBreaker()
+        return breakers[base_url]
+
+
+def breaker_stats():
+    stats = []
+    with breakers_lock:
+        for base_url, host_header in breakers:
+            breaker = breakers[(base_url, host_header)]
+            stats.append(
+                {
+                    "base_url": base_url,
+                    "host_header": host_header,
+                    "trips": breaker.trips,
+                    "open": monotonic() < breaker.opened_until,
+                }
+            )
+    return stats
+
+
+def reset_after_fork():
+    global sessions, sessions_lock, limiters, limiters_lock, breakers, breakers_lock
+    sessions = {}
+    sessions_lock = Lock()
+    limiters = {}
+    limiters_lock = Lock()
+    breakers = {}
+    breakers_lock = Lock()
+
+
+def log_failure(ERROR_FILE, method, urlPath, payload, status, text):
+    with open(ERROR_FILE, "a") as f:
+        if payload is None:
+            f.writelines([str(datetime.now().isoformat()) + " " + method + " request failed ", str(urlPath), "\n", str(status), " ", str(text), "\n"])
+        else:
+            f.writelines([str(datetime.now().isoformat()) + " " + method + " request failed ", str(urlPath), "\n", str(payload), "\n", str(status), " ", str(text), "\n"])
+
+
+def backoff_seconds(attempt):
+    # Exponential backoff with full jitter
+    return uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def request(method, apikey, urlPath, payload=None, expect_codes=[], ERROR_FILE="", host_header=""):
+    headers = {}
     headers["Authorization"] = f"Bearer {apikey}"
-    headers["Content-Type"] = f"application/json"
-    if host_header != '':
+    body = None
+    if payload is not None:
+        body, body_headers = encode_body(payload)
+        headers.update(body_headers)
+    if host_header != "":
         headers["Host"] = host_header
-    run=True
-    errors={}
-    while run==True:
+    session = get_session(urlPath, host_header)
+    limiter = get_limiter(urlPath, host_header)
+    breaker = get_breaker(urlPath, host_header)
+    resp = None
+    # Status of the last attempt for the telemetry, a status code or the error of an attempt without response
+    last_status = None
+    run = True
+    errors = {}
+    attempt = 0
+    throttle_wait = 0
+    latency = 0
+    start = monotonic()
+    while run == True:
+        # Fail fast while the target is considered down, the caller decides what to do with the payload
+        if not breaker.allow():
+            errors["circuit_open"] = errors.get("circuit_open", 0) + 1
+            log_failure(ERROR_FILE, method, urlPath, payload, "circuit_open", "too many consecutive failures")
+            resp = None
+            last_status = "circuit_open"
+            break
         try:
-            resp = requests.request("PUT", urlPath, headers=headers, json=payload)
+            throttle_wait += limiter.acquire()
+            sent = monotonic()
+            resp = session.request(
+                method, urlPath, headers=headers, data=body, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+            )
+            latency = monotonic() - sent
+            last_status = resp.status_code
             run = False
+            if resp.status_code > 499:
+                breaker.failure()
+            else:
+                breaker.success()
             if resp.status_code > 299:
-                #Track error
+                # Track error
                 if resp.status_code in errors:
-                    errors[resp.status_code]+=1
-                else:
-                    errors[resp.status_code]=1
-                #Retry upon throttling error
-                if resp.status_code == 429:
-                    sleep(0.05)
-                    run=True
+                    errors[resp.status_code] += 1
                 else:
-                    if resp.status_code not in expect_codes:
-                        with open(ERROR_FILE, "a") as f:
-                            f.writelines([str(datetime.now().isoformat())+" PUT request failed ",str(urlPath),"\n",str(payload),"\n",str(resp.status_code)," ",str(resp.text),"\n"])
-        except requests.exceptions.ConnectionError as e:
-            run=True
-    return resp,errors
-
-def patch(apikey, urlPath, headers={}, payload='', expect_codes=[],ERROR_FILE='',host_header=''):
-    headers={}
-    headers["Authorization"] = f"Bearer {apikey}"
-    headers["Content-Type"] = f"application/json"
-    if host_header != '':
-        headers["Host"] = host_header
-    run=True
-    errors={}
-    while run==True:
+                    errors[resp.status_code] = 1
+                # Retry upon throttling and gateway errors
+                if resp.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+                    wait = backoff_seconds(attempt)
+                    if resp.status_code == 429:
+                        retry_after = retry_after_seconds(resp)
+                        limiter.throttle(retry_after)
+                        wait = max(retry_after, wait)
+                        throttle_wait += wait
+                    sleep(wait)
+                    attempt += 1
+                    run = True
+                elif resp.status_code not in expect_codes:
+                    log_failure(ERROR_FILE, method, urlPath, payload, resp.status_code, resp.text)
+            else:
+                limiter.success()
+        except requests.exceptions.RequestException as e:
+            breaker.failure()
+            errors["connection"] = errors.get("connection", 0) + 1
+            resp = None
+            last_status = "connection"
+            if attempt < MAX_RETRIES:
+                sleep(backoff_seconds(attempt))
+                attempt += 1
+            else:
+                log_failure(ERROR_FILE, method, urlPath, payload, "connection", repr(e))
+                run = False
+    telemetry.record(
+        method,
+        urlPath,
+        last_status,
+        latency,
+        monotonic() - start,
+        len(body) if body is not None else 0,
+        len(resp.content) if resp is not None else 0,
+        attempt,
+        throttle_wait,
+    )
+    return resp, errors
+
+
+# File contents are streamed in chunks of this size, whatever the size of the file
+FILE_CHUNK_BYTES = 1048576
+
+
+def file_chunks(download, transferred):
+    for chunk in download.iter_content(FILE_CHUNK_BYTES):
+        transferred["bytes"] += len(chunk)
+        yield chunk
+
+
+def transfer(
+    source_apikey,
+    source_urlPath,
+    target_apikey,
+    target_urlPath,
+    media_type=None,
+    ERROR_FILE="",
+    source_host_header="",
+    target_host_header="",
+):
+    # Stream a file from the source files API to the target. The download is uploaded chunk by chunk as it is received, with chunked transfer encoding, so the file is never held in memory. Retries download the file again.
+    source_headers = {"Authorization": f"Bearer {source_apikey}"}
+    if source_host_header != "":
+        source_headers["Host"] = source_host_header
+    target_headers = {"Authorization": f"Bearer {target_apikey}"}
+    target_headers["Content-Type"] = media_type or "application/octet-stream"
+    if target_host_header != "":
+        target_headers["Host"] = target_host_header
+    source_session = get_session(source_urlPath, source_host_header)
+    source_limiter = get_limiter(source_urlPath, source_host_header)
+    source_breaker = get_breaker(source_urlPath, source_host_header)
+    target_session = get_session(target_urlPath, target_host_header)
+    target_limiter = get_limiter(target_urlPath, target_host_header)
+    target_breaker = get_breaker(target_urlPath, target_host_header)
+    resp = None
+    last_status = None
+    errors = {}
+    attempt = 0
+    throttle_wait = 0
+    latency = 0
+    transferred = {"bytes": 0}
+    start = monotonic()
+    while True:
+        if not source_breaker.allow() or not target_breaker.allow():
+            errors["circuit_open"] = errors.get("circuit_open", 0) + 1
+            log_failure(ERROR_FILE, "PUT", target_urlPath, None, "circuit_open", "too many consecutive failures")
+            resp = None
+            last_status = "circuit_open"
+            break
+        # The limiter and breaker of the request in progress, the download then the upload
+        limiter, breaker, method, urlPath = source_limiter, source_breaker, "GET", source_urlPath
+        download = None
         try:
-            resp = requests.request("PATCH", urlPath, headers=headers, json=payload)
-            run = False
-            if resp.status_code > 299:
-                #Track error
-                if resp.status_code in errors:
-                    errors[resp.status_code]+=1
-                else:
-                    errors[resp.status_code]=1
-                #Retry upon throttling error
-                if resp.status_code == 429:
-                    sleep(0.05)
-                    run=True
-                else:
-                    if resp.status_code not in expect_codes:
-                        with open(ERROR_FILE, "a") as f:
-                            f.writelines([str(datetime.now().isoformat())+" PATCH request failed ",str(urlPath),"\n",str(payload),"\n",str(resp.status_code)," ",str(resp.text),"\n"])
-        except requests.exceptions.ConnectionError as e:
-            run=True
-    return resp,errors
\ No newline at end of file
+            throttle_wait += limiter.acquire()
+            download = source_session.get(
+                source_urlPath,
+                headers=source_headers,
+                stream=True,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            )
+            resp = download
+            if download.status_code <= 299:
+                source_breaker.success()
+                source_limiter.success()
+                limiter, breaker, method, urlPath = target_limiter, target_breaker, "PUT", target_urlPath
+                transferred["bytes"] = 0
+                throttle_wait += limiter.acquire()
+                sent = monotonic()
+                resp = target_session.put(
+                    target_urlPath,
+                    headers=target_headers,
+                    data=file_chunks(download, transferred),
+                    timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                )
+                latency = monotonic() - sent
+            last_status = resp.status_code
+            text = resp.text if resp.status_code > 299 else ""
+        except requests.exceptions.RequestException as e:
+            breaker.failure()
+            errors["connection"] = errors.get("connection", 0) + 1
+            resp = None
+            last_status = "connection"
+            if attempt < MAX_RETRIES:
+                sleep(backoff_seconds(attempt))
+                attempt += 1
+                continue
+            log_failure(ERROR_FILE, method, urlPath, None, "connection", repr(e))
+            break
+        finally:
+            if download is not None:
+                download.close()
+        if resp.status_code > 499:
+            breaker.failure()
+        else:
+            breaker.success()
+        if resp.status_code <= 299:
+            limiter.success()
+            break
+        errors[resp.status_code] = errors.get(resp.status_code, 0) + 1
+        # Retry upon throttling and gateway errors of either request
+        if resp.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+            wait = backoff_seconds(attempt)
+            if resp.status_code == 429:
+                retry_after = retry_after_seconds(resp)
+                limiter.throttle(retry_after)
+                wait = max(retry_after, wait)
+                throttle_wait += wait
+            sleep(wait)
+            attempt += 1
+            continue
+        log_failure(ERROR_FILE, method, urlPath, None, resp.status_code, text)
+        break
+    telemetry.record(
+        "PUT",
+        target_urlPath,
+        last_status,
+        latency,
+        monotonic() - start,
+        transferred["bytes"],
+        len(resp.content) if resp is not None and resp.request.method == "PUT" else 0,
+        attempt,
+        throttle_wait,
+    )
+    return resp, errors
+
+
+def get(apikey, urlPath, headers={}, expect_codes=[], ERROR_FILE="", host_header=""):
+    return request("GET", apikey, urlPath, None, expect_codes, ERROR_FILE, host_header)
+
+
+def post(apikey, urlPath, headers={}, payload="", expect_codes=[], ERROR_FILE="", host_header=""):
+    return request("POST", apikey, urlPath, payload, expect_codes, ERROR_FILE, host_header)
+
+
+def put(apikey, urlPath, headers={}, payload="", expect_codes=[], ERROR_FILE="", host_header=""):
+    return request("PUT", apikey, urlPath, payload, expect_codes, ERROR_FILE, host_header)
+
+
+def patch(apikey, urlPath, headers={}, payload="", expect_codes=[], ERROR_FILE="", host_header=""):
+    return request("PATCH", apikey, urlPath, payload, expect_codes, ERROR_FILE, host_header)
@@ -0,0 +1,269 @@
+import sys
+import json
+from threading import Lock, Thread
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import telemetry
+import deadletters
+
+# Progress of a run in machine-readable form, for runs without a terminal: periodic JSON lines, a Prometheus text endpoint and a summary written once the run is over.
+# The totals of each table come from the status reports read by the reporter. The batches waiting for a writer and the writers busy with each table are counted by the writer pools.
+
+writers = {}
+writers_lock = Lock()
+# Latest writer gauges of each worker process, added to the gauges of the main process
+workers = {}
+
+
+def queued(table, change):
+    with writers_lock:
+        gauges = writers.setdefault(table, {"queued": 0, "active": 0})
+        gauges["queued"] += change
+
+
+def active(table, change):
+    with writers_lock:
+        gauges = writers.setdefault(table, {"queued": 0, "active": 0})
+        gauges["active"] += change
+
+
+def update_worker(worker, worker_gauges):
+    with writers_lock:
+        workers[worker] = worker_gauges
+
+
+def writer_gauges():
+    with writers_lock:
+        report = {table: dict(writers[table]) for table in writers}
+        for worker in workers:
+            for table in workers[worker]:
+                gauges = report.setdefault(table, {"queued": 0, "active": 0})
+                gauges["queued"] += workers[worker][table]["queued"]
+                gauges["active"] += workers[worker][table]["active"]
+    return report
+
+
+def reset_after_fork():
+    global writers, writers_lock, workers
+    writers = {}
+    writers_lock = Lock()
+    workers = {}
+
+
+class RunMetrics:
+    # Totals of the status reports of each table, with the time the table was first reported and the time all of its passes were over
+    def __init__(self, tables):
+        self.lock = Lock()
+        self.start = datetime.now()
+        self.tables = {
+            table: {
+                "records": 0,
+                "links": 0,
+                "files": 0,
+                "failed": 0,
+                "total": None,
+                "errors": {},
+                "started": None,
+                "finished": None,
+            }
+            for table in tables
+        }
+        # Totals at the previous sample, rates are computed between two samples
+        self.sampled = self.start
+        self.previous = {table: {"records": 0, "links": 0, "files": 0} for table in tables}
+
+    def update(self, status_report):
+        now = datetime.now()
+        with self.lock:
+            for table in status_report:
+                totals = self.tables[table]
+                # Record counts arrive while the tables are copied, they do not start a table
+                if "summary" in status_report[table]:
+                    totals["total"] = status_report[table]["summary"]
+                    continue
+                if totals["started"] is None:
+                    totals["started"] = now
+                for key in ("records", "links", "files", "failed"):
+                    if status_report[table].get(key) is not None:
+                        totals[key] += status_report[table][key]
+                for error_code in status_report[table].get("errors", {}):
+                    totals["errors"][str(error_code)] = (
+                        totals["errors"].get(str(error_code), 0)
+                        + status_report[table]["errors"][error_code]
+                    )
+
+    def finish(self, table):
+        with self.lock:
+            if self.tables[table]["finished"] is None:
+                self.tables[table]["finished"] = datetime.now()
+
+    def sample(self):
+        # Totals, rates since the previous sample and writer gauges of each table
+        now = datetime.now()
+        gauges = writer_gauges()
+        with self.lock:
+            seconds = max((now - self.sampled).total_seconds(), 0.001)
+            line = {
+                "time": now.isoformat(),
+                "elapsed_seconds": round((now - self.start).total_seconds(), 3),
+                "tables": {},
+            }
+            for table in self.tables:
+                totals = self.tables[table]
+                line["tables"][table] = {
+                    "total": totals["total"],
+                    "records": totals["records"],
+                    "links": totals["links"],
+                    "files": totals["files"],
+                    "records_per_second": round((totals["records"] - self.previous[table]["records"]) / seconds, 1),
+                    "links_per_second": round((totals["links"] - self.previous[table]["links"]) / seconds, 1),
+                    "files_per_second": round((totals["files"] - self.previous[table]["files"]) / seconds, 1),
+                    "failed": totals["failed"],
+                    "queued_batches": gauges.get(table, {}).get("queued", 0),
+                    "active_writers": gauges.get(table, {}).get("active", 0),
+                    "errors": dict(totals["errors"]),
+                    "completed": totals["finished"] is not None,
+                }
+                self.previous[table] = {key: totals[key] for key in ("records", "links", "files")}
+            self.sampled = now
+        line["dead_letters"] = deadletters.count()
+        return line
+
+    def prometheus(self):
+        # Counters and gauges in the Prometheus text format, rates are left to the server
+        gauges = writer_gauges()
+        lines = []
+        with self.lock:
+            for key, help_text in (
+                ("records", "Records written per table."),
+                ("links", "Records with links backfilled per table."),
+                ("files", "Attachments copied per table."),
+                ("failed", "Records and links of dead-lettered batches per table."),
+            ):
+                lines.append("# HELP xreplay_" + key + "_total " + help_text)
+                lines.append("# TYPE xreplay_" + key + "_total counter")
+                for table in self.tables:
+                    lines.append('xreplay_%s_total{table="%s"} %d' % (key, table, self.tables[table][key]))
+            lines.append("# HELP xreplay_errors_total Failed requests per table and status.")
+            lines.append("# TYPE xreplay_errors_total counter")
+            for table in self.tables:
+                for error_code in self.tables[table]["errors"]:
+                    lines.append(
+                        'xreplay_errors_total{table="%s",status="%s"} %d'
+                        % (table, error_code, self.tables[table]["errors"][error_code])
+                    )
+            lines.append("# HELP xreplay_table_completed Whether all passes of the table are over.")
+            lines.append("# TYPE xreplay_table_completed gauge")
+            for table in self.tables:
+                lines.append(
+                    'xreplay_table_completed{table="%s"} %d'
+                    % (table, self.tables[table]["finished"] is not None)
+                )
+            elapsed = (datetime.now() - self.start).total_seconds()
+        for name, key, help_text in (
+            ("xreplay_queued_batches", "queued", "Write batches waiting for a writer per table."),
+            ("xreplay_active_writers", "active", "Writers busy with a batch per table."),
+        ):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " gauge")
+            for table in gauges:
+                lines.append('%s{table="%s"} %d' % (name, table, gauges[table][key]))
+        endpoint_stats = telemetry.snapshot()["endpoints"]
+        lines.append("# HELP xreplay_requests_total Requests sent per endpoint.")
+        lines.append("# TYPE xreplay_requests_total counter")
+        for endpoint in endpoint_stats:
+            lines.append('xreplay_requests_total{endpoint="%s"} %d' % (endpoint, endpoint_stats[endpoint]["requests"]))
+        lines.append("# HELP xreplay_dead_letters_total Batches written to the dead letter file.")
+        lines.append("# TYPE xreplay_dead_letters_total counter")
+        lines.append("xreplay_dead_letters_total %d" % deadletters.count())
+        lines.append("# HELP xreplay_elapsed_seconds Time since the copy started.")
+        lines.append("# TYPE xreplay_elapsed_seconds gauge")
+        lines.append("xreplay_elapsed_seconds %.3f" % elapsed)
+        return "\n".join(lines) + "\n"
+
+    def summary(self, completed):
+        # Duration and throughput of each table, from its first report until all of its passes were over
+        now = datetime.now()
+        with self.lock:
+            result = {
+                "started": self.start.isoformat(),
+                "finished": now.isoformat(),
+                "elapsed_seconds": round((now - self.start).total_seconds(), 3),
+                "completed": completed,
+                "tables": {},
+            }
+            for table in self.tables:
+                totals = self.tables[table]
+                duration = None
+                if totals["started"] is not None:
+                    duration = ((totals["finished"] or now) - totals["started"]).total_seconds()
+                result["tables"][table] = {
+                    "total": totals["total"],
+                    "records": totals["records"],
+                    "links": totals["links"],
+                    "files": totals["files"],
+                    "failed": totals["failed"],
+                    "errors": dict(totals["errors"]),
+                    "started": totals["started"].isoformat() if totals["started"] is not None else None,
+                    "finished": totals["finished"].isoformat() if totals["finished"] is not None else None,
+                    "duration_seconds": round(duration, 3) if duration is not None else None,
+                    "records_per_second": round(totals["records"] / duration, 1) if duration else None,
+                }
+            result["records"] = sum(totals["records"] for totals in self.tables.values())
+            result["links"] = sum(totals["links"] for totals in self.tables.values())
+            result["files"] = sum(totals["files"] for totals in self.tables.values())
+            result["failed"] = sum(totals["failed"] for totals in self.tables.values())
+        result["records_per_second"] = (
+            round(result["records"] / result["elapsed_seconds"], 1) if result["elapsed_seconds"] > 0 else None
+        )
+        result["dead_letters"] = deadletters.count()
+        result["requests"] = {
+            endpoint: stats["requests"] for endpoint, stats in telemetry.snapshot()["endpoints"].items()
+        }
+        return result
+
+
+def write_line(path, line):
+    # Append a JSON line to the metrics file, or write it to stdout when the path is -. Headless runs print everything else to stderr.
+    if path == "-":
+        sys.__stdout__.write(json.dumps(line) + "\n")
+        sys.__stdout__.flush()
+        return
+    with open(path, "a") as f:
+        f.write(json.dumps(line) + "\n")
+
+
+def emitter(run_metrics, path, interval, stop):
+    # Periodically write a sample until the stop event is set, then a last one with the final totals
+    while not stop.wait(interval):
+        write_line(path, run_metrics.sample())
+    write_line(path, run_metrics.sample())
+
+
+def serve(run_metrics, port):
+    # Serve the metrics on the local interface in a background thread, returns the server to shut down
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = run_metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are not logged to the terminal
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_summary(path, run_metrics, completed):
+    with open(path, "w") as f:
+        f.write(json.dumps(run_metrics.summary(completed), indent=2))
@@ -0,0 +1,352 @@
+import math
+from time import monotonic
+from queue import Queue, Empty
+from threading import Thread
+from urllib.parse import urlsplit
+from methods import get, post, response_json
+from threads import initial_query, flatten_record, encoded_size, count_records, map_concurrently
+from attachments import file_query, file_fields
+from strategy import strongly_connected_components
+
+# The plan of a replay is computed from the source only: the counts of each table, a sample page of each table for the record sizes and a short probe of the latency of reads and of round trips to the target.
+# Nothing is written to the target, the latency of writes is estimated from the target round trip and from the time the source takes per record of a page.
+
+# Categories of compute_table_link_depth
+LINK_DEPTH = {
+    "category1": "no links",
+    "category2": "links to tables without links",
+    "category3": "links to tables with links",
+}
+
+
+def run_all(tasks, concurrency):
+    # Run the tasks with as many threads as the concurrency, returns their results in order
+    results = [None] * len(tasks)
+    pending = Queue()
+    for position in range(len(tasks)):
+        pending.put(position)
+
+    def run():
+        while True:
+            try:
+                position = pending.get(block=False)
+            except Empty:
+                return
+            results[position] = tasks[position]()
+
+    runners = [Thread(target=run) for runner in range(max(1, min(concurrency, len(tasks))))]
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join()
+    return results
+
+
+def median(values):
+    values = sorted(value for value in values if value is not None)
+    if len(values) == 0:
+        return None
+    return values[len(values) // 2]
+
+
+def round_trip(side, ERROR_FILE):
+    # Time of a request the server answers without reading any record. A branch that does not exist yet answers 404 just as fast.
+    start = monotonic()
+    resp, errors = get(
+        apikey=side["key"],
+        urlPath=side["url"],
+        expect_codes=[404],
+        ERROR_FILE=ERROR_FILE,
+        host_header=side["host_header"],
+    )
+    if resp is None:
+        return None
+    return monotonic() - start
+
+
+def sample_page(side, table, query_payload, ERROR_FILE):
+    # First page of a query with the time it took and the size of the response
+    start = monotonic()
+    resp, errors = post(
+        apikey=side["key"],
+        urlPath=side["url"] + "/tables/" + table + "/query",
+        payload=query_payload,
+        ERROR_FILE=ERROR_FILE,
+        host_header=side["host_header"],
+    )
+    if resp is None or resp.status_code > 299:
+        return None
+    return {
+        "records": response_json(resp)["records"],
+        "latency": monotonic() - start,
+        "bytes": len(resp.content),
+    }
+
+
+def sample_table(side, table, PAGE_SIZE, columns, schema_links, schema_files, ERROR_FILE):
+    # Records of the sample page and their average size in a write request
+    page = sample_page(
+        side, table, initial_query(PAGE_SIZE, table, schema_links, columns=columns), ERROR_FILE
+    )
+    if page is None:
+        return None
+    sizes = [
+        encoded_size(flatten_record(record, table, schema_links, schema_files))
+        for record in page["records"]
+    ]
+    return {
+        "records": len(sizes),
+        "record_bytes": sum(sizes) / len(sizes) if len(sizes) > 0 else 0,
+        "latency": page["latency"],
+        "bytes": page["bytes"],
+    }
+
+
+def sample_files(side, table, PAGE_SIZE, schema_links, schema_files, ERROR_FILE):
+    # Average number of files of the records with attachments, and the average size of those files when the source lists it
+    page = sample_page(
+        side, table, file_query(PAGE_SIZE, table, schema_links, schema_files), ERROR_FILE
+    )
+    if page is None:
+        return None
+    files = 0
+    file_bytes = 0
+    for record in page["records"]:
+        record_files = file_fields(record, table, schema_files)[1]
+        files += len(record_files)
+        for column in schema_files[table]:
+            value = record.get(column)
+            for item in value if isinstance(value, list) else [value]:
+                if item is not None:
+                    file_bytes += item.get("size") or 0
+    return {
+        "files_per_record": files / len(page["records"]) if len(page["records"]) > 0 else 0,
+        "file_bytes": file_bytes / files if files > 0 else 0,
+    }
+
+
+def probe(
+    tables,
+    source,
+    target,
+    PAGE_SIZE,
+    table_columns,
+    schema_links,
+    schema_files,
+    file_tables,
+    ERROR_FILE,
+    concurrency,
+):
+    # Sample every table at the configured concurrency. Small schemas are sampled several times so that the probe keeps as many requests in flight as the copy would.
+    probed = [tables[position % len(tables)] for position in range(max(len(tables), concurrency))]
+    samples = run_all(
+        [
+            lambda table=table: sample_table(
+                source, table, PAGE_SIZE, table_columns[table], schema_links, schema_files, ERROR_FILE
+            )
+            for table in probed
+        ],
+        concurrency,
+    )
+    result = {"tables": {}, "files": {}}
+    for table, sample in zip(probed, samples):
+        if table not in result["tables"]:
+            result["tables"][table] = sample
+    # Full pages only, the last page of a small table is faster than a page of the configured size
+    full_pages = [
+        sample for sample in samples if sample is not None and sample["records"] == PAGE_SIZE
+    ]
+    if len(full_pages) == 0:
+        full_pages = [sample for sample in samples if sample is not None and sample["records"] > 0]
+    result["read_latency"] = median(sample["latency"] for sample in full_pages)
+    result["page_records"] = median(sample["records"] for sample in full_pages)
+    result["read_throughput"] = None
+    if len(full_pages) > 0:
+        result["read_throughput"] = sum(sample["bytes"] for sample in full_pages) / sum(
+            sample["latency"] for sample in full_pages
+        )
+    file_samples = run_all(
+        [
+            lambda table=table: sample_files(
+                source, table, PAGE_SIZE, schema_links, schema_files, ERROR_FILE
+            )
+            for table in file_tables
+        ],
+        concurrency,
+    )
+    result["files"] = dict(zip(file_tables, file_samples))
+    result["source_round_trip"] = median(
+        run_all([lambda: round_trip(source, ERROR_FILE)] * concurrency, concurrency)
+    )
+    result["target_round_trip"] = None
+    if target is not None:
+        result["target_round_trip"] = median(
+            run_all([lambda: round_trip(target, ERROR_FILE)] * concurrency, concurrency)
+        )
+    return result
+
+
+def count_tables(tables, source, ERROR_FILE, table_since, deferred_links, file_tables, schema_files):
+    # Records of each table, of those the records with links to backfill and the records with attachments. The counts of all tables are requested a few at a time, like the counts of a copy.
+    record_filters = {}
+    for table in tables:
+        record_filters[(table, "records")] = None
+        if len(deferred_links[table]) > 0:
+            record_filters[(table, "backfill")] = {
+                "$any": [{"$exists": column} for column in deferred_links[table]]
+            }
+        if table in file_tables:
+            record_filters[(table, "files")] = {
+                "$any": [{"$exists": column} for column in schema_files[table]]
+            }
+    counted = map_concurrently(
+        lambda count: count_records(
+            source["key"],
+            source["url"],
+            count[0],
+            ERROR_FILE,
+            source["host_header"],
+            table_since.get(count[0]),
+            record_filters[count],
+        ),
+        list(record_filters),
+    )
+    return {
+        table: {
+            "records": counted[(table, "records")],
+            "backfill": counted.get((table, "backfill"), 0),
+            "files": counted.get((table, "files"), 0),
+        }
+        for table in tables
+    }
+
+
+def same_host(source, target):
+    return target is not None and (
+        urlsplit(source["url"]).netloc == urlsplit(target["url"]).netloc
+        and source["host_header"] == target["host_header"]
+    )
+
+
+def estimate(
+    tables,
+    table_dependencies,
+    counts,
+    probed,
+    source,
+    target,
+    PAGE_SIZE,
+    BULK_SIZE,
+    BULK_BYTES,
+    PARTITIONS,
+    WRITERS,
+    FILE_CONCURRENCY,
+    MAX_REQUEST_RATE,
+    BACKFILL,
+):
+    # Requests and durations of each table and of the whole run. Unknown counts are left out of the totals.
+    read_latency = probed["read_latency"] or 0
+    source_round_trip = probed["source_round_trip"] or 0
+    # Time the source spends per record of a page, on top of the round trip. Writes are assumed to take the target as long per record.
+    record_latency = 0
+    if probed["page_records"]:
+        record_latency = max(read_latency - source_round_trip, 0) / probed["page_records"]
+    target_round_trip = probed["target_round_trip"] or 0
+    result = {"tables": {}, "record_latency": record_latency}
+    for table in tables:
+        records = counts[table]["records"] or 0
+        sample = probed["tables"].get(table) or {"record_bytes": 0}
+        bulks = 0
+        bulk_records = 0
+        if target is not None and records > 0:
+            bulks = math.ceil(records / BULK_SIZE)
+            if BULK_BYTES > 0:
+                bulks = max(bulks, math.ceil(records * sample["record_bytes"] / BULK_BYTES))
+            bulk_records = records / bulks
+        queries = math.ceil(records / PAGE_SIZE) if records > 0 else 1
+        partitions = PARTITIONS if records >= PARTITIONS * PAGE_SIZE else 1
+        backfill = counts[table]["backfill"] or 0
+        # Atomic link updates are sent one record at a time
+        backfill_batch = 1 if BACKFILL == "atomic_update" else min(backfill, BULK_SIZE)
+        backfill_reads = 0
+        backfill_writes = 0
+        if backfill > 0:
+            backfill_writes = math.ceil(backfill / backfill_batch)
+            # The bulk rewrite scrolls the records with links of the source again, the other backfills read them from the link store
+            if BACKFILL == "bulk_rewrite":
+                backfill_reads = math.ceil(backfill / PAGE_SIZE)
+        file_records = counts[table]["files"] or 0
+        file_sample = probed["files"].get(table) or {"files_per_record": 0, "file_bytes": 0}
+        files = math.ceil(file_records * file_sample["files_per_record"])
+        # The metadata of each page of records with attachments is set with one transaction
+        file_transactions = math.ceil(file_records / PAGE_SIZE)
+        file_latency = source_round_trip + target_round_trip
+        if probed["read_throughput"]:
+            # Downloaded then uploaded at the read throughput of the probe
+            file_latency += 2 * file_sample["file_bytes"] / probed["read_throughput"]
+        result["tables"][table] = {
+            "queries": queries,
+            "bulks": bulks,
+            "backfill_reads": backfill_reads,
+            "backfill_writes": backfill_writes,
+            "file_transactions": file_transactions,
+            "files": files,
+            "read_seconds": queries * read_latency / partitions,
+            "write_seconds": bulks * (target_round_trip + bulk_records * record_latency),
+            "backfill_seconds": backfill_reads * read_latency
+            + backfill_writes * (target_round_trip + backfill_batch * record_latency),
+            "file_seconds": files * file_latency
+            + file_transactions * (read_latency + target_round_trip + PAGE_SIZE * record_latency),
+        }
+    tables_estimate = result["tables"]
+    # A table is copied once the tables it links to are copied, its writes are shared with all writers
+    finished = {}
+    for component in strongly_connected_components(
+        {table: table_dependencies[table] for table in tables}
+    ):
+        for table in component:
+            started = max([finished[linked] for linked in table_dependencies[table] if linked in finished] or [0])
+            finished[table] = started + max(
+                tables_estimate[table]["read_seconds"],
+                tables_estimate[table]["write_seconds"] / WRITERS,
+            )
+    copy_seconds = max(
+        max(finished.values() or [0]),
+        sum(estimate["write_seconds"] for estimate in tables_estimate.values()) / WRITERS,
+    )
+    backfill_seconds = sum(estimate["backfill_seconds"] for estimate in tables_estimate.values()) / WRITERS
+    file_seconds = 0
+    if FILE_CONCURRENCY > 0:
+        file_seconds = sum(estimate["file_seconds"] for estimate in tables_estimate.values()) / FILE_CONCURRENCY
+    source_requests = sum(
+        estimate["queries"] + estimate["backfill_reads"] + estimate["files"]
+        for estimate in tables_estimate.values()
+    )
+    target_requests = sum(
+        estimate["bulks"] + estimate["backfill_writes"] + estimate["file_transactions"] + estimate["files"]
+        for estimate in tables_estimate.values()
+    )
+    # The run cannot be faster than the request rate allowed per host
+    if same_host(source, target):
+        rate_seconds = (source_requests + target_requests) / MAX_REQUEST_RATE
+    else:
+        rate_seconds = max(source_requests, target_requests) / MAX_REQUEST_RATE
+    result["source_requests"] = source_requests
+    result["target_requests"] = target_requests
+    result["copy_seconds"] = copy_seconds
+    result["backfill_seconds"] = backfill_seconds
+    result["file_seconds"] = file_seconds
+    result["rate_seconds"] = rate_seconds
+    result["total_seconds"] = max(copy_seconds + backfill_seconds + file_seconds, rate_seconds)
+    return result
+
+
+def table_order(tables, table_dependencies):
+    # Tables in the order they can be copied, the tables a table links to first
+    return [
+        table
+        for component in strongly_connected_components(
+            {table: table_dependencies[table] for table in tables}
+        )
+        for table in sorted(component)
+    ]
@@ -0,0 +1,146 @@
+import os
+from time import sleep
+from copy import deepcopy
+from queue import Empty
+from checkpoint import Checkpoint
+from methods import session_stats, limiter_stats, breaker_stats
+import methods
+from threads import table_rank
+import deadletters
+import telemetry
+import metrics
+
+# With --processes, the tables are split between worker processes forked from the main process, so that the responses, records and payloads of different tables are parsed and encoded on several cores instead of contending for the GIL of a single interpreter.
+# Each table is copied and backfilled by a single worker with its own writers. Workers send their reports, checkpoint state and request statistics to the main process over a multiprocessing queue, the main process runs the reporter and owns the state file.
+
+
+# Seconds the workers wait for the record counts before the tables are assigned to them, the counts of the largest tables can take much longer than starting the copy
+ASSIGNMENT_WAIT = 5
+
+
+def assign_tables(tables, table_counts, processes):
+    # Largest tables first, each to the worker with the fewest records so far. Tables whose count is not known yet are spread over the workers, each to the worker with the fewest of them.
+    assignment = [[] for worker in range(min(processes, len(tables)))]
+    assigned_records = [0] * len(assignment)
+    unknown_tables = [0] * len(assignment)
+    for table in sorted(tables, key=lambda table: table_rank(table, table_counts)):
+        if table_counts.get(table) is None:
+            load = list(zip(unknown_tables, assigned_records))
+            worker = load.index(min(load))
+            unknown_tables[worker] += 1
+        else:
+            worker = assigned_records.index(min(assigned_records))
+            assigned_records[worker] += max(table_counts[table], 1)
+        assignment[worker].append(table)
+    return assignment
+
+
+class ReportSender:
+    # End of the reporting queue in a worker process, reports are put on the reporting queue of the main process by collect()
+    def __init__(self, queue):
+        self.queue = queue
+
+    def put(self, status_report):
+        self.queue.put(("report", os.getpid(), status_report))
+
+
+class WorkerCheckpoint(Checkpoint):
+    # Progress of the tables of a worker process, saved by sending their state to the main process
+    def __init__(self, tables, queue, state):
+        Checkpoint.__init__(self, None, state)
+        self.tables = tables
+        self.queue = queue
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                # The queue pickles messages in a background thread, the state keeps changing in the meantime
+                tables = {
+                    table: deepcopy(self.state["tables"][table])
+                    for table in self.tables
+                    if table in self.state["tables"]
+                }
+            self.queue.put(("state", os.getpid(), tables))
+
+
+def reset_after_fork():
+    # A forked worker process opens its own connections, keeps its own request rates and circuits, and only counts its own requests, writers and dead letters.
+    # The module locks are replaced too, another thread of the main process may have been holding one of them when it forked.
+    methods.reset_after_fork()
+    deadletters.reset_after_fork()
+    telemetry.reset_after_fork()
+    metrics.reset_after_fork()
+
+
+def watch_parent(parent):
+    # A worker stops when the main process is killed, the progress of its tables could not be saved anymore
+    while os.getppid() == parent:
+        sleep(1)
+    os._exit(1)
+
+
+def telemetry_sender(queue, interval, stop):
+    # Periodically send the request statistics of a worker process until the stop event is set
+    while not stop.wait(interval):
+        queue.put(("telemetry", os.getpid(), telemetry.snapshot()["endpoints"]))
+
+
+def gauge_sender(queue, interval, stop):
+    # Periodically send the writer gauges of a worker process until the stop event is set
+    while not stop.wait(interval):
+        queue.put(("gauges", os.getpid(), metrics.writer_gauges()))
+
+
+def process_stats(synced_at):
+    # Final statistics of a worker process, sent once its tables are done
+    return {
+        "sessions": session_stats(),
+        "limiters": limiter_stats(),
+        "breakers": breaker_stats(),
+        "dead_letters": deadletters.count(),
+        "endpoints": telemetry.snapshot()["endpoints"],
+        "gauges": metrics.writer_gauges(),
+        "synced_at": synced_at,
+    }
+
+
+def collect(queue, workers, reporting_queue, checkpoint, synced_at, worker_stats):
+    # Apply the messages of the worker processes until all of them exited. A worker only exits once its messages have all been sent, the ones left are read without waiting.
+    while True:
+        alive = any(worker.is_alive() for worker in workers)
+        try:
+            kind, pid, message = queue.get(block=alive, timeout=0.1 if alive else None)
+        except Empty:
+            if not alive:
+                return
+            continue
+        if kind == "report":
+            reporting_queue.put(message)
+        elif kind == "state":
+            if checkpoint is not None:
+                checkpoint.merge(message)
+                checkpoint.save()
+        elif kind == "telemetry":
+            telemetry.update_worker(pid, message)
+        elif kind == "gauges":
+            metrics.update_worker(pid, message)
+        elif kind == "stats":
+            telemetry.update_worker(pid, message["endpoints"])
+            metrics.update_worker(pid, message["gauges"])
+            deadletters.add_count(message["dead_letters"])
+            synced_at.update(message["synced_at"])
+            worker_stats.append(message)
+
+
+def merge_stats(stats_lists, keys):
+    # Sum the statistics of the same base url and host header across processes
+    merged = {}
+    for stats in stats_lists:
+        for entry in stats:
+            base_url = (entry["base_url"], entry["host_header"])
+            if base_url not in merged:
+                merged[base_url] = dict(entry)
+            else:
+                for key in keys:
+                    merged[base_url][key] += entry[key]
+    return list(merged.values())
@@ -1,18 +1,17 @@
 def compute_table_link_depth(schema):
     categories= ["category1","category2","category3"]
     table_categories={category: [] for category in categories}
+    # count the links of each table once instead of scanning the schema for every link column
+    table_links={}
+    for table in schema["schema"]["tables"]:
+        table_links[table["name"]]=len([column for column in table["columns"] if column["type"]=="link"])
     for table in schema["schema"]["tables"]:
         local_table_links=0
         remote_table_links=0
         for column in table["columns"]:
             if column["type"]=="link":
                 local_table_links+=1
-                linked_table=column["link"]["table"]
-                for iter_table in schema["schema"]["tables"]:
-                    if iter_table["name"]==linked_table:
-                        for iter_column in iter_table["columns"]:
-                            if iter_column["type"]=="link":
-                                remote_table_links+=1
+                remote_table_links+=table_links.get(column["link"]["table"],0)
         if local_table_links==0:
             #Category 1: no links in the table, can be indexed
             table_categories["category1"].append(table["name"])
@@ -22,4 +21,92 @@ def compute_table_link_depth(schema):
         else:
             #Category 3: links in local table, links in remote table. Cannot detemine link depth.
             table_categories["category3"].append(table["name"])
-    return table_categories
\ No newline at end of file
+    return table_categories
+
+
+def compute_link_graph(schema):
+    # Tables linked to by each table
+    link_graph={}
+    for table in schema["schema"]["tables"]:
+        link_graph[table["name"]]=[]
+        for column in table["columns"]:
+            if column["type"]=="link" and column["link"]["table"] not in link_graph[table["name"]]:
+                link_graph[table["name"]].append(column["link"]["table"])
+    return link_graph
+
+
+def strongly_connected_components(link_graph):
+    # Tarjan's algorithm without recursion, so that long link chains do not hit the recursion limit. Components are returned in reverse topological order: the tables a component links to come before it.
+    index={}
+    lowlink={}
+    stack=[]
+    on_stack=set()
+    components=[]
+    counter=0
+    for root in link_graph:
+        if root in index:
+            continue
+        work=[(root,0)]
+        while len(work)>0:
+            table,position=work.pop()
+            if position==0:
+                index[table]=counter
+                lowlink[table]=counter
+                counter+=1
+                stack.append(table)
+                on_stack.add(table)
+            recurse=False
+            targets=link_graph.get(table,[])
+            while position<len(targets):
+                target=targets[position]
+                position+=1
+                if target not in link_graph:
+                    # link to a table that is not part of the schema
+                    continue
+                if target not in index:
+                    work.append((table,position))
+                    work.append((target,0))
+                    recurse=True
+                    break
+                elif target in on_stack:
+                    lowlink[table]=min(lowlink[table],index[target])
+            if recurse:
+                continue
+            if lowlink[table]==index[table]:
+                component=[]
+                while True:
+                    member=stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member==table:
+                        break
+                components.append(component)
+            if len(work)>0:
+                parent=work[-1][0]
+                lowlink[parent]=min(lowlink[parent],lowlink[table])
+    return components
+
+
+def compute_table_dependencies(schema):
+    # Returns the tables each table has to wait for before it is copied, and the link columns that are deferred to a backfill pass.
+    # Links between tables of the same strongly connected component (link cycles, including a table linking to itself) cannot be created in one pass, they are the only deferred links.
+    # All other links point to tables that can be copied entirely before the table itself.
+    link_graph=compute_link_graph(schema)
+    component_of={}
+    for component in strongly_connected_components(link_graph):
+        for table in component:
+            component_of[table]=tuple(component)
+    table_dependencies={}
+    deferred_links={}
+    for table in schema["schema"]["tables"]:
+        table_dependencies[table["name"]]=[]
+        deferred_links[table["name"]]={}
+        for column in table["columns"]:
+            if column["type"]!="link" or column["link"]["table"] not in component_of:
+                continue
+            linked_table=column["link"]["table"]
+            if component_of[linked_table]==component_of[table["name"]]:
+                deferred_links[table["name"]][column["name"]]=column
+            elif linked_table not in table_dependencies[table["name"]]:
+                table_dependencies[table["name"]].append(linked_table)
+    return table_dependencies, deferred_links
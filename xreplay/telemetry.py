@@ -0,0 +1,198 @@
+from threading import Lock
+from datetime import datetime
+from urllib.parse import urlsplit
+import json
+
+# Upper bounds of the histogram buckets, values above the last bound fall in an overflow bucket
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+SIZE_BUCKETS_BYTES = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+ENDPOINT_CLASSES = ["query", "bulk", "transaction", "summarize", "aggregate"]
+# File contents are read and written under the column path of their record
+FILE_PATH = "/column/"
+
+endpoints = {}
+endpoints_lock = Lock()
+# Latest endpoint statistics of each worker process, merged into the snapshots of the main process
+workers = {}
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        position = 0
+        while position < len(self.bounds) and value > self.bounds[position]:
+            position += 1
+        self.counts[position] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @classmethod
+    def from_dict(cls, bounds, histogram):
+        restored = cls(bounds)
+        restored.counts = [histogram["buckets"][str(bound)] for bound in bounds]
+        restored.counts.append(histogram["buckets"]["+inf"])
+        restored.count = histogram["count"]
+        restored.sum = histogram["sum"]
+        restored.max = histogram["max"]
+        return restored
+
+    def merge(self, other):
+        for position in range(len(self.counts)):
+            self.counts[position] += other.counts[position]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        # Estimated as the upper bound of the bucket holding the percentile, capped to the largest value seen
+        if self.count == 0:
+            return 0
+        rank = self.count * percent / 100
+        cumulative = 0
+        for position in range(len(self.counts)):
+            cumulative += self.counts[position]
+            if cumulative >= rank:
+                if position < len(self.bounds):
+                    return min(self.bounds[position], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        buckets = {}
+        for position, bound in enumerate(self.bounds):
+            buckets[str(bound)] = self.counts[position]
+        buckets["+inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "mean": round(self.sum / self.count, 3) if self.count > 0 else 0,
+            "p50": round(self.percentile(50), 3),
+            "p90": round(self.percentile(90), 3),
+            "p99": round(self.percentile(99), 3),
+            "max": round(self.max, 3),
+            "buckets": buckets,
+        }
+
+
+def endpoint_class(method, urlPath):
+    if method == "PATCH":
+        return "patch"
+    path = urlsplit(urlPath).path
+    if FILE_PATH in path:
+        return "file"
+    for endpoint in ENDPOINT_CLASSES:
+        if path.endswith("/" + endpoint):
+            return endpoint
+    return "other"
+
+
+def record(
+    method,
+    urlPath,
+    status,
+    latency,
+    elapsed,
+    request_bytes,
+    response_bytes,
+    retries,
+    throttle_wait,
+):
+    endpoint = endpoint_class(method, urlPath)
+    with endpoints_lock:
+        if endpoint not in endpoints:
+            endpoints[endpoint] = {
+                "requests": 0,
+                "statuses": {},
+                "retries": 0,
+                "throttle_wait_ms": 0,
+                "retry_time_ms": 0,
+                "latency_ms": Histogram(LATENCY_BUCKETS_MS),
+                "elapsed_ms": Histogram(LATENCY_BUCKETS_MS),
+                "request_bytes": Histogram(SIZE_BUCKETS_BYTES),
+                "response_bytes": Histogram(SIZE_BUCKETS_BYTES),
+            }
+        stats = endpoints[endpoint]
+        stats["requests"] += 1
+        stats["statuses"][str(status)] = stats["statuses"].get(str(status), 0) + 1
+        stats["retries"] += retries
+        stats["throttle_wait_ms"] += throttle_wait * 1000
+        # Time spent in failed attempts and backoff on top of the last round trip
+        stats["retry_time_ms"] += max(0, elapsed - latency - throttle_wait) * 1000
+        stats["latency_ms"].add(latency * 1000)
+        stats["elapsed_ms"].add(elapsed * 1000)
+        stats["request_bytes"].add(request_bytes)
+        stats["response_bytes"].add(response_bytes)
+
+
+def merge_endpoint(stats, other):
+    # Add the statistics of an endpoint reported by another process
+    stats["requests"] += other["requests"]
+    for status in other["statuses"]:
+        stats["statuses"][status] = stats["statuses"].get(status, 0) + other["statuses"][status]
+    for key in ("retries", "throttle_wait_ms", "retry_time_ms"):
+        stats[key] = round(stats[key] + other[key], 3)
+    for key, bounds in (
+        ("latency_ms", LATENCY_BUCKETS_MS),
+        ("elapsed_ms", LATENCY_BUCKETS_MS),
+        ("request_bytes", SIZE_BUCKETS_BYTES),
+        ("response_bytes", SIZE_BUCKETS_BYTES),
+    ):
+        histogram = Histogram.from_dict(bounds, stats[key])
+        histogram.merge(Histogram.from_dict(bounds, other[key]))
+        stats[key] = histogram.to_dict()
+
+
+def update_worker(worker, endpoint_report):
+    with endpoints_lock:
+        workers[worker] = endpoint_report
+
+
+def snapshot():
+    with endpoints_lock:
+        report = {}
+        for endpoint in endpoints:
+            stats = endpoints[endpoint]
+            report[endpoint] = {
+                "requests": stats["requests"],
+                "statuses": dict(stats["statuses"]),
+                "retries": stats["retries"],
+                "throttle_wait_ms": round(stats["throttle_wait_ms"], 3),
+                "retry_time_ms": round(stats["retry_time_ms"], 3),
+                "latency_ms": stats["latency_ms"].to_dict(),
+                "elapsed_ms": stats["elapsed_ms"].to_dict(),
+                "request_bytes": stats["request_bytes"].to_dict(),
+                "response_bytes": stats["response_bytes"].to_dict(),
+            }
+        for worker in workers:
+            for endpoint in workers[worker]:
+                if endpoint not in report:
+                    report[endpoint] = json.loads(json.dumps(workers[worker][endpoint]))
+                else:
+                    merge_endpoint(report[endpoint], workers[worker][endpoint])
+    return {"time": datetime.now().isoformat(), "endpoints": report}
+
+
+def reset_after_fork():
+    global endpoints, endpoints_lock, workers
+    endpoints = {}
+    endpoints_lock = Lock()
+    workers = {}
+
+
+def dump(path):
+    with open(path, "w") as f:
+        f.write(json.dumps(snapshot(), indent=2))
+
+
+def dumper(path, interval, stop):
+    # Periodically overwrite the telemetry file until the stop event is set, then write the final state
+    while not stop.wait(interval):
+        dump(path)
+    dump(path)
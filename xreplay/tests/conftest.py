@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of xreplay import each other as top level modules, like when xreplay.py is run from its directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
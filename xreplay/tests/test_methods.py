@@ -0,0 +1,42 @@
+import requests
+import methods
+import telemetry
+
+
+class Session:
+    # Answers each request with the next outcome, a status code or an exception to raise
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+
+    def request(self, method, urlPath, headers=None, data=None, timeout=None):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response._content = b"{}"
+        return response
+
+
+def test_telemetry_records_the_status_of_the_last_attempt(tmp_path, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(
+        methods,
+        "get_session",
+        lambda urlPath, host_header="": Session(
+            [requests.exceptions.ConnectionError(), 503, requests.exceptions.ConnectionError()]
+        ),
+    )
+    monkeypatch.setattr(methods, "sleep", lambda seconds: None)
+    monkeypatch.setattr(methods, "MAX_RETRIES", 2)
+    monkeypatch.setattr(telemetry, "record", lambda *args: recorded.append(args))
+    resp, errors = methods.request(
+        "POST",
+        "key",
+        "http://127.0.0.1:9/db/tables/a/query",
+        {},
+        ERROR_FILE=str(tmp_path / "errors.log"),
+    )
+    assert resp is None
+    assert errors == {"connection": 2, 503: 1}
+    assert recorded[0][2] == "connection"
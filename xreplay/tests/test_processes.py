@@ -0,0 +1,15 @@
+from processes import assign_tables
+
+
+def test_tables_are_balanced_on_their_counts():
+    assert assign_tables(["a", "b", "c", "d"], {"a": 10, "b": 60, "c": 30, "d": 25}, 2) == [
+        ["b"],
+        ["c", "d", "a"],
+    ]
+
+
+def test_tables_still_being_counted_are_spread_over_the_workers():
+    assert assign_tables(["a", "b", "c", "d", "e"], {"a": 100}, 2) == [
+        ["a", "c", "e"],
+        ["b", "d"],
+    ]
@@ -0,0 +1,146 @@
+import json
+from queue import Queue
+import threads
+import deadletters
+
+
+class Response:
+    def __init__(self, status_code, text="{}"):
+        self.status_code = status_code
+        self.text = text
+
+
+class Target:
+    # Branch of a target with the write semantics of Xata: bulk writes insert records and fail on ids that exist, transaction updates with upsert replace or insert them
+    def __init__(self, records):
+        self.records = {record["id"]: dict(record) for record in records}
+        self.requests = []
+
+    def request(self, method, apikey, urlPath, payload=None, expect_codes=[], ERROR_FILE="", host_header=""):
+        self.requests.append((method, urlPath))
+        if urlPath.endswith("/bulk"):
+            for record in payload["records"]:
+                if record["id"] in self.records:
+                    return Response(400, '{"message":"record ' + record["id"] + ' already exists"}'), {400: 1}
+            for record in payload["records"]:
+                self.records[record["id"]] = dict(record)
+            return Response(200), {}
+        if urlPath.endswith("/transaction"):
+            for operation in payload["operations"]:
+                update = operation["update"]
+                if update["id"] not in self.records and not update.get("upsert"):
+                    return Response(400), {400: 1}
+                self.records.setdefault(update["id"], {"id": update["id"]}).update(update["fields"])
+            return Response(200), {}
+        return Response(404), {404: 1}
+
+
+def table_writer(tmp_path, upsert):
+    return threads.TableWriter(
+        None,
+        {},
+        1000,
+        Queue(),
+        100,
+        "key",
+        "http://target/db/database:main",
+        "teams",
+        None,
+        {"teams": {}},
+        "xata",
+        None,
+        None,
+        str(tmp_path / "errors.log"),
+        DEAD_LETTER_FILE=str(tmp_path / "dead-letters.ndjson"),
+        upsert=upsert,
+    )
+
+
+def reports(table_writer):
+    return list(table_writer.reporting_queue.queue)
+
+
+def test_incremental_sync_updates_changed_records_that_exist_in_the_target(tmp_path, monkeypatch):
+    mark = "2024-01-01T00:00:00Z"
+    # Changed after the mark of the previous sync, the record is scrolled again
+    query = threads.initial_query(100, "teams", {"teams": []}, since=mark)
+    assert query["filter"] == {threads.UPDATED_COLUMN: {"$ge": mark}}
+    changed = {"id": "rec_1", "name": "renamed", "xata": {"updatedAt": "2024-02-01T00:00:00Z"}}
+    added = {"id": "rec_2", "name": "new", "xata": {"updatedAt": "2024-02-01T00:00:00Z"}}
+    records = [threads.flatten_record(dict(record), "teams", {"teams": []}, {"teams": []}) for record in (changed, added)]
+    target = Target([{"id": "rec_1", "name": "original"}])
+    monkeypatch.setattr(threads, "request", target.request)
+    dead_letters = deadletters.count()
+    writer = table_writer(tmp_path, upsert=True)
+    writer.flush(records)
+    assert target.records == {
+        "rec_1": {"id": "rec_1", "name": "renamed"},
+        "rec_2": {"id": "rec_2", "name": "new"},
+    }
+    assert target.requests == [("POST", "http://target/db/database:main/transaction")]
+    assert deadletters.count() == dead_letters
+    assert reports(writer) == [{"teams": {"records": 2}}]
+
+
+def test_bulk_writes_insert_records_of_a_new_target(tmp_path, monkeypatch):
+    target = Target([])
+    monkeypatch.setattr(threads, "request", target.request)
+    writer = table_writer(tmp_path, upsert=False)
+    writer.flush([{"id": "rec_1", "name": "first"}, {"id": "rec_2", "name": "second"}])
+    assert target.requests == [("POST", "http://target/db/database:main/tables/teams/bulk")]
+    assert set(target.records) == {"rec_1", "rec_2"}
+
+
+def test_split_codes_only_split_oversized_batches_past_the_maximum_depth():
+    records = [{"id": "rec_1"}, {"id": "rec_2"}]
+    assert threads.split_codes(records) == [400, 413, 422]
+    assert threads.split_codes(records, threads.MAX_SPLIT_DEPTH - 1) == [400, 413, 422]
+    assert threads.split_codes(records, threads.MAX_SPLIT_DEPTH) == [413]
+    # A single record cannot be split, its rejection is a failure
+    assert threads.split_codes(records[:1]) == []
+    assert threads.split_codes(records[:1], threads.MAX_SPLIT_DEPTH) == []
+
+
+def test_repeated_rejection_needs_the_same_invalid_status_and_message():
+    assert threads.repeated_rejection([(400, "missing column"), (400, "missing column")])
+    assert threads.repeated_rejection([(422, "invalid"), (422, "invalid")])
+    assert not threads.repeated_rejection([(400, "invalid rec_1"), (400, "invalid rec_2")])
+    assert not threads.repeated_rejection([(400, "invalid"), (200, "{}")])
+    assert not threads.repeated_rejection([(400, "invalid"), (422, "invalid")])
+    # Oversized halves still get smaller when they are split
+    assert not threads.repeated_rejection([(413, "too large"), (413, "too large")])
+    assert not threads.repeated_rejection([(None, ""), (None, "")])
+
+
+def test_batch_rejected_as_a_whole_is_dead_lettered_with_the_errors_of_its_halves(tmp_path, monkeypatch):
+    requests = []
+
+    def reject(method, apikey, urlPath, payload=None, expect_codes=[], ERROR_FILE="", host_header=""):
+        requests.append(len(payload["records"]))
+        return Response(400, '{"message":"column missing"}'), {400: 1}
+
+    monkeypatch.setattr(threads, "request", reject)
+    writer = table_writer(tmp_path, upsert=False)
+    writer.flush([{"id": "rec_" + str(position)} for position in range(100)])
+    # The batch and its two halves, instead of splitting down to single records
+    assert requests == [100, 50, 50]
+    assert reports(writer) == [
+        {"teams": {"errors": {400: 3}}},
+        {"teams": {"failed": 100}},
+    ]
+    with open(tmp_path / "dead-letters.ndjson") as f:
+        dead_letters = [json.loads(line) for line in f]
+    assert len(dead_letters) == 1
+    assert len(dead_letters[0]["payload"]["records"]) == 100
+    assert dead_letters[0]["errors"] == {"400": 3}
+
+
+def test_drained_reports_total_the_files_of_the_follow_rounds():
+    queue = Queue()
+    queue.put({"b": {"records": 2}})
+    queue.put({"b": {"files": 3}})
+    queue.put({"b": {"files": 1, "errors": {"404": 1}}})
+    queue.put({"b": {"files": None}})
+    assert threads.drain_reports(queue) == {
+        "b": {"records": 2, "links": 0, "files": 4, "failed": 0, "errors": {"404": 1}}
+    }
@@ -1,524 +1,1135 @@
-from time import sleep
-from queue import Empty
-from methods import get, post, patch
-from datetime import datetime
+from queue import Queue, PriorityQueue, Empty
+from methods import get, post, patch, request, response_json, limiter_stats, dumps, log_failure
+import deadletters
+import metrics
+from datetime import datetime, timezone
 from operator import itemgetter
+from threading import Thread, Lock, Semaphore, Event
+from itertools import count
+from copy import deepcopy
 
 
-def producer(
-    queue,
+def initial_query(
     PAGE_SIZE,
-    from_XATA_API_KEY,
-    from_BRANCH_URL,
     table,
     schema_links,
-    schema_files,
-    ERROR_FILE,
-    host_header="",
     mode="full",
     fetch_records="all",
+    partition_filter=None,
+    columns=None,
+    since=None,
 ):
     query_payload = {}
     query_payload["page"] = {}
     query_payload["page"]["size"] = PAGE_SIZE
 
+    # only request the columns that are written to the target, links as their id
+    if mode == "full" and columns is not None and len(columns) > 0:
+        query_payload["columns"] = list(columns)
+
     if mode == "only_links":
         query_payload["filter"] = {}
         query_payload["filter"]["$any"] = []
         query_payload["columns"] = []
         for column in schema_links[table]:
-            if "filter" in query_payload and "columns" in query_payload:
-                query_payload["filter"]["$any"].append({"$exists": column})
-                # only fetch the column.id for the linked record to reduce payload size down to necessary
-                query_payload["columns"].append(column + ".id")
+            query_payload["filter"]["$any"].append({"$exists": column})
+            # only fetch the column.id for the linked record to reduce payload size down to necessary
+            query_payload["columns"].append(column + ".id")
 
     if fetch_records == "with_links":
         query_payload["filter"] = {}
         query_payload["filter"]["$any"] = []
-        query_payload["columns"] = []
+        if "columns" not in query_payload:
+            query_payload["columns"] = []
+        # retrieve only records that have link column data
+        for column in schema_links[table]:
+            query_payload["filter"]["$any"].append({"$exists": column})
 
-    more = True
-    while more == True:
-        if mode == "full" and fetch_records == "all":
-            raw_query_response, errors = post(
-                apikey=from_XATA_API_KEY,
-                urlPath=from_BRANCH_URL + "/tables/" + table + "/query",
-                payload=query_payload,
-                ERROR_FILE=ERROR_FILE,
-                host_header=host_header,
+    # restrict the scroll to a range of the table when it is partitioned
+    if partition_filter is not None:
+        if "filter" not in query_payload:
+            query_payload["filter"] = {}
+        query_payload["filter"].update(partition_filter)
+
+    # only scroll the records updated since the previous sync
+    if since is not None:
+        if "filter" not in query_payload:
+            query_payload["filter"] = {}
+        query_payload["filter"][UPDATED_COLUMN] = {"$ge": since}
+    return query_payload
+
+
+def next_page_query(query_payload, query_response, mode="full", fetch_records="all"):
+    if query_response["meta"]["page"]["more"] != True:
+        return None
+    if mode == "full" and fetch_records == "with_links":
+        query_payload = {}
+        query_payload["page"] = {}
+    query_payload["page"]["after"] = query_response["meta"]["page"]["cursor"]
+    # filter is only applied for the initial query, pagination does not need the filter
+    if mode == "only_links" and "filter" in query_payload:
+        query_payload.pop("filter")
+    return query_payload
+
+
+def query_columns(table, schema_columns, schema_links, schema_files):
+    # file and file[] columns are not copied, link columns only need the id of the linked record
+    columns = []
+    for column in schema_columns[table]:
+        if column in schema_files[table]:
+            continue
+        if column in schema_links[table]:
+            columns.append(column + ".id")
+        elif schema_columns[table][column]["type"] == "object":
+            columns.append(column + ".*")
+        else:
+            columns.append(column)
+    return columns
+
+
+def flatten_record(record, table, schema_links, schema_files):
+    record.pop("xata", None)
+    # flatten link id keys to make them compatible with the write api
+    for column in schema_links[table]:
+        if column in record:
+            record[column] = (record.pop(column))["id"]
+    # remove file and file[] columns as unsupported
+    for column in schema_files[table]:
+        if column in record:
+            record.pop(column)
+    return record
+
+
+def strip_deferred_links(record, table, deferred_links):
+    for column in deferred_links[table]:
+        # ignore the link if it has a value and is part of a link cycle, it is backfilled later
+        if column in record.keys():
+            record.pop(column)
+    return record
+
+
+def batch_size(BULK_SIZE, mode="full"):
+    # Atomic link updates are sent one record at a time
+    if mode == "only_links":
+        return 1
+    return BULK_SIZE
+
+
+def queue_slots(MAX_QUEUE_SIZE, item_size):
+    # Queues carry whole pages or batches, the queue size is given in records
+    return max(1, MAX_QUEUE_SIZE // item_size)
+
+
+def encoded_size(record):
+    # Estimated size of the record in the request body, before compression
+    return len(dumps(record)) + 1
+
+
+def split_batches(records, sizes, size, max_bytes=0):
+    # Full batches of size records, closed earlier when the next record would take the batch over max_bytes. The remainder waits for the next page.
+    batches = []
+    start = 0
+    batch_bytes = 0
+    for position in range(len(records)):
+        if position > start and max_bytes > 0 and batch_bytes + sizes[position] > max_bytes:
+            batches.append(records[start:position])
+            start = position
+            batch_bytes = 0
+        batch_bytes += sizes[position]
+        if position + 1 - start == size:
+            batches.append(records[start : position + 1])
+            start = position + 1
+            batch_bytes = 0
+    return batches, records[start:], sizes[start:]
+
+
+# Write batches rejected as invalid or too large are bisected, so that the valid records are written in large sub-batches and only the records that fail on their own are logged and dead-lettered.
+SPLIT_STATUS_CODES = [400, 413, 422]
+# Invalid batches are split at most this many times, oversized batches are split until they fit
+MAX_SPLIT_DEPTH = 5
+
+
+def split_codes(records, depth=0):
+    # Failures of multi-record batches are expected, they are resolved by splitting them
+    if len(records) <= 1:
+        return []
+    if depth >= MAX_SPLIT_DEPTH:
+        return [413]
+    return SPLIT_STATUS_CODES
+
+
+def repeated_rejection(rejections):
+    # Both halves of an invalid batch rejected with the same status and message: the batch is rejected as a whole, not because of some of its records
+    return (
+        len(set(rejections)) == 1
+        and rejections[0][0] in SPLIT_STATUS_CODES
+        and rejections[0][0] != 413
+    )
+
+
+def upsert_transaction(table, records):
+    # Transaction updating the records by id, and inserting those that do not exist yet
+    transaction_payload = {}
+    transaction_payload["operations"] = []
+    for record_to_update in records:
+        # the records are copied so that a batch can be sent again after a split
+        fields = dict(record_to_update)
+        transaction_item = {}
+        transaction_item["update"] = {}
+        transaction_item["update"]["table"] = table
+        transaction_item["update"]["id"] = fields.pop("id")
+        transaction_item["update"]["fields"] = fields
+        transaction_item["update"]["upsert"] = True
+        transaction_payload["operations"].append(transaction_item)
+    return transaction_payload
+
+
+def batch_request(table, records, mode="full", records_type="all", upsert=False):
+    # Returns the method, path under the branch url and payload of the write request for a batch of records, and whether they are reported as records or links.
+    # Bulk writes only insert records. Records that may already be in the target, in incremental syncs and in the pages a resumed run sends again, are upserted with a transaction instead.
+    if mode == "bulk_links_transaction":
+        return "POST", "/transaction", upsert_transaction(table, records), "links"
+    elif mode == "only_links":
+        record = dict(records[0])
+        record_id = record.pop("id")
+        return "PATCH", "/tables/" + table + "/data/" + record_id, record, "links"
+    elif upsert:
+        return "POST", "/transaction", upsert_transaction(table, records), report_key(mode, records_type)
+    elif mode == "full" and records_type == "with_links":
+        return "POST", "/tables/" + table + "/bulk", {"records": records}, "links"
+    else:
+        return "POST", "/tables/" + table + "/bulk", {"records": records}, "records"
+
+
+def backfill_modes(BACKFILL):
+    # Consumer mode, records type, producer mode and records to fetch of the pass that backfills the links of cycles
+    if BACKFILL == "atomic_update":
+        # update links with an atomic request per record
+        return "only_links", "all", "only_links", "all"
+    elif BACKFILL == "bulk_rewrite":
+        # rewrite the entire records in bulks including links
+        return "full", "with_links", "full", "with_links"
+    # update links with bulk updates using transactions
+    return "bulk_links_transaction", "all", "only_links", "all"
+
+
+def report_key(mode="full", records_type="all"):
+    # Full records with or without link content are reported as record counts, link backfilling passes are reported as link counts.
+    if (mode == "full" and records_type == "all") or mode == "no_links":
+        return "records"
+    return "links"
+
+
+def resumed_reports(checkpoint, table, phase, key):
+    # Reports of the records a previous run already wrote for a table pass, followed by the close report when the pass is done
+    if checkpoint is None:
+        return []
+    reports = []
+    if checkpoint.records(table, phase) > 0:
+        reports.append({table: {key: checkpoint.records(table, phase)}})
+    if checkpoint.done(table, phase):
+        reports.append({table: {key: None}})
+    return reports
+
+
+def write_file(records, table, schema, output_format, output_path):
+    if output_format == "json":
+        with open(output_path + table + ".log", "a") as f:
+            for record in records:
+                f.write(str(record) + "\n")
+    elif output_format == "csv":
+        with open(output_path + table + ".csv", "a") as f:
+            for record in records:
+                csv_record = ""
+                csv_record_position = 1
+                for current_table in schema["schema"]["tables"]:
+                    if current_table["name"] == table:
+                        csv_record_max_position = len(current_table["columns"])
+                        if "id" in record:
+                            csv_record += str(record["id"]) + ","
+                        for schema_column in sorted(
+                            current_table["columns"], key=itemgetter("name")
+                        ):
+                            if schema_column["name"] in record:
+                                if (
+                                    schema_column["type"]
+                                    in ("multiple", "string", "text", "object")
+                                    and len(record[schema_column["name"]]) > 0
+                                ):
+                                    csv_record += (
+                                        '"'
+                                        + str(record[schema_column["name"]]).replace(
+                                            '"', '""'
+                                        )
+                                        + '"'
+                                    )
+                                else:
+                                    csv_record += str(record[schema_column["name"]])
+                            if csv_record_position < csv_record_max_position:
+                                csv_record += ","
+                            csv_record_position += 1
+                f.write(str(csv_record) + "\n")
+
+
+# Incremental syncs only copy the records updated since the highest update time seen by the previous sync of the table
+UPDATED_COLUMN = "xata.updatedAt"
+
+
+# Large tables can be split in ranges of creation time, each scrolled concurrently with an independent cursor into the same table queue.
+PARTITION_COLUMN = "xata.createdAt"
+
+
+def partition_probe():
+    summaries = {}
+    summaries["total"] = {"count": "*"}
+    summaries["first"] = {"min": PARTITION_COLUMN}
+    summaries["last"] = {"max": PARTITION_COLUMN}
+    return {"summaries": summaries}
+
+
+def parse_timestamp(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def format_timestamp(value):
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def partition_filters(summary, partitions, PAGE_SIZE):
+    # Split the creation time range of the table in equal intervals. Tables too small to fill a few pages per partition are scrolled with a single cursor.
+    if (
+        partitions < 2
+        or summary.get("total") is None
+        or summary["total"] < partitions * PAGE_SIZE
+        or summary.get("first") is None
+        or summary.get("last") is None
+    ):
+        return [None]
+    first = parse_timestamp(summary["first"])
+    last = parse_timestamp(summary["last"])
+    step = (last - first) / partitions
+    if step.total_seconds() <= 0:
+        return [None]
+    filters = []
+    lower = None
+    for partition in range(1, partitions + 1):
+        upper = first + step * partition if partition < partitions else None
+        time_range = {}
+        # The first and last ranges are open, records created during the copy belong to the last one
+        if lower is not None:
+            time_range["$ge"] = format_timestamp(lower)
+        if upper is not None:
+            time_range["$lt"] = format_timestamp(upper)
+        filters.append({PARTITION_COLUMN: time_range})
+        lower = upper
+    return filters
+
+
+def query_pages(
+    query_payload,
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
+    table,
+    ERROR_FILE,
+    host_header="",
+    mode="full",
+    fetch_records="all",
+):
+    # Yields the records of each page of the scroll starting at the given query, along with the query of the next page, None after the last page
+    query_payload = deepcopy(query_payload)
+    while query_payload is not None:
+        raw_query_response, errors = post(
+            apikey=from_XATA_API_KEY,
+            urlPath=from_BRANCH_URL + "/tables/" + table + "/query",
+            payload=query_payload,
+            ERROR_FILE=ERROR_FILE,
+            host_header=host_header,
+        )
+        if raw_query_response is None or raw_query_response.status_code > 299:
+            # The scroll cannot continue without the cursor of the failed page
+            with open(ERROR_FILE, "a") as f:
+                f.writelines([str(datetime.now().isoformat()) + " Scroll of table " + table + " aborted at query ", str(query_payload), "\n"])
+            return
+        query_response = response_json(raw_query_response)
+        query_payload = next_page_query(
+            query_payload, query_response, mode, fetch_records
+        )
+        # the next query is modified in place by the following page, the checkpoint keeps its own copy
+        yield query_response["records"], deepcopy(query_payload)
+
+
+def read_ahead(pages, PREFETCH):
+    # Requests the next pages in a separate thread while the current one is processed, up to PREFETCH pages ahead. The fetching thread blocks once the buffer is full, so the table queue backpressure also applies to the reads.
+    buffer = Queue(PREFETCH)
+
+    def fetch():
+        try:
+            for page in pages:
+                buffer.put(page)
+        finally:
+            buffer.put(None)
+
+    fetcher = Thread(target=fetch)
+    fetcher.start()
+    while True:
+        page = buffer.get()
+        if page is None:
+            break
+        yield page
+    fetcher.join()
+
+
+def scroll(
+    queue,
+    query_payload,
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
+    table,
+    schema_links,
+    schema_files,
+    ERROR_FILE,
+    host_header="",
+    mode="full",
+    fetch_records="all",
+    PREFETCH=0,
+    checkpoint=None,
+    phase="copy",
+    position=0,
+):
+    pages = query_pages(
+        query_payload,
+        from_XATA_API_KEY,
+        from_BRANCH_URL,
+        table,
+        ERROR_FILE,
+        host_header,
+        mode,
+        fetch_records,
+    )
+    if PREFETCH > 0:
+        pages = read_ahead(pages, PREFETCH)
+    for records, next_query in pages:
+        ticket = None
+        if checkpoint is not None:
+            ticket = checkpoint.page(table, phase, position, next_query, len(records))
+        if len(records) > 0:
+            queue.put(
+                [flatten_record(record, table, schema_links, schema_files) for record in records],
+                ticket,
             )
-            query_response = raw_query_response.json()
-            for record in query_response["records"]:
-                record.pop("xata", None)
-                # flatten link id keys to make them compatible with the write api
-                for column in schema_links[table]:
-                    if column in record:
-                        record[column] = (record.pop(column))["id"]
-                # remove file and file[] columns as unsupported
-                for column in schema_files[table]:
-                    if column in record:
-                        record.pop(column)
-                queue.put(record)
-            if query_response["meta"]["page"]["more"] == True:
-                query_payload["page"]["after"] = query_response["meta"]["page"][
-                    "cursor"
-                ]
-            else:
-                more = False
-        # only fetch records that have links
-        elif mode == "full" and fetch_records == "with_links":
-            for column in schema_links[table]:
-                # retrieve only records that have link column data
-                if "filter" in query_payload and "columns" in query_payload:
-                    query_payload["filter"]["$any"].append({"$exists": column})
-            raw_query_response, errors = post(
+
+
+def scroll_queries(
+    PAGE_SIZE,
+    table,
+    schema_links,
+    schema_files,
+    mode="full",
+    fetch_records="all",
+    partitions=1,
+    schema_columns=None,
+    partition_summary=None,
+    since=None,
+):
+    # Initial query of each scroll of a table pass, one per partition
+    columns = None
+    if schema_columns is not None:
+        columns = query_columns(table, schema_columns, schema_links, schema_files)
+    partition_list = [None]
+    if partition_summary is not None:
+        partition_list = partition_filters(partition_summary, partitions, PAGE_SIZE)
+    scrolls = []
+    for partition_filter in partition_list:
+        scrolls.append(
+            {
+                "query": initial_query(
+                    PAGE_SIZE,
+                    table,
+                    schema_links,
+                    mode,
+                    fetch_records,
+                    partition_filter,
+                    columns,
+                    since,
+                ),
+                "done": False,
+            }
+        )
+    return scrolls
+
+
+def producer(
+    queue,
+    PAGE_SIZE,
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
+    table,
+    schema_links,
+    schema_files,
+    ERROR_FILE,
+    host_header="",
+    mode="full",
+    fetch_records="all",
+    partitions=1,
+    PREFETCH=0,
+    schema_columns=None,
+    checkpoint=None,
+    phase="copy",
+    since=None,
+):
+    # A pass started by an interrupted run continues the scrolls it saved instead of starting over
+    scrolls = None
+    if checkpoint is not None:
+        scrolls = checkpoint.scrolls(table, phase)
+    if scrolls is None:
+        partition_summary = None
+        if partitions > 1:
+            summary_response, errors = post(
                 apikey=from_XATA_API_KEY,
-                urlPath=from_BRANCH_URL + "/tables/" + table + "/query",
-                payload=query_payload,
+                urlPath=from_BRANCH_URL + "/tables/" + table + "/summarize",
+                payload=partition_probe(),
                 ERROR_FILE=ERROR_FILE,
                 host_header=host_header,
             )
-            query_response = raw_query_response.json()
-            for record in query_response["records"]:
-                record.pop("xata", None)
-                # flatten link id keys to make them compatible with the write api
-                for column in schema_links[table]:
-                    if column in record:
-                        record[column] = (record.pop(column))["id"]
-                # remove file and file[] columns as unsupported
-                for column in schema_files[table]:
-                    if column in record:
-                        record.pop(column)
-                queue.put(record)
-            if query_response["meta"]["page"]["more"] == True:
-                query_payload = {}
-                query_payload["page"] = {}
-                query_payload["page"]["after"] = query_response["meta"]["page"][
-                    "cursor"
-                ]
-            else:
-                more = False
-        elif mode == "only_links":
-            raw_query_response, errors = post(
-                apikey=from_XATA_API_KEY,
-                urlPath=from_BRANCH_URL + "/tables/" + table + "/query",
-                payload=query_payload,
-                ERROR_FILE=ERROR_FILE,
-                host_header=host_header,
+            if summary_response is not None and summary_response.status_code == 200:
+                partition_summary = response_json(summary_response)["summaries"][0]
+        scrolls = scroll_queries(
+            PAGE_SIZE,
+            table,
+            schema_links,
+            schema_files,
+            mode,
+            fetch_records,
+            partitions,
+            schema_columns,
+            partition_summary,
+            since,
+        )
+        if checkpoint is not None:
+            checkpoint.start(table, phase, scrolls)
+    scroll_threads = []
+    for position in range(len(scrolls)):
+        if scrolls[position]["done"]:
+            continue
+        scroll_threads.append(
+            Thread(
+                target=scroll,
+                args=(
+                    queue,
+                    scrolls[position]["query"],
+                    from_XATA_API_KEY,
+                    from_BRANCH_URL,
+                    table,
+                    schema_links,
+                    schema_files,
+                    ERROR_FILE,
+                    host_header,
+                    mode,
+                    fetch_records,
+                    PREFETCH,
+                    checkpoint,
+                    phase,
+                    position,
+                ),
             )
-            query_response = raw_query_response.json()
-            for record in query_response["records"]:
-                record.pop("xata", None)
-                for column in schema_links[table]:
-                    if column in record:
-                        record[column] = (record.pop(column))["id"]
-                # remove file and file[] columns as unsupported
-                for column in schema_files[table]:
-                    if column in record:
-                        record.pop(column)
-                queue.put(record)
-            if query_response["meta"]["page"]["more"] == True:
-                query_payload["page"]["after"] = query_response["meta"]["page"][
-                    "cursor"
-                ]
-                # filter is only applied for the initial query, pagination does not need the filter
-                if "filter" in query_payload:
-                    query_payload.pop("filter")
-            else:
-                more = False
+        )
+    for scroll_thread in scroll_threads:
+        scroll_thread.start()
+    for scroll_thread in scroll_threads:
+        scroll_thread.join()
     queue.put(None)
 
 
-def consumer(
-    queue,
-    reporting_queue,
-    BULK_SIZE,
+def store_scroll(checkpoint, table, phase="backfill"):
+    # The link store is scrolled by row position, a single scroll per table
+    scrolls = None
+    if checkpoint is not None:
+        scrolls = checkpoint.scrolls(table, phase)
+    if scrolls is None:
+        scrolls = [{"query": {"after": 0}, "done": False}]
+        if checkpoint is not None:
+            checkpoint.start(table, phase, scrolls)
+    return scrolls[0]
+
+
+def store_producer(queue, link_store, table, PAGE_SIZE, checkpoint=None, phase="backfill"):
+    # Backfills the links captured while the table was copied, instead of scrolling the source table again
+    store_position = store_scroll(checkpoint, table, phase)
+    if not store_position["done"]:
+        for records, position in link_store.pages(
+            table, PAGE_SIZE, store_position["query"]["after"]
+        ):
+            ticket = None
+            if checkpoint is not None:
+                ticket = checkpoint.page(table, phase, 0, {"after": position}, len(records))
+            queue.put(records, ticket)
+        if checkpoint is not None:
+            checkpoint.page(table, phase, 0, None, 0)
+    queue.put(None)
+
+
+class TableWriter:
+    # Batches the pages of one table pass and hands the batches to the shared writer pool. Scroll threads put pages like on a queue, and None once the scroll is over. The table pass is closed with a single report once its last batch is written.
+    def __init__(
+        self,
+        pool,
+        table_counts,
+        MAX_QUEUE_SIZE,
+        reporting_queue,
+        BULK_SIZE,
+        to_XATA_API_KEY,
+        to_BRANCH_URL,
+        table,
+        schema,
+        deferred_links,
+        output,
+        output_format,
+        output_path,
+        ERROR_FILE,
+        host_header="",
+        mode="full",
+        records_type="all",
+        DEAD_LETTER_FILE="",
+        BULK_BYTES=0,
+        link_store=None,
+        checkpoint=None,
+        upsert=False,
+    ):
+        self.pool = pool
+        self.table_counts = table_counts
+        self.reporting_queue = reporting_queue
+        self.BULK_SIZE = BULK_SIZE
+        self.to_XATA_API_KEY = to_XATA_API_KEY
+        self.to_BRANCH_URL = to_BRANCH_URL
+        self.table = table
+        self.schema = schema
+        self.deferred_links = deferred_links
+        self.output = output
+        self.output_format = output_format
+        self.output_path = output_path
+        self.ERROR_FILE = ERROR_FILE
+        self.host_header = host_header
+        self.mode = mode
+        self.records_type = records_type
+        self.DEAD_LETTER_FILE = DEAD_LETTER_FILE
+        self.BULK_BYTES = BULK_BYTES
+        self.link_store = link_store
+        self.checkpoint = checkpoint
+        self.upsert = upsert
+        # Batches waiting for a writer are bounded by the queue size in records
+        self.slots = Semaphore(queue_slots(MAX_QUEUE_SIZE, batch_size(BULK_SIZE, mode)))
+        self.lock = Lock()
+        self.file_lock = Lock()
+        self.records = []
+        self.sizes = []
+        # Checkpoint ticket of the page of each buffered record
+        self.tickets = []
+        self.pending = 0
+        self.closed = False
+        self.finished = Event()
+
+    def put(self, page, ticket=None):
+        with self.lock:
+            if page is None:
+                batches = [self.records] if len(self.records) > 0 else []
+                self.records = []
+                self.sizes = []
+            else:
+                if self.mode == "no_links":
+                    # keep the links of cycles for the backfill before they are stripped
+                    if self.link_store is not None:
+                        self.link_store.add(self.table, page, self.deferred_links[self.table])
+                    for record in page:
+                        strip_deferred_links(record, self.table, self.deferred_links)
+                self.records.extend(page)
+                if self.BULK_BYTES > 0:
+                    self.sizes.extend(encoded_size(record) for record in page)
+                else:
+                    self.sizes.extend([0] * len(page))
+                self.tickets.extend([ticket] * len(page))
+                batches, self.records, self.sizes = split_batches(
+                    self.records,
+                    self.sizes,
+                    batch_size(self.BULK_SIZE, self.mode),
+                    self.BULK_BYTES,
+                )
+            batch_tickets = []
+            offset = 0
+            for batch in batches:
+                batch_tickets.append(self.tickets[offset : offset + len(batch)])
+                offset += len(batch)
+            self.tickets = self.tickets[offset:]
+            self.pending += len(batches)
+        for batch, tickets in zip(batches, batch_tickets):
+            self.slots.acquire()
+            # Counts arrive while the tables are copied, a table is ranked by its count as soon as it is known
+            self.pool.put(table_rank(self.table, self.table_counts), self, (batch, tickets))
+        if page is None:
+            with self.lock:
+                self.closed = True
+                finished = self.pending == 0
+            if finished:
+                self.close()
+
+    def write(self, batch):
+        records, tickets = batch
+        self.slots.release()
+        try:
+            self.flush(records)
+        except Exception as e:
+            # A failure the requests do not handle must not stop the writer nor lose the batch
+            self.abandon(records, e)
+        finally:
+            # The pages of the batch count as written for the checkpoint, failed records are in the dead letters
+            if self.checkpoint is not None:
+                self.checkpoint.acknowledge(tickets)
+            with self.lock:
+                self.pending -= 1
+                finished = self.closed and self.pending == 0
+            if finished:
+                self.close()
+
+    def abandon(self, records, error):
+        method, path, payload, key = batch_request(
+            self.table, records, self.mode, self.records_type, self.upsert
+        )
+        log_failure(self.ERROR_FILE, method, self.to_BRANCH_URL + path, payload, "exception", repr(error))
+        deadletters.write(
+            self.DEAD_LETTER_FILE, self.table, method, path, payload, {"exception": 1}
+        )
+        self.reporting_queue.put(
+            {self.table: {"errors": {"exception": 1}, "failed": len(records)}}
+        )
+
+    def close(self):
+        close_report = {self.table: {report_key(self.mode, self.records_type): None}}
+        self.reporting_queue.put(close_report)
+        self.finished.set()
+
+    def flush(self, records):
+        if self.output == "xata":
+            self.settle(records, self.send(records), 0)
+            return
+        # Only full records are logged to file, links are not backfilled when the file output method is selected.
+        if self.output == "file" and report_key(self.mode, self.records_type) == "records":
+            # batches of a table can be written by several writers at once
+            with self.file_lock:
+                write_file(
+                    records, self.table, self.schema, self.output_format, self.output_path
+                )
+        status_report = {self.table: {report_key(self.mode, self.records_type): len(records)}}
+        self.reporting_queue.put(status_report)
+
+    def send(self, records, depth=0):
+        method, path, payload, key = batch_request(
+            self.table, records, self.mode, self.records_type, self.upsert
+        )
+        resp, errors = request(
+            method,
+            apikey=self.to_XATA_API_KEY,
+            urlPath=self.to_BRANCH_URL + path,
+            payload=payload,
+            expect_codes=split_codes(records, depth),
+            ERROR_FILE=self.ERROR_FILE,
+            host_header=self.host_header,
+        )
+        if resp is None:
+            return method, path, payload, key, None, "", errors
+        return method, path, payload, key, resp.status_code, resp.text, errors
+
+    def settle(self, records, sent, depth):
+        method, path, payload, key, status, text, errors = sent
+        # Send both halves of a rejected batch again
+        if status in split_codes(records, depth):
+            halves = [records[: len(records) // 2], records[len(records) // 2 :]]
+            sent_halves = [self.send(half, depth + 1) for half in halves]
+            if not repeated_rejection([sent_half[4:6] for sent_half in sent_halves]):
+                errors.pop(status, None)
+                if errors != {}:
+                    self.reporting_queue.put({self.table: {"errors": errors}})
+                for half, sent_half in zip(halves, sent_halves):
+                    self.settle(half, sent_half, depth + 1)
+                return
+            # Splitting further would only repeat the rejection, the batch is kept whole in the dead letters with the errors of its halves
+            for sent_half in sent_halves:
+                for error_code in sent_half[6]:
+                    errors[error_code] = errors.get(error_code, 0) + sent_half[6][error_code]
+            log_failure(self.ERROR_FILE, method, self.to_BRANCH_URL + path, payload, status, text)
+        # If there are errors returned by the request, add them to the reporting queue
+        if errors != {}:
+            error_report = {self.table: {"errors": errors}}
+            self.reporting_queue.put(error_report)
+        # Keep failed batches for replay instead of losing them, their records are counted apart from the records written
+        if status is None or status > 299:
+            deadletters.write(
+                self.DEAD_LETTER_FILE, self.table, method, path, payload, errors
+            )
+            self.reporting_queue.put({self.table: {"failed": len(records)}})
+            return
+        self.reporting_queue.put({self.table: {key: len(records)}})
+
+
+class WriterPool:
+    # Writer threads shared by all tables. Batches are taken by rank, so that writers go to the largest tables first and move on to smaller tables whenever the larger ones have nothing queued.
+    def __init__(self, writers):
+        self.batches = PriorityQueue()
+        self.sequence = count()
+        self.threads = [Thread(target=self.writer) for writer_iterator in range(writers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, rank, table_writer, batch):
+        # The sequence keeps batches of the same rank in order and is never equal, so table writers are never compared
+        metrics.queued(table_writer.table, 1)
+        self.batches.put((rank, next(self.sequence), table_writer, batch))
+
+    def writer(self):
+        while True:
+            rank, sequence, table_writer, batch = self.batches.get()
+            # check for stop
+            if table_writer is None:
+                break
+            metrics.queued(table_writer.table, -1)
+            metrics.active(table_writer.table, 1)
+            try:
+                table_writer.write(batch)
+            finally:
+                metrics.active(table_writer.table, -1)
+
+    def stop(self):
+        for thread in self.threads:
+            self.batches.put((float("inf"), next(self.sequence), None, None))
+        for thread in self.threads:
+            thread.join()
+
+
+def count_records(
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
+    table,
+    ERROR_FILE,
+    host_header="",
+    since=None,
+    record_filter=None,
+):
+    # Number of records of the table, or updated since the previous sync, None when the summarize request fails. The count can be restricted further to the records matching a filter.
+    summary_payload = {"summaries": {"total": {"count": "*"}}}
+    if since is not None or record_filter is not None:
+        summary_payload["filter"] = dict(record_filter or {})
+    if since is not None:
+        summary_payload["filter"][UPDATED_COLUMN] = {"$ge": since}
+    summaries, errors = post(
+        apikey=from_XATA_API_KEY,
+        urlPath=from_BRANCH_URL + "/tables/" + table + "/summarize",
+        payload=summary_payload,
+        ERROR_FILE=ERROR_FILE,
+        host_header=host_header,
+    )
+    if summaries is not None and summaries.status_code == 200:
+        return response_json(summaries)["summaries"][0]["total"]
+    return None
+
+
+def high_water_mark(from_XATA_API_KEY, from_BRANCH_URL, table, ERROR_FILE, host_header=""):
+    # Highest update time of the records of the table before it is copied, the next sync starts from it. None when the table is empty or the summarize request fails.
+    summaries, errors = post(
+        apikey=from_XATA_API_KEY,
+        urlPath=from_BRANCH_URL + "/tables/" + table + "/summarize",
+        payload={"summaries": {"last": {"max": UPDATED_COLUMN}}},
+        ERROR_FILE=ERROR_FILE,
+        host_header=host_header,
+    )
+    if summaries is not None and summaries.status_code == 200:
+        return response_json(summaries)["summaries"][0].get("last")
+    return None
+
+
+def record_ids(XATA_API_KEY, BRANCH_URL, table, PAGE_SIZE, ERROR_FILE, host_header=""):
+    # Ids of all the records of the table, None when the scroll is aborted
+    ids = set()
+    pages = query_pages(
+        {"page": {"size": PAGE_SIZE}, "columns": ["id"]},
+        XATA_API_KEY,
+        BRANCH_URL,
+        table,
+        ERROR_FILE,
+        host_header,
+    )
+    for records, next_query in pages:
+        ids.update(record["id"] for record in records)
+        if next_query is None:
+            return ids
+    return None
+
+
+def delete_missing(
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
     to_XATA_API_KEY,
     to_BRANCH_URL,
     table,
-    schema,
-    schema_links,
-    schema_files,
-    table_categories,
-    output,
-    output_format,
-    output_path,
+    PAGE_SIZE,
+    BULK_SIZE,
     ERROR_FILE,
-    host_header="",
-    mode="full",
-    records_type="all",
+    DEAD_LETTER_FILE="",
+    source_host_header="",
+    destination_host_header="",
 ):
-    # consume work
-    records = []
+    # Deletes the records of the target table whose id is no longer in the source table. Returns the number of deleted records, None when the ids could not be listed.
+    source_ids = record_ids(
+        from_XATA_API_KEY, from_BRANCH_URL, table, PAGE_SIZE, ERROR_FILE, source_host_header
+    )
+    if source_ids is None:
+        return None
+    target_ids = record_ids(
+        to_XATA_API_KEY, to_BRANCH_URL, table, PAGE_SIZE, ERROR_FILE, destination_host_header
+    )
+    if target_ids is None:
+        return None
+    deleted_ids = sorted(target_ids - source_ids)
+    deleted = 0
+    for position in range(0, len(deleted_ids), BULK_SIZE):
+        transaction_payload = {
+            "operations": [
+                {"delete": {"table": table, "id": record_id}}
+                for record_id in deleted_ids[position : position + BULK_SIZE]
+            ]
+        }
+        resp, errors = post(
+            apikey=to_XATA_API_KEY,
+            urlPath=to_BRANCH_URL + "/transaction",
+            payload=transaction_payload,
+            ERROR_FILE=ERROR_FILE,
+            host_header=destination_host_header,
+        )
+        if resp is None or resp.status_code > 299:
+            deadletters.write(
+                DEAD_LETTER_FILE, table, "POST", "/transaction", transaction_payload, errors
+            )
+        else:
+            deleted += len(transaction_payload["operations"])
+    return deleted
+
+
+def drain_reports(queue):
+    # Totals of the status reports left in the queue, per table, when no reporter is running
+    totals = {}
     while True:
-        # get a unit of work
         try:
-            record = queue.get(block=False)
+            status_report = queue.get_nowait()
         except Empty:
-            sleep(0.05)
-            continue
-        # check for stop
-        if record is None:
-            # place the None back for other consumer threads to terminate as well
-            queue.put(None)
-            break
-        if mode == "no_links":
-            for column in schema_links[table]:
-                if (
-                    schema_links[table][column]["link"]["table"]
-                    in table_categories["category3"]
-                ):
-                    # ignore the link if it has a value and points to a category 3 table
-                    if column in record.keys():
-                        record.pop(column)
-        # Process full records with or without link content. These are reported as record counts for the reporting thread.
-        # This is the only case that we want to log to file, if the file output method is selected.
-        if (mode == "full" and records_type == "all") or mode == "no_links":
-            records.append(record)
-            if len(records) == BULK_SIZE:
-                if output == "xata":
-                    resp, errors = post(
-                        apikey=to_XATA_API_KEY,
-                        urlPath=to_BRANCH_URL + "/tables/" + table + "/bulk",
-                        payload={"records": records},
-                        ERROR_FILE=ERROR_FILE,
-                        host_header=host_header,
-                    )
-                    # If there are errors returned by the request, add them to the reporting queue
-                    if errors != {}:
-                        error_report = {}
-                        error_report = {table: {"errors": errors}}
-                        reporting_queue.put(error_report)
-                elif output == "file":
-                    if output_format == "json":
-                        with open(output_path + table + ".log", "a") as f:
-                            for record in records:
-                                f.write(str(record) + "\n")
-                            errors = {}
-                    elif output_format == "csv":
-                        with open(output_path + table + ".csv", "a") as f:
-                            for record in records:
-                                csv_record = ""
-                                csv_record_position = 1
-                                for current_table in schema["schema"]["tables"]:
-                                    if current_table["name"] == table:
-                                        csv_record_max_position = len(
-                                            current_table["columns"]
-                                        )
-                                        if "id" in record:
-                                            csv_record += str(record["id"]) + ","
-                                        for schema_column in sorted(
-                                            current_table["columns"],
-                                            key=itemgetter("name"),
-                                        ):
-                                            if schema_column["name"] in record:
-                                                if (
-                                                    schema_column["type"]
-                                                    in (
-                                                        "multiple",
-                                                        "string",
-                                                        "text",
-                                                        "object",
-                                                    )
-                                                    and len(
-                                                        record[schema_column["name"]]
-                                                    )
-                                                    > 0
-                                                ):
-                                                    csv_record += (
-                                                        '"'
-                                                        + str(
-                                                            record[
-                                                                schema_column["name"]
-                                                            ]
-                                                        ).replace('"', '""')
-                                                        + '"'
-                                                    )
-                                                else:
-                                                    csv_record += str(
-                                                        record[schema_column["name"]]
-                                                    )
-                                            if (
-                                                csv_record_position
-                                                < csv_record_max_position
-                                            ):
-                                                csv_record += ","
-                                            csv_record_position += 1
-                                f.write(str(csv_record) + "\n")
-                            errors = {}
-                status_report = {}
-                status_report = {table: {"records": len(records)}}
-                reporting_queue.put(status_report)
-                records = []
-        # explicitly process records with link content. This happens in the second pass for backfilling, these are reported as link counts for the reporting thread.
-        elif mode == "full" and records_type == "with_links":
-            records.append(record)
-            if len(records) == BULK_SIZE:
-                if output == "xata":
-                    resp, errors = post(
-                        apikey=to_XATA_API_KEY,
-                        urlPath=to_BRANCH_URL + "/tables/" + table + "/bulk",
-                        payload={"records": records},
-                        ERROR_FILE=ERROR_FILE,
-                        host_header=host_header,
-                    )
-                    # If there are errors returned by the request, add them to the reporting queue
-                    if errors != {}:
-                        error_report = {}
-                        error_report = {table: {"errors": errors}}
-                        reporting_queue.put(error_report)
-                status_report = {}
-                status_report = {table: {"links": len(records)}}
-                reporting_queue.put(status_report)
-                records = []
-        elif mode == "bulk_links_transaction":
-            records.append(record)
-            if len(records) == BULK_SIZE:
-                if output == "xata":
-                    # transaction request
-                    transaction_payload = {}
-                    transaction_payload["operations"] = []
-                    for record_to_update in records:
-                        transaction_item = {}
-                        transaction_item["update"] = {}
-                        transaction_item["update"]["table"] = table
-                        transaction_item["update"]["id"] = record_to_update.pop("id")
-                        transaction_item["update"]["fields"] = record_to_update
-                        transaction_item["update"]["upsert"] = True
-                        transaction_payload["operations"].append(transaction_item)
-                    resp, errors = post(
-                        apikey=to_XATA_API_KEY,
-                        urlPath=to_BRANCH_URL + "/transaction",
-                        payload=transaction_payload,
-                        ERROR_FILE=ERROR_FILE,
-                        host_header=host_header,
-                    )
-                    # If there are errors returned by the request, add them to the reporting queue
-                    if errors != {}:
-                        error_report = {}
-                        error_report = {table: {"errors": errors}}
-                        reporting_queue.put(error_report)
-                status_report = {}
-                status_report = {table: {"links": len(records)}}
-                reporting_queue.put(status_report)
-                records = []
-        # Atomic record link updates
-        elif mode == "only_links":
-            record_id = record.pop("id")
-            resp, errors = patch(
-                apikey=to_XATA_API_KEY,
-                urlPath=to_BRANCH_URL + "/tables/" + table + "/data/" + record_id,
-                payload=record,
-                ERROR_FILE=ERROR_FILE,
-                host_header=host_header,
-            )
-            if errors != {}:
-                error_report = {}
-                error_report = {table: {"errors": errors}}
-                reporting_queue.put(error_report)
-            status_report = {}
-            status_report = {table: {"links": 1}}
-            reporting_queue.put(status_report)
-    # all done
-    if (mode == "full" and records_type == "all") or mode == "no_links":
-        if output == "xata" and len(records) > 0:
-            resp, errors = post(
-                apikey=to_XATA_API_KEY,
-                urlPath=to_BRANCH_URL + "/tables/" + table + "/bulk",
-                payload={"records": records},
-                ERROR_FILE=ERROR_FILE,
-            )
-            # If there are errors returned by the request, add them to the reporting queue
-            if errors != {}:
-                error_report = {}
-                error_report = {table: {"errors": errors}}
-                reporting_queue.put(error_report)
-        elif output == "file":
-            if output_format == "json":
-                with open(output_path + table + ".log", "a") as f:
-                    for record in records:
-                        f.write(str(record) + "\n")
-                    errors = {}
-            elif output_format == "csv":
-                with open(output_path + table + ".csv", "a") as f:
-                    for record in records:
-                        csv_record = ""
-                        csv_record_position = 1
-                        for current_table in schema["schema"]["tables"]:
-                            if current_table["name"] == table:
-                                csv_record_max_position = len(current_table["columns"])
-                                if "id" in record:
-                                    csv_record += str(record["id"]) + ","
-                                for schema_column in sorted(
-                                    current_table["columns"], key=itemgetter("name")
-                                ):
-                                    if schema_column["name"] in record:
-                                        if (
-                                            schema_column["type"]
-                                            in ("multiple", "string", "text", "object")
-                                            and len(record[schema_column["name"]]) > 0
-                                        ):
-                                            csv_record += (
-                                                '"'
-                                                + str(
-                                                    record[schema_column["name"]]
-                                                ).replace('"', '""')
-                                                + '"'
-                                            )
-                                        else:
-                                            csv_record += str(
-                                                record[schema_column["name"]]
-                                            )
-                                    if csv_record_position < csv_record_max_position:
-                                        csv_record += ","
-                                    csv_record_position += 1
-                        f.write(str(csv_record) + "\n")
-                    errors = {}
-
-        status_report = {}
-        status_report = {table: {"records": len(records)}}
-        reporting_queue.put(status_report)
-        close_report = {table: {"records": None}}
-        reporting_queue.put(close_report)
-    elif mode == "full" and records_type == "with_links":
-        if output == "xata" and len(records) > 0:
-            resp, errors = post(
-                apikey=to_XATA_API_KEY,
-                urlPath=to_BRANCH_URL + "/tables/" + table + "/bulk",
-                payload={"records": records},
-                ERROR_FILE=ERROR_FILE,
-                host_header=host_header,
+            return totals
+        for table in status_report:
+            table_totals = totals.setdefault(
+                table, {"records": 0, "links": 0, "files": 0, "failed": 0, "errors": {}}
             )
-            if errors != {}:
-                error_report = {}
-                error_report = {table: {"errors": errors}}
-                reporting_queue.put(error_report)
-        status_report = {}
-        status_report = {table: {"links": len(records)}}
-        reporting_queue.put(status_report)
-        close_report = {table: {"links": None}}
-        reporting_queue.put(close_report)
-    elif mode == "bulk_links_transaction":
-        if output == "xata" and len(records) > 0:
-            # transaction request
-            transaction_payload = {}
-            transaction_payload["operations"] = []
-            for record_to_update in records:
-                transaction_item = {}
-                transaction_item["update"] = {}
-                transaction_item["update"]["table"] = table
-                transaction_item["update"]["id"] = record_to_update.pop("id")
-                transaction_item["update"]["fields"] = record_to_update
-                transaction_item["update"]["upsert"] = True
-                transaction_payload["operations"].append(transaction_item)
-            resp, errors = post(
-                apikey=to_XATA_API_KEY,
-                urlPath=to_BRANCH_URL + "/transaction",
-                payload=transaction_payload,
-                ERROR_FILE=ERROR_FILE,
-                host_header=host_header,
+            for key in ("records", "links", "files", "failed"):
+                if status_report[table].get(key) is not None:
+                    table_totals[key] += status_report[table][key]
+            for error_code in status_report[table].get("errors", {}):
+                table_totals["errors"][error_code] = (
+                    table_totals["errors"].get(error_code, 0)
+                    + status_report[table]["errors"][error_code]
+                )
+
+
+# Summarize requests sent at once when the counts or update times of all tables are needed
+COUNT_CONCURRENCY = 8
+
+
+def map_concurrently(function, items, concurrency=COUNT_CONCURRENCY):
+    # Call the function on each item with a few threads at once, returns the results by item
+    results = {}
+    pending = Queue()
+    for item in items:
+        pending.put(item)
+
+    def run():
+        while True:
+            try:
+                item = pending.get(block=False)
+            except Empty:
+                return
+            results[item] = function(item)
+
+    threads = [Thread(target=run) for thread_iterator in range(max(1, min(concurrency, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def record_counter(
+    reporting_queue,
+    table_counts,
+    tables,
+    from_XATA_API_KEY,
+    from_BRANCH_URL,
+    ERROR_FILE,
+    host_header="",
+    table_since={},
+):
+    # Count the records of the tables while they are copied, largest tables are ranked first as soon as their count is known. Each count is reported as it arrives, the progress shows ? until then.
+    def count(table):
+        table_counts[table] = count_records(
+            from_XATA_API_KEY,
+            from_BRANCH_URL,
+            table,
+            ERROR_FILE,
+            host_header,
+            table_since.get(table),
+        )
+        reporting_queue.put({table: {"summary": table_counts[table]}})
+
+    map_concurrently(count, tables)
+
+
+def table_rank(table, table_counts):
+    # Tables with the most records are written first, tables of unknown size last
+    if table_counts.get(table) is None:
+        return 0
+    return -table_counts[table]
+
+
+def throttling_status():
+    status = ""
+    for rate_stats in limiter_stats():
+        if rate_stats["throttled"] > 0:
+            status += (
+                " | Request rate "
+                + (rate_stats["host_header"] or rate_stats["base_url"])
+                + ": "
+                + str(rate_stats["rate"])
+                + "/s"
             )
-            if errors != {}:
-                error_report = {}
-                error_report = {table: {"errors": errors}}
-                reporting_queue.put(error_report)
-        status_report = {}
-        status_report = {table: {"links": len(records)}}
-        reporting_queue.put(status_report)
-        close_report = {table: {"links": None}}
-        reporting_queue.put(close_report)
-    elif mode == "only_links":
-        close_report = {table: {"links": None}}
-        reporting_queue.put(close_report)
+    return status
+
+
+def table_errors(table_report):
+    # Errors per status code, along with the records and links of the batches that were dead-lettered
+    if table_report["failed"] == 0:
+        return table_report["errors"]
+    return dict(table_report["errors"], failed=table_report["failed"])
 
 
 def reporter(
     queue,
     tables,
-    table_categories,
+    table_dependencies,
+    deferred_links,
     from_XATA_API_KEY,
     from_BRANCH_URL,
     ERROR_FILE,
-    CONCURRENT_CONSUMERS,
+    table_counts,
     host_header,
     output,
     output_format,
     output_path,
+    REPORT_INTERVAL=1,
+    file_tables=(),
+    HEADLESS=False,
+    run_metrics=None,
 ):
+    # Without a terminal the progress lines are not redrawn, a line is printed as each table completes and the metrics are kept by run_metrics
     LINE_UP = "\033[1A"
     LINE_CLEAR = "\x1b[2K"
     report = {}
     table_status = {}
     if output == "xata":
         print("\nExecution plan:")
-        for category in table_categories:
-            if category == "category1" and len(table_categories[category]) > 0:
-                print(
-                    table_categories[category],
-                    "do not contain links and will be copied first.",
-                )
-            if category == "category2" and len(table_categories[category]) > 0:
+        for table in tables:
+            if len(table_dependencies[table]) == 0:
+                print(table, "does not wait for other tables and will be copied right away.")
+            else:
                 print(
-                    table_categories[category],
-                    "contain links to other tables from the above list so will be copied second.",
+                    table,
+                    "will be copied as soon as",
+                    table_dependencies[table],
+                    "have been copied.",
                 )
-            if category == "category3" and len(table_categories[category]) > 0:
+            if len(deferred_links[table]) > 0:
                 print(
-                    table_categories[category],
-                    "contain links to other tables with links and will be copied last. Links will be backfilled after all records have been copied.",
+                    table,
+                    "links",
+                    list(deferred_links[table]),
+                    "are part of a link cycle and will be backfilled once",
+                    sorted(
+                        set(
+                            deferred_links[table][column]["link"]["table"]
+                            for column in deferred_links[table]
+                        )
+                    ),
+                    "have been copied.",
                 )
     elif output == "file":
         if output_format == "json":
             print("\nTable output file paths:")
-            for category in table_categories:
-                for ordered_table in table_categories[category]:
-                    print(
-                        "-", ordered_table + ":", output_path + ordered_table + ".log"
-                    )
+            for ordered_table in tables:
+                print("-", ordered_table + ":", output_path + ordered_table + ".log")
         elif output_format == "csv":
             print("\nTable output csv paths:")
-            for category in table_categories:
-                for ordered_table in table_categories[category]:
-                    print(
-                        "-", ordered_table + ":", output_path + ordered_table + ".csv"
-                    )
+            for ordered_table in tables:
+                print("-", ordered_table + ":", output_path + ordered_table + ".csv")
     print("\n>>> COPYING TABLE DATA <<<\n")
     start = datetime.now()
     for table in tables:
         print("Initializing replay from", table)
         table_status[table] = {}
         table_status[table]["threads_finished"] = 0
-        summaries, errors = post(
-            apikey=from_XATA_API_KEY,
-            urlPath=from_BRANCH_URL + "/tables/" + table + "/summarize",
-            payload={"summaries": {"total": {"count": "*"}}},
-            ERROR_FILE=ERROR_FILE,
-            host_header=host_header,
-        )
-        table_status[table]["records_summary"] = summaries.json()["summaries"][0][
-            "total"
-        ]
+        if table_counts.get(table) is not None:
+            table_status[table]["records_summary"] = table_counts[table]
+        else:
+            table_status[table]["records_summary"] = "?"
         report[table] = {}
         report[table]["records"] = 0
+        report[table]["failed"] = 0
         report[table]["errors"] = {}
-        # Category 3 tables will also get links reporting due to individual link backfilling strategy
-        if table in table_categories["category3"]:
+        # Tables with links in cycles will also get links reporting due to individual link backfilling strategy
+        if len(deferred_links[table]) > 0:
             report[table]["links"] = 0
             table_status[table]["links_finished"] = 0
+        # Tables with attachments also report the files copied by their file pass
+        if table in file_tables:
+            report[table]["files"] = 0
+            table_status[table]["files_finished"] = 0
+    if len(file_tables) > 0:
+        print("Initializing copy of attachments")
+    rendered = datetime.now()
+    changed = False
+    completed_tables = set()
     while True:
+        closing = False
+        # Wait for the next report, at most until the elapsed time line is due for a refresh
+        wait = REPORT_INTERVAL - (datetime.now() - rendered).total_seconds()
         try:
-            status_report = queue.get(block=False)
+            status_report = queue.get(timeout=max(wait, 0))
+            if run_metrics is not None:
+                run_metrics.update(status_report)
             for key in status_report:
+                if "summary" in status_report[key]:
+                    if status_report[key]["summary"] is not None:
+                        table_status[key]["records_summary"] = status_report[key]["summary"]
                 if "records" in status_report[key]:
                     if status_report[key]["records"] is not None:
                         report[key]["records"] += status_report[key]["records"]
                     else:
                         table_status[key]["threads_finished"] += 1
+                        closing = True
                 if "links" in status_report[key]:
                     if status_report[key]["links"] is not None:
                         report[key]["links"] += status_report[key]["links"]
                     else:
                         table_status[key]["links_finished"] += 1
+                        closing = True
+                if "files" in status_report[key]:
+                    if status_report[key]["files"] is not None:
+                        report[key]["files"] += status_report[key]["files"]
+                    else:
+                        table_status[key]["files_finished"] += 1
+                        closing = True
+                if "failed" in status_report[key]:
+                    report[key]["failed"] += status_report[key]["failed"]
                 if "errors" in status_report[key]:
                     # handle errors
                     for error_code in status_report[key]["errors"]:
@@ -530,76 +1141,37 @@ def reporter(
                             report[key]["errors"][error_code] = status_report[key][
                                 "errors"
                             ][error_code]
+            changed = True
         except Empty:
-            print(LINE_UP, end=LINE_CLEAR)
-            print("Elapsed:", datetime.now() - start)
-            sleep(0.1)
+            pass
+        # Render state changes at most once per interval, except when writers finish so that completion is detected right away
+        if not closing and (datetime.now() - rendered).total_seconds() < REPORT_INTERVAL:
+            continue
+        rendered = datetime.now()
+        if not changed:
+            if not HEADLESS:
+                print(LINE_UP, end=LINE_CLEAR)
+                print("Elapsed:", str(datetime.now() - start) + throttling_status())
             continue
+        changed = False
 
-        print(LINE_UP, end=LINE_CLEAR)
-        for table in report:
+        if not HEADLESS:
             print(LINE_UP, end=LINE_CLEAR)
+            for table in report:
+                print(LINE_UP, end=LINE_CLEAR)
+            if len(file_tables) > 0:
+                print(LINE_UP, end=LINE_CLEAR)
 
-        for table in report:
-            if "records" in report[table] and "links" not in report[table]:
-                if table_status[table]["threads_finished"] != CONCURRENT_CONSUMERS:
-                    if report[table]["errors"] == {}:
-                        print(
-                            table,
-                            ":",
-                            report[table]["records"],
-                            "/",
-                            table_status[table]["records_summary"],
-                        )
-                    else:
-                        print(
-                            table,
-                            ":",
-                            report[table]["records"],
-                            "/",
-                            table_status[table]["records_summary"],
-                            "Errors:",
-                            report[table]["errors"],
-                        )
-                else:
-                    if report[table]["errors"] == {}:
-                        print(
-                            table,
-                            ":",
-                            report[table]["records"],
-                            "/",
-                            table_status[table]["records_summary"],
-                            "[Completed]",
-                        )
-                    else:
-                        print(
-                            table,
-                            ":",
-                            report[table]["records"],
-                            "/",
-                            table_status[table]["records_summary"],
-                            "[Completed]",
-                            "Errors:",
-                            report[table]["errors"],
-                        )
-            if "records" in report[table] and "links" in report[table]:
-                if report[table]["links"] > 0:
-                    if (
-                        table_status[table]["threads_finished"] == CONCURRENT_CONSUMERS
-                        and table_status[table]["links_finished"]
-                        == CONCURRENT_CONSUMERS
-                    ):
-                        if report[table]["errors"] == {}:
+            for table in report:
+                if "records" in report[table] and "links" not in report[table]:
+                    if table_status[table]["threads_finished"] == 0:
+                        if table_errors(report[table]) == {}:
                             print(
                                 table,
                                 ":",
                                 report[table]["records"],
                                 "/",
                                 table_status[table]["records_summary"],
-                                "[Completed]",
-                                "| Backfilled links:",
-                                report[table]["links"],
-                                "[Completed]",
                             )
                         else:
                             print(
@@ -608,19 +1180,11 @@ def reporter(
                                 report[table]["records"],
                                 "/",
                                 table_status[table]["records_summary"],
-                                "[Completed]",
-                                "| Backfilled links:",
-                                report[table]["links"],
-                                "[Completed]",
                                 "Errors:",
-                                report[table]["errors"],
+                                table_errors(report[table]),
                             )
-                    elif (
-                        table_status[table]["threads_finished"] == CONCURRENT_CONSUMERS
-                        and table_status[table]["links_finished"]
-                        != CONCURRENT_CONSUMERS
-                    ):
-                        if report[table]["errors"] == {}:
+                    else:
+                        if table_errors(report[table]) == {}:
                             print(
                                 table,
                                 ":",
@@ -628,8 +1192,6 @@ def reporter(
                                 "/",
                                 table_status[table]["records_summary"],
                                 "[Completed]",
-                                "| Backfilled links:",
-                                report[table]["links"],
                             )
                         else:
                             print(
@@ -639,89 +1201,173 @@ def reporter(
                                 "/",
                                 table_status[table]["records_summary"],
                                 "[Completed]",
-                                "| Backfilled links:",
-                                report[table]["links"],
                                 "Errors:",
-                                report[table]["errors"],
-                            )
-                    elif (
-                        table_status[table]["links_finished"] != CONCURRENT_CONSUMERS
-                        and table_status[table]["threads_finished"]
-                        != CONCURRENT_CONSUMERS
-                    ):
-                        if report[table]["errors"] == {}:
-                            print(
-                                table,
-                                ":",
-                                report[table]["records"],
-                                "/",
-                                table_status[table]["records_summary"],
-                                "| Backfilled links:",
-                                report[table]["links"],
-                            )
-                        else:
-                            print(
-                                table,
-                                ":",
-                                report[table]["records"],
-                                "/",
-                                table_status[table]["records_summary"],
-                                "| Backfilled links:",
-                                report[table]["links"],
-                                "Errors:",
-                                report[table]["errors"],
-                            )
-                else:
-                    if table_status[table]["threads_finished"] != CONCURRENT_CONSUMERS:
-                        if report[table]["errors"] == {}:
-                            print(
-                                table,
-                                ":",
-                                report[table]["records"],
-                                "/",
-                                table_status[table]["records_summary"],
-                            )
-                        else:
-                            print(
-                                table,
-                                ":",
-                                report[table]["records"],
-                                "/",
-                                table_status[table]["records_summary"],
-                                "Errors:",
-                                report[table]["errors"],
+                                table_errors(report[table]),
                             )
+                if "records" in report[table] and "links" in report[table]:
+                    if report[table]["links"] > 0:
+                        if (
+                            table_status[table]["threads_finished"] > 0
+                            and table_status[table]["links_finished"] > 0
+                        ):
+                            if table_errors(report[table]) == {}:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                    "[Completed]",
+                                    "| Backfilled links:",
+                                    report[table]["links"],
+                                    "[Completed]",
+                                )
+                            else:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                    "[Completed]",
+                                    "| Backfilled links:",
+                                    report[table]["links"],
+                                    "[Completed]",
+                                    "Errors:",
+                                    table_errors(report[table]),
+                                )
+                        elif (
+                            table_status[table]["threads_finished"] > 0
+                            and table_status[table]["links_finished"] == 0
+                        ):
+                            if table_errors(report[table]) == {}:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                    "[Completed]",
+                                    "| Backfilled links:",
+                                    report[table]["links"],
+                                )
+                            else:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                    "[Completed]",
+                                    "| Backfilled links:",
+                                    report[table]["links"],
+                                    "Errors:",
+                                    table_errors(report[table]),
+                                )
+                        elif (
+                            table_status[table]["links_finished"] == 0
+                            and table_status[table]["threads_finished"] == 0
+                        ):
+                            if table_errors(report[table]) == {}:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                    "| Backfilled links:",
+                                    report[table]["links"],
+                                )
+                            else:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                    "| Backfilled links:",
+                                    report[table]["links"],
+                                    "Errors:",
+                                    table_errors(report[table]),
+                                )
                     else:
-                        if report[table]["errors"] == {}:
-                            print(
-                                table,
-                                ":",
-                                report[table]["records"],
-                                "/",
-                                table_status[table]["records_summary"],
-                                "[Completed]",
-                            )
+                        if table_status[table]["threads_finished"] == 0:
+                            if table_errors(report[table]) == {}:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                )
+                            else:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                    "Errors:",
+                                    table_errors(report[table]),
+                                )
                         else:
-                            print(
-                                table,
-                                ":",
-                                report[table]["records"],
-                                "/",
-                                table_status[table]["records_summary"],
-                                "[Completed]",
-                                "Errors:",
-                                report[table]["errors"],
-                            )
+                            if table_errors(report[table]) == {}:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                    "[Completed]",
+                                )
+                            else:
+                                print(
+                                    table,
+                                    ":",
+                                    report[table]["records"],
+                                    "/",
+                                    table_status[table]["records_summary"],
+                                    "[Completed]",
+                                    "Errors:",
+                                    table_errors(report[table]),
+                                )
         all_finished = True
         for table in tables:
+            table_finished = True
             if "threads_finished" in table_status[table]:
-                if table_status[table]["threads_finished"] != CONCURRENT_CONSUMERS:
-                    all_finished = False
+                if table_status[table]["threads_finished"] == 0:
+                    table_finished = False
             # Only check for link completion when the output is Xata. When writting to file, links are written with a single pass, we do not backfill links,
             if ("links_finished" in table_status[table]) and output == "xata":
-                if table_status[table]["links_finished"] != CONCURRENT_CONSUMERS:
-                    all_finished = False
-        print("Elapsed:", datetime.now() - start)
+                if table_status[table]["links_finished"] == 0:
+                    table_finished = False
+            if "files_finished" in table_status[table]:
+                if table_status[table]["files_finished"] == 0:
+                    table_finished = False
+            if not table_finished:
+                all_finished = False
+            elif table not in completed_tables:
+                completed_tables.add(table)
+                if run_metrics is not None:
+                    run_metrics.finish(table)
+                if HEADLESS:
+                    line = [datetime.now().isoformat(timespec="seconds"), table, ":", report[table]["records"], "records"]
+                    if report[table].get("links", 0) > 0:
+                        line += ["and", report[table]["links"], "links backfilled"]
+                    if report[table].get("files", 0) > 0:
+                        line += ["and", report[table]["files"], "files copied"]
+                    line += ["[Completed]"]
+                    if table_errors(report[table]) != {}:
+                        line += ["Errors:", table_errors(report[table])]
+                    print(*line)
+        if not HEADLESS:
+            if len(file_tables) > 0:
+                files_sum = sum(report[table]["files"] for table in file_tables)
+                if all(table_status[table]["files_finished"] > 0 for table in file_tables):
+                    print("Attachments:", files_sum, "files copied", "[Completed]")
+                else:
+                    print("Attachments:", files_sum, "files copied")
+            print("Elapsed:", str(datetime.now() - start) + throttling_status())
         if all_finished == True:
             records_sum = 0
             links_sum = 0
@@ -731,9 +1377,8 @@ def reporter(
                     records_sum += report[table]["records"]
                 if "links" in report[table]:
                     links_sum += report[table]["links"]
-                if "errors" in report[table]:
-                    if report[table]["errors"] != {}:
-                        suggest_check_errorlog = True
+                if table_errors(report[table]) != {}:
+                    suggest_check_errorlog = True
             if links_sum == 0:
                 print(
                     "Data transfer completed. Processed", records_sum, "records total."
@@ -746,6 +1391,12 @@ def reporter(
                     links_sum,
                     "records with links.",
                 )
+            if len(file_tables) > 0:
+                print(
+                    "Copied",
+                    sum(report[table]["files"] for table in file_tables),
+                    "attachments.",
+                )
             if suggest_check_errorlog == True:
                 print("Check error log", ERROR_FILE, "for details of failed requests.")
             break
@@ -0,0 +1,197 @@
+import json
+import hashlib
+from datetime import datetime
+from threading import Thread
+from threads import initial_query, query_pages, read_ahead, flatten_record, map_concurrently, COUNT_CONCURRENCY
+
+# Source and target tables are scanned in parallel with the projection of the copy, each record is hashed and summed into the bucket of its id prefix.
+# Only the buckets whose counts or digests differ are scanned again, filtered on their id prefix, to find the records that are missing, extra or different.
+# When too many buckets differ, for instance in an empty or diverged target, the whole table is scanned once more and all ids are compared instead.
+
+# Generated ids share this prefix, buckets are made of the first characters that follow it
+ID_PREFIX = "rec_"
+# Mismatched buckets scanned again one by one, past this number the ids of the whole table are compared
+MAX_DRILLED_BUCKETS = 32
+
+
+def id_bucket(record_id, prefix_length):
+    # Id prefix of the bucket of a record
+    if record_id.startswith(ID_PREFIX):
+        return record_id[: len(ID_PREFIX) + prefix_length]
+    return record_id[:prefix_length]
+
+
+def record_digest(record):
+    # Digest of the record content as canonical JSON, without the xata metadata
+    content = {column: record[column] for column in record if column != "xata"}
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), default=str)
+    return int.from_bytes(hashlib.sha256(canonical.encode("utf-8")).digest()[:8], "big")
+
+
+def scan(side, table, query_payload, ERROR_FILE, PREFETCH=0):
+    # Pages of the table on the source or target side, with the query of the next page, None after the last one
+    pages = query_pages(
+        query_payload, side["key"], side["url"], table, ERROR_FILE, side["host_header"]
+    )
+    if PREFETCH > 0:
+        pages = read_ahead(pages, PREFETCH)
+    return pages
+
+
+def bucket_digests(side, table, query_payload, schema_links, schema_files, ERROR_FILE, prefix_length, PREFETCH=0):
+    # Count and sum of the record digests per id prefix, the sum does not depend on the scroll order. Also returns whether the scroll reached the last page.
+    buckets = {}
+    complete = False
+    for records, next_query in scan(side, table, query_payload, ERROR_FILE, PREFETCH):
+        for record in records:
+            record = flatten_record(record, table, schema_links, schema_files)
+            bucket = buckets.setdefault(id_bucket(record["id"], prefix_length), [0, 0])
+            bucket[0] += 1
+            bucket[1] = (bucket[1] + record_digest(record)) % (1 << 64)
+        complete = next_query is None
+    return buckets, complete
+
+
+def record_digests(side, table, query_payload, schema_links, schema_files, ERROR_FILE, prefix, prefix_length, PREFETCH=0):
+    # Digest of each record of a bucket, or of the whole table when the prefix is None
+    digests = {}
+    complete = False
+    for records, next_query in scan(side, table, query_payload, ERROR_FILE, PREFETCH):
+        for record in records:
+            record = flatten_record(record, table, schema_links, schema_files)
+            # ids shorter than the prefix length are their own bucket, but also match the filter of longer prefixes
+            if prefix is None or id_bucket(record["id"], prefix_length) == prefix:
+                digests[record["id"]] = record_digest(record)
+        complete = next_query is None
+    return digests, complete
+
+
+def in_parallel(source_target):
+    # Run the source and the target function at once, returns both results
+    results = [None, None]
+
+    def run(position):
+        results[position] = source_target[position]()
+
+    scanners = [Thread(target=run, args=(position,)) for position in range(2)]
+    for scanner in scanners:
+        scanner.start()
+    for scanner in scanners:
+        scanner.join()
+    return results
+
+
+def verify_table(
+    source,
+    target,
+    table,
+    PAGE_SIZE,
+    columns,
+    schema_links,
+    schema_files,
+    ERROR_FILE,
+    prefix_length=6,
+    PREFETCH=0,
+):
+    query_payload = initial_query(PAGE_SIZE, table, schema_links, columns=columns)
+    (source_buckets, source_complete), (target_buckets, target_complete) = in_parallel(
+        [
+            lambda: bucket_digests(source, table, query_payload, schema_links, schema_files, ERROR_FILE, prefix_length, PREFETCH),
+            lambda: bucket_digests(target, table, query_payload, schema_links, schema_files, ERROR_FILE, prefix_length, PREFETCH),
+        ]
+    )
+    result = {
+        "source": sum(bucket[0] for bucket in source_buckets.values()),
+        "target": sum(bucket[0] for bucket in target_buckets.values()),
+        "buckets": len(set(source_buckets) | set(target_buckets)),
+        "mismatched_buckets": 0,
+        "missing": [],
+        "extra": [],
+        "different": [],
+        "complete": source_complete and target_complete,
+    }
+    mismatched = sorted(
+        prefix
+        for prefix in set(source_buckets) | set(target_buckets)
+        if source_buckets.get(prefix) != target_buckets.get(prefix)
+    )
+    result["mismatched_buckets"] = len(mismatched)
+    # Drill down into the mismatched buckets only, or compare all ids when most of the table would be scanned again bucket by bucket
+    if len(mismatched) > MAX_DRILLED_BUCKETS:
+        drilled = [None]
+    else:
+        drilled = mismatched
+    for prefix in drilled:
+        bucket_query = query_payload
+        if prefix is not None:
+            bucket_query = initial_query(
+                PAGE_SIZE,
+                table,
+                schema_links,
+                partition_filter={"id": {"$startsWith": prefix}},
+                columns=columns,
+            )
+        (source_digests, source_complete), (target_digests, target_complete) = in_parallel(
+            [
+                lambda: record_digests(source, table, bucket_query, schema_links, schema_files, ERROR_FILE, prefix, prefix_length, PREFETCH),
+                lambda: record_digests(target, table, bucket_query, schema_links, schema_files, ERROR_FILE, prefix, prefix_length, PREFETCH),
+            ]
+        )
+        result["complete"] = result["complete"] and source_complete and target_complete
+        for record_id in sorted(source_digests):
+            if record_id not in target_digests:
+                result["missing"].append(record_id)
+            elif source_digests[record_id] != target_digests[record_id]:
+                result["different"].append(record_id)
+        for record_id in sorted(target_digests):
+            if record_id not in source_digests:
+                result["extra"].append(record_id)
+    return result
+
+
+def verify(
+    tables,
+    source,
+    target,
+    PAGE_SIZE,
+    table_columns,
+    schema_links,
+    schema_files,
+    ERROR_FILE,
+    prefix_length=6,
+    PREFETCH=0,
+    concurrency=COUNT_CONCURRENCY,
+):
+    # Verify a few tables at once, returns the result of each table
+    results = map_concurrently(
+        lambda table: verify_table(
+            source,
+            target,
+            table,
+            PAGE_SIZE,
+            table_columns[table],
+            schema_links,
+            schema_files,
+            ERROR_FILE,
+            prefix_length,
+            PREFETCH,
+        ),
+        tables,
+        concurrency,
+    )
+    # Log the ids of all differing records, only a sample is printed
+    with open(ERROR_FILE, "a") as f:
+        for table in tables:
+            for kind in ("missing", "extra", "different"):
+                for record_id in results[table][kind]:
+                    f.write(
+                        str(datetime.now().isoformat())
+                        + " Verify "
+                        + table
+                        + " "
+                        + kind
+                        + " record "
+                        + record_id
+                        + "\n"
+                    )
+    return results
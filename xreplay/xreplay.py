@@ -1,24 +1,80 @@
 #! /usr/bin/env python
 
 import os
+import sys
 import argparse
-from methods import get, post, put
-from threads import producer, consumer, reporter
-from strategy import compute_table_link_depth
+from methods import (
+    get,
+    post,
+    put,
+    configure_sessions,
+    session_stats,
+    configure_limiters,
+    limiter_stats,
+    configure_codec,
+    configure_retries,
+    breaker_stats,
+    orjson,
+    zstandard,
+)
+import deadletters
+from threads import (
+    producer,
+    reporter,
+    TableWriter,
+    WriterPool,
+    record_counter,
+    map_concurrently,
+    COUNT_CONCURRENCY,
+    backfill_modes,
+    store_producer,
+    resumed_reports,
+    report_key,
+    high_water_mark,
+    delete_missing,
+    drain_reports,
+    query_columns,
+)
+from linkstore import LinkStore, remove_store
+from attachments import FilePool, copy_files
+from checkpoint import Checkpoint, load_marks, save_marks
+from verify import verify
+from plan import probe, count_tables, estimate, table_order, LINK_DEPTH
+from processes import (
+    assign_tables,
+    ASSIGNMENT_WAIT,
+    ReportSender,
+    WorkerCheckpoint,
+    reset_after_fork,
+    watch_parent,
+    telemetry_sender,
+    gauge_sender,
+    process_stats,
+    collect,
+    merge_stats,
+)
+from strategy import compute_table_dependencies, compute_table_link_depth
+from asyncio_engine import replay_tables, aiohttp
+import asyncio
+import multiprocessing
+import signal
 from time import sleep
-from threading import Thread
+from threading import Thread, Event
+import telemetry
+import metrics
 from queue import Queue
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 from operator import itemgetter
 
 parser = argparse.ArgumentParser()
 
 # Adding mandatory argument
-parser.add_argument("--from_workspace", help="Source workspace id", required=True)
-parser.add_argument("--from_database", help="Source database name", required=True)
-parser.add_argument("--from_branch", help="Source branch name", required=True)
-parser.add_argument("--from_region", help="Source region name", required=True)
+# Source arguments and output are mandatory unless dead letters are replayed
+parser.add_argument("--from_workspace", help="Source workspace id", required=False)
+parser.add_argument("--from_database", help="Source database name", required=False)
+parser.add_argument("--from_branch", help="Source branch name", required=False)
+parser.add_argument("--from_region", help="Source region name", required=False)
 parser.add_argument(
     "--from_XATA_API_KEY", help="Xata API key for the source workspace", required=False
 )
@@ -33,7 +89,27 @@ parser.add_argument(
 )
 parser.add_argument(
     "--concurrency",
-    help="Number of concurrent writer threads per table. Range is 1 to 10.",
+    help="Number of writers budgeted per table to size the writer pool when --writers is not given. The pool is shared by all tables, any writer writes batches of any table. Range is 1 to 10, or 1 to 500 with the asyncio engine.",
+    required=False,
+)
+parser.add_argument(
+    "--writers",
+    help="Number of writer threads shared by all tables. Range is 1 to 100, or 1 to 5000 writer coroutines with the asyncio engine. Default: concurrency times the number of tables, up to the maximum.",
+    required=False,
+)
+parser.add_argument(
+    "--engine",
+    help="Run producers and consumers as threads, or as coroutines on a single event loop. Options: threads,asyncio. Default: threads",
+    required=False,
+)
+parser.add_argument(
+    "--processes",
+    help="Number of worker processes the tables are split between, each with its own producers and writers, to parse and encode records on several cores. Only with the threads engine. Range is 1 to 64. Default 1.",
+    required=False,
+)
+parser.add_argument(
+    "--inflight",
+    help="Maximum number of concurrent requests across all tables with the asyncio engine. Range is 1 to 1000. Default 100.",
     required=False,
 )
 parser.add_argument(
@@ -41,21 +117,106 @@ parser.add_argument(
     help="Number of records per write request. Range is 1 to 1000.",
     required=False,
 )
+parser.add_argument(
+    "--bulk_bytes",
+    help="Maximum estimated size in bytes of the records of a write request, before compression. Range is 1024 to 100000000, 0 disables the limit. Default 4000000.",
+    required=False,
+)
 parser.add_argument(
     "--page_size",
     help="Number of records to fetch in each page of the scroll request. Range is 1 to 200.",
     required=False,
 )
+parser.add_argument(
+    "--partitions",
+    help="Number of concurrent scroll cursors per table, each reading a range of record creation times. Range is 1 to 32. Default 1.",
+    required=False,
+)
+parser.add_argument(
+    "--prefetch",
+    help="Number of scroll pages to request ahead of processing for each cursor. Range is 0 to 10. Default 2.",
+    required=False,
+)
 parser.add_argument(
     "--queue_size",
-    help="Number of inflight events we can store in the memory queue. Range is page_size to 10000.",
+    help="Number of inflight records we can store in the memory queue. Range is page_size to 10000.",
+    required=False,
+)
+parser.add_argument(
+    "--max_request_rate",
+    help="Maximum number of requests per second per host. The rate is lowered automatically when requests are throttled. Default 1000.",
+    required=False,
+)
+parser.add_argument(
+    "--compression",
+    help="Compress request bodies larger than 1KB. Options: none,gzip,zstd. Default: none",
+    required=False,
+)
+parser.add_argument(
+    "--json_codec",
+    help="JSON encoder and decoder for request and response bodies. Options: auto,json,orjson. Default: auto, which uses orjson when it is installed",
+    required=False,
+)
+parser.add_argument(
+    "--telemetry_file",
+    help="File path to write per endpoint request telemetry to as JSON, at intervals and at the end of the run.",
+    required=False,
+)
+parser.add_argument(
+    "--telemetry_interval",
+    help="Number of seconds between telemetry file updates. Default 60.",
+    required=False,
+)
+parser.add_argument(
+    "--report_interval",
+    help="Number of seconds between refreshes of the progress report. Default 1.",
+    required=False,
+)
+parser.add_argument(
+    "--headless",
+    help="Do not redraw the progress report, for runs without a terminal. Metrics are written as JSON lines to the metrics file, stdout by default, and the other output is printed to stderr.",
+    action="store_true",
+)
+parser.add_argument(
+    "--metrics_file",
+    help="File path to append progress metrics to as JSON lines, - for stdout with --headless. Default stdout with --headless, none otherwise.",
+    required=False,
+)
+parser.add_argument(
+    "--metrics_interval",
+    help="Number of seconds between metrics lines. Default 10.",
+    required=False,
+)
+parser.add_argument(
+    "--prometheus_port",
+    help="Serve progress metrics in the Prometheus text format on this local port at /metrics.",
+    required=False,
+)
+parser.add_argument(
+    "--summary_file",
+    help="File path to write a JSON summary of the run to, with the duration and throughput of each table.",
+    required=False,
+)
+parser.add_argument(
+    "--max_retries",
+    help="Number of times a request is retried upon connection, throttling or gateway errors before its batch is written to the dead letter file. Default 10.",
+    required=False,
+)
+parser.add_argument(
+    "--dead_letter_file",
+    help="File path to write failed write batches to, one JSON object per line.",
+    required=False,
+)
+parser.add_argument(
+    "--replay_dead_letters",
+    help="Send the batches of a dead letter file to the destination branch again, then exit.",
     required=False,
 )
 parser.add_argument("--error_file", help="File path to output errors.", required=False)
 parser.add_argument(
     "--output",
     help="Where to output records: xata or local files. Options: xata,file",
-    required=True,
+    required=False,
 )
 parser.add_argument(
     "--output_path", help="Directory to write record content to.", required=False
@@ -68,6 +229,71 @@ parser.add_argument(
     help="How to backfill links: bulk updates using transactions, bulk rewrite entire records, atomic link column updates. Options: transaction,bulk,atomic. Default: transaction",
     required=False,
 )
+parser.add_argument(
+    "--file_concurrency",
+    help="Number of threads streaming the content of file and file[] columns from the source to the target, shared by all tables. Range is 0 to 100, 0 does not copy attachments. Default 4.",
+    required=False,
+)
+parser.add_argument(
+    "--link_store_file",
+    help="File path of the local SQLite store that keeps the links of cycles between the copy and the backfill. Removed at the end of the run.",
+    required=False,
+)
+parser.add_argument(
+    "--state_file",
+    help="File path to save the progress of the run to, so that it can be resumed with --resume. Default: logs/state-<to_workspace>-<to_database>-<to_branch>.json",
+    required=False,
+)
+parser.add_argument(
+    "--resume",
+    help="Resume an interrupted run from its state file, into the target branch it already created.",
+    action="store_true",
+)
+parser.add_argument(
+    "--incremental",
+    help="Sync the records updated since the previous run into the existing target branch, instead of copying all records into a new one.",
+    action="store_true",
+)
+parser.add_argument(
+    "--delete_missing",
+    help="With --incremental, also delete the target records whose id is no longer in the source.",
+    action="store_true",
+)
+parser.add_argument(
+    "--sync_file",
+    help="File path of the update times reached by the last completed run, where incremental syncs start from. Default: logs/sync-<to_workspace>-<to_database>-<to_branch>.json",
+    required=False,
+)
+parser.add_argument(
+    "--follow",
+    help="Keep running after the copy, and sync the records updated in the source into the target at every poll interval.",
+    action="store_true",
+)
+parser.add_argument(
+    "--follow_interval",
+    help="Number of seconds between polls of the source tables with --follow. Default 5.",
+    required=False,
+)
+parser.add_argument(
+    "--verify",
+    help="Compare the records of the source and target branches instead of copying, then exit.",
+    action="store_true",
+)
+parser.add_argument(
+    "--verify_prefix_length",
+    help="Number of id characters after rec_ that records are grouped by when verifying. Range is 1 to 32. Default 6.",
+    required=False,
+)
+parser.add_argument(
+    "--plan",
+    help="Print the table dependencies, the record counts and sizes, and the requests and time a copy is estimated to take, then exit. Nothing is written to the destination.",
+    action="store_true",
+)
+parser.add_argument(
+    "--checkpoint_interval",
+    help="Number of seconds between state file updates. Default 10.",
+    required=False,
+)
 parser.add_argument(
     "--custom_source",
     help="Using a custom source instead of Xata's Production endpoints",
@@ -96,6 +322,33 @@ parser.add_argument(
 
 args = parser.parse_args()
 
+if args.replay_dead_letters:
+    REPLAY_DEAD_LETTERS = str(args.replay_dead_letters)
+    if not os.path.isfile(REPLAY_DEAD_LETTERS):
+        print("Error: Dead letter file", REPLAY_DEAD_LETTERS, "does not exist.")
+        exit(-1)
+    args.output = "xata"
+else:
+    REPLAY_DEAD_LETTERS = ""
+    # Verification reads the target branch like a copy to Xata would write it
+    if args.verify:
+        args.output = "xata"
+    missing_arguments = [
+        "--" + argument
+        for argument in [
+            "from_workspace",
+            "from_database",
+            "from_branch",
+            "from_region",
+            "output",
+        ]
+        if getattr(args, argument) is None
+    ]
+    if len(missing_arguments) > 0:
+        parser.error(
+            "the following arguments are required: " + ", ".join(missing_arguments)
+        )
+
 if str(args.output).lower() == "xata":
     OUTPUT = "xata"
     OUTPUT_PATH = ""
@@ -110,7 +363,9 @@ else:
     print("Please specify a valid --output target value (xata or file).")
     exit(-1)
 
-if not args.from_XATA_API_KEY:
+if REPLAY_DEAD_LETTERS != "":
+    from_XATA_API_KEY = ""
+elif not args.from_XATA_API_KEY:
     try:
         from_XATA_API_KEY = str(os.environ["from_XATA_API_KEY"])
     except KeyError:
@@ -181,28 +436,85 @@ elif OUTPUT == "file":
         if not OUTPUT_PATH.endswith("/"):
             OUTPUT_PATH += "/"
 
+if not args.engine or str(args.engine).lower() == "threads":
+    ENGINE = "threads"
+    MAX_CONCURRENCY = 10
+    MAX_WRITERS = 100
+elif str(args.engine).lower() == "asyncio":
+    ENGINE = "asyncio"
+    MAX_CONCURRENCY = 500
+    MAX_WRITERS = 5000
+    if aiohttp is None:
+        print("Error: The asyncio engine requires the aiohttp package to be installed.")
+        exit(-1)
+    if OUTPUT != "xata":
+        print("Error: The asyncio engine is only available when the output is xata.")
+        exit(-1)
+else:
+    print("Error: engine should be one of threads or asyncio.")
+    exit(-1)
+
 if not args.concurrency and OUTPUT == "xata":
     CONCURRENT_CONSUMERS = 2
 elif OUTPUT == "file":
     CONCURRENT_CONSUMERS = 1
-elif int(args.concurrency) >= 1 and int(args.concurrency) <= 10:
+elif int(args.concurrency) >= 1 and int(args.concurrency) <= MAX_CONCURRENCY:
     CONCURRENT_CONSUMERS = int(args.concurrency)
 else:
-    print("Error: Concurrency should be between 1 and 10.")
+    print("Error: Concurrency should be between 1 and", str(MAX_CONCURRENCY) + ".")
+    exit(-1)
+
+if not args.writers:
+    WRITERS = None
+elif int(args.writers) >= 1 and int(args.writers) <= MAX_WRITERS:
+    WRITERS = int(args.writers)
+else:
+    print("Error: Writers should be between 1 and", str(MAX_WRITERS) + ".")
+    exit(-1)
+
+if not args.processes:
+    PROCESSES = 1
+elif int(args.processes) >= 1 and int(args.processes) <= 64:
+    PROCESSES = int(args.processes)
+else:
+    print("Error: Processes should be between 1 and 64.")
+    exit(-1)
+if PROCESSES > 1:
+    if ENGINE != "threads":
+        print("Error: Worker processes are only available with the threads engine.")
+        exit(-1)
+    # Workers are forked, so that they start with the schema and settings of the main process
+    if "fork" not in multiprocessing.get_all_start_methods():
+        print("Error: Worker processes are not available on this platform.")
+        exit(-1)
+    process_context = multiprocessing.get_context("fork")
+
+if not args.inflight:
+    MAX_INFLIGHT_REQUESTS = 100
+elif int(args.inflight) >= 1 and int(args.inflight) <= 1000:
+    MAX_INFLIGHT_REQUESTS = int(args.inflight)
+else:
+    print("Error: Inflight requests should be between 1 and 1000.")
     exit(-1)
 
 if not args.bulk_size:
     BULK_SIZE = 100
 elif int(args.bulk_size) >= 1 and int(args.bulk_size) <= 1000:
     BULK_SIZE = int(args.bulk_size)
-    if BULK_SIZE > 500:
-        print(
-            "Warning: You have configured a large bulk size. If there are large records in the tables to copy, you could reach the transaction size limit. In case errors occur, consider retrying with a smaller bulk size."
-        )
 else:
     print("Error: Bulk size should be between 1 and 1000.")
     exit(-1)
 
+if not args.bulk_bytes:
+    BULK_BYTES = 4000000
+elif int(args.bulk_bytes) == 0 or (
+    int(args.bulk_bytes) >= 1024 and int(args.bulk_bytes) <= 100000000
+):
+    BULK_BYTES = int(args.bulk_bytes)
+else:
+    print("Error: Bulk bytes should be 0 or between 1024 and 100000000.")
+    exit(-1)
+
 if not args.page_size:
     PAGE_SIZE = 200
 elif int(args.page_size) >= 1 and int(args.page_size) <= 200:
@@ -211,6 +523,22 @@ else:
     print("Error: Page size should be between 1 and 200.")
     exit(-1)
 
+if not args.partitions:
+    PARTITIONS = 1
+elif int(args.partitions) >= 1 and int(args.partitions) <= 32:
+    PARTITIONS = int(args.partitions)
+else:
+    print("Error: Partitions should be between 1 and 32.")
+    exit(-1)
+
+if not args.prefetch:
+    PREFETCH = 2
+elif int(args.prefetch) >= 0 and int(args.prefetch) <= 10:
+    PREFETCH = int(args.prefetch)
+else:
+    print("Error: Prefetch should be between 0 and 10 pages.")
+    exit(-1)
+
 if not args.queue_size:
     MAX_QUEUE_SIZE = 1000
 elif int(args.queue_size) >= PAGE_SIZE and int(args.queue_size) <= 10000:
@@ -223,6 +551,51 @@ else:
     )
     exit(-1)
 
+if not args.max_request_rate:
+    MAX_REQUEST_RATE = 1000
+elif float(args.max_request_rate) >= 1:
+    MAX_REQUEST_RATE = float(args.max_request_rate)
+else:
+    print("Error: Max request rate should be at least 1 request per second.")
+    exit(-1)
+configure_limiters(MAX_REQUEST_RATE)
+
+if not args.compression or str(args.compression).lower() == "none":
+    COMPRESSION = "none"
+elif str(args.compression).lower() == "gzip":
+    COMPRESSION = "gzip"
+elif str(args.compression).lower() == "zstd":
+    if zstandard is None:
+        print("Error: zstd compression requires the zstandard package to be installed.")
+        exit(-1)
+    COMPRESSION = "zstd"
+else:
+    print("Error: compression should be one of none, gzip or zstd.")
+    exit(-1)
+
+if not args.json_codec or str(args.json_codec).lower() == "auto":
+    JSON_CODEC = "orjson" if orjson is not None else "json"
+elif str(args.json_codec).lower() == "json":
+    JSON_CODEC = "json"
+elif str(args.json_codec).lower() == "orjson":
+    if orjson is None:
+        print("Error: The orjson codec requires the orjson package to be installed.")
+        exit(-1)
+    JSON_CODEC = "orjson"
+else:
+    print("Error: json_codec should be one of auto, json or orjson.")
+    exit(-1)
+configure_codec(JSON_CODEC, COMPRESSION)
+
+if not args.max_retries:
+    MAX_RETRIES = 10
+elif int(args.max_retries) >= 0:
+    MAX_RETRIES = int(args.max_retries)
+else:
+    print("Error: Max retries should be 0 or more.")
+    exit(-1)
+configure_retries(MAX_RETRIES)
+
 if not args.error_file:
     ERROR_FILE = (
         "logs/debug-"
@@ -245,6 +618,131 @@ except:
     print("Cannot open or create error log file", ERROR_FILE)
     exit(-1)
 
+if not args.dead_letter_file:
+    DEAD_LETTER_FILE = (
+        "logs/deadletters-"
+        + TO_WORKSPACE
+        + "-"
+        + TO_DATABASE
+        + "-"
+        + TO_BRANCH
+        + "-"
+        + str(datetime.now().isoformat(timespec="seconds"))
+        + ".ndjson"
+    )
+else:
+    DEAD_LETTER_FILE = str(args.dead_letter_file)
+if os.path.abspath(DEAD_LETTER_FILE) == os.path.abspath(REPLAY_DEAD_LETTERS or "."):
+    print("Error: Dead letters cannot be replayed into the same dead letter file.")
+    exit(-1)
+try:
+    if os.path.dirname(DEAD_LETTER_FILE) != "":
+        os.makedirs(os.path.dirname(DEAD_LETTER_FILE), exist_ok=True)
+except:
+    print("Cannot access or create dead letter file directory for", DEAD_LETTER_FILE)
+    exit(-1)
+
+if not args.link_store_file:
+    LINK_STORE_FILE = (
+        "logs/links-"
+        + TO_WORKSPACE
+        + "-"
+        + TO_DATABASE
+        + "-"
+        + TO_BRANCH
+        + "-"
+        + str(datetime.now().isoformat(timespec="seconds"))
+        + ".sqlite"
+    )
+else:
+    LINK_STORE_FILE = str(args.link_store_file)
+
+if not args.state_file:
+    STATE_FILE = (
+        "logs/state-" + TO_WORKSPACE + "-" + TO_DATABASE + "-" + TO_BRANCH + ".json"
+    )
+else:
+    STATE_FILE = str(args.state_file)
+if args.resume:
+    if OUTPUT != "xata":
+        print("Error: Resume is only available when the output is xata.")
+        exit(-1)
+    if not os.path.isfile(STATE_FILE):
+        print("Error: State file", STATE_FILE, "does not exist, there is no run to resume.")
+        exit(-1)
+    RESUME = True
+else:
+    RESUME = False
+if OUTPUT == "xata":
+    try:
+        if os.path.dirname(STATE_FILE) != "":
+            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    except:
+        print("Cannot access or create state file directory for", STATE_FILE)
+        exit(-1)
+
+if args.incremental:
+    if OUTPUT != "xata":
+        print("Error: Incremental syncs are only available when the output is xata.")
+        exit(-1)
+    INCREMENTAL = True
+else:
+    INCREMENTAL = False
+if args.delete_missing and not INCREMENTAL:
+    print("Error: Deleted records are only synced with --incremental.")
+    exit(-1)
+DELETE_MISSING = bool(args.delete_missing)
+if not args.sync_file:
+    SYNC_FILE = (
+        "logs/sync-" + TO_WORKSPACE + "-" + TO_DATABASE + "-" + TO_BRANCH + ".json"
+    )
+else:
+    SYNC_FILE = str(args.sync_file)
+if OUTPUT == "xata":
+    try:
+        if os.path.dirname(SYNC_FILE) != "":
+            os.makedirs(os.path.dirname(SYNC_FILE), exist_ok=True)
+    except:
+        print("Cannot access or create sync file directory for", SYNC_FILE)
+        exit(-1)
+
+if args.follow:
+    if OUTPUT != "xata":
+        print("Error: Following changes is only available when the output is xata.")
+        exit(-1)
+    FOLLOW = True
+else:
+    FOLLOW = False
+if not args.follow_interval:
+    FOLLOW_INTERVAL = 5
+elif float(args.follow_interval) > 0:
+    FOLLOW_INTERVAL = float(args.follow_interval)
+else:
+    print("Error: Follow interval should be a positive number of seconds.")
+    exit(-1)
+
+VERIFY = bool(args.verify)
+if not args.verify_prefix_length:
+    VERIFY_PREFIX_LENGTH = 6
+elif int(args.verify_prefix_length) >= 1 and int(args.verify_prefix_length) <= 32:
+    VERIFY_PREFIX_LENGTH = int(args.verify_prefix_length)
+else:
+    print("Error: Verify prefix length should be between 1 and 32.")
+    exit(-1)
+
+PLAN = bool(args.plan)
+if PLAN and (RESUME or VERIFY or REPLAY_DEAD_LETTERS != ""):
+    print("Error: --plan cannot be combined with --resume, --verify or --replay_dead_letters.")
+    exit(-1)
+
+if not args.checkpoint_interval:
+    CHECKPOINT_INTERVAL = 10
+elif float(args.checkpoint_interval) > 0:
+    CHECKPOINT_INTERVAL = float(args.checkpoint_interval)
+else:
+    print("Error: Checkpoint interval should be a positive number of seconds.")
+    exit(-1)
+
 if not args.links_backfill_method:
     BACKFILL = "bulk_transaction"
 elif str(args.links_backfill_method).lower() == "bulk":
@@ -257,6 +755,92 @@ else:
     print("Error: links_backfill_method should be one of bulk or atomic.")
     exit(-1)
 
+# Attachments are only copied to Xata, they are not written to file
+if OUTPUT != "xata":
+    FILE_CONCURRENCY = 0
+elif not args.file_concurrency:
+    FILE_CONCURRENCY = 4
+elif int(args.file_concurrency) >= 0 and int(args.file_concurrency) <= 100:
+    FILE_CONCURRENCY = int(args.file_concurrency)
+else:
+    print("Error: File concurrency should be between 0 and 100.")
+    exit(-1)
+
+if not args.telemetry_file:
+    TELEMETRY_FILE = ""
+else:
+    TELEMETRY_FILE = str(args.telemetry_file)
+    try:
+        if os.path.dirname(TELEMETRY_FILE) != "":
+            os.makedirs(os.path.dirname(TELEMETRY_FILE), exist_ok=True)
+        open(TELEMETRY_FILE, "w+")
+    except:
+        print("Cannot open or create telemetry file", TELEMETRY_FILE)
+        exit(-1)
+
+if not args.telemetry_interval:
+    TELEMETRY_INTERVAL = 60
+elif float(args.telemetry_interval) > 0:
+    TELEMETRY_INTERVAL = float(args.telemetry_interval)
+else:
+    print("Error: Telemetry interval should be a positive number of seconds.")
+    exit(-1)
+
+if not args.report_interval:
+    REPORT_INTERVAL = 1
+elif float(args.report_interval) > 0:
+    REPORT_INTERVAL = float(args.report_interval)
+else:
+    print("Error: Report interval should be a positive number of seconds.")
+    exit(-1)
+
+HEADLESS = bool(args.headless)
+if args.metrics_file:
+    METRICS_FILE = str(args.metrics_file)
+elif HEADLESS:
+    METRICS_FILE = "-"
+else:
+    METRICS_FILE = ""
+if METRICS_FILE == "-" and not HEADLESS:
+    print("Error: Metrics are only written to stdout with --headless, the progress report is printed there otherwise.")
+    exit(-1)
+if HEADLESS:
+    # Stdout is left to the metrics, so that they can be read line by line. The settings, completed tables and statistics are printed to stderr.
+    sys.stdout = sys.stderr
+if METRICS_FILE not in ("", "-"):
+    try:
+        if os.path.dirname(METRICS_FILE) != "":
+            os.makedirs(os.path.dirname(METRICS_FILE), exist_ok=True)
+        open(METRICS_FILE, "a")
+    except:
+        print("Cannot open or create metrics file", METRICS_FILE)
+        exit(-1)
+if not args.metrics_interval:
+    METRICS_INTERVAL = 10
+elif float(args.metrics_interval) > 0:
+    METRICS_INTERVAL = float(args.metrics_interval)
+else:
+    print("Error: Metrics interval should be a positive number of seconds.")
+    exit(-1)
+if not args.prometheus_port:
+    PROMETHEUS_PORT = 0
+elif int(args.prometheus_port) >= 1 and int(args.prometheus_port) <= 65535:
+    PROMETHEUS_PORT = int(args.prometheus_port)
+else:
+    print("Error: Prometheus port should be between 1 and 65535.")
+    exit(-1)
+if not args.summary_file:
+    SUMMARY_FILE = ""
+else:
+    SUMMARY_FILE = str(args.summary_file)
+    try:
+        if os.path.dirname(SUMMARY_FILE) != "":
+            os.makedirs(os.path.dirname(SUMMARY_FILE), exist_ok=True)
+        open(SUMMARY_FILE, "a")
+    except:
+        print("Cannot open or create summary file", SUMMARY_FILE)
+        exit(-1)
+
 if OUTPUT == "file":
     try:
         os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
@@ -335,6 +919,32 @@ else:
         + TO_DATABASE
     )
 
+# Size the connection pools before the first request for the requests sent before the copy: the summarize requests of all tables and the verification or plan probes. They are resized once the tables and writers are known.
+configure_sessions(max(COUNT_CONCURRENCY, CONCURRENT_CONSUMERS + 1))
+
+if REPLAY_DEAD_LETTERS != "":
+    print("\n>>> Xata Replay tool <<<\n")
+    print("Replaying dead letters from", REPLAY_DEAD_LETTERS, "to", to_BRANCH_URL)
+    replayed, failed = deadletters.replay(
+        REPLAY_DEAD_LETTERS,
+        to_XATA_API_KEY,
+        to_BRANCH_URL,
+        BULK_SIZE,
+        ERROR_FILE,
+        DEAD_LETTER_FILE,
+        destination_host_header,
+    )
+    print("Replayed", replayed, "records,", failed, "failed.")
+    if failed > 0:
+        print(
+            "Failed batches were written to",
+            DEAD_LETTER_FILE,
+            "and details to the error log",
+            ERROR_FILE,
+        )
+        exit(-1)
+    exit(0)
+
 # verify the origin branch exists
 branch_check_response, errors = get(
     apikey=from_XATA_API_KEY,
@@ -342,7 +952,7 @@ branch_check_response, errors = get(
     expect_codes=[],
     ERROR_FILE=ERROR_FILE,
 )
-if branch_check_response.status_code != 200:
+if branch_check_response is None or branch_check_response.status_code != 200:
     print(
         "Aborting because the origin branch "
         + str(from_BRANCH_URL)
@@ -353,8 +963,57 @@ if branch_check_response.status_code != 200:
 
 target_type = "unidentified"
 
+# A resumed run continues in the target branch it created, with the backfill method and link store it started with
+checkpoint = None
+if RESUME:
+    try:
+        checkpoint = Checkpoint.load(STATE_FILE)
+    except Exception as e:
+        print("Cannot read state file", STATE_FILE, str(e))
+        exit(-1)
+    if (
+        checkpoint.state["run"]["from"] != from_BRANCH_URL
+        or checkpoint.state["run"]["to"] != to_BRANCH_URL
+    ):
+        print(
+            "Aborting because the state file",
+            STATE_FILE,
+            "was saved by a run from",
+            checkpoint.state["run"]["from"],
+            "to",
+            checkpoint.state["run"]["to"],
+        )
+        exit(-1)
+    if checkpoint.state["completed"]:
+        print("The run saved in", STATE_FILE, "has already completed, nothing to resume.")
+        exit(0)
+    BACKFILL = checkpoint.state["run"]["backfill"]
+    LINK_STORE_FILE = checkpoint.state["run"]["link_store_file"]
+    INCREMENTAL = checkpoint.state["run"]["incremental"]
+    DELETE_MISSING = checkpoint.state["run"]["delete_missing"]
+    target_type = "resumed"
+# An incremental sync writes into the target branch of a previous run, verification reads it
+elif INCREMENTAL or VERIFY:
+    branch_check_response, errors = get(
+        apikey=to_XATA_API_KEY,
+        urlPath=to_BRANCH_URL,
+        expect_codes=[],
+        ERROR_FILE=ERROR_FILE,
+        host_header=destination_host_header,
+    )
+    if branch_check_response is None or branch_check_response.status_code != 200:
+        print(
+            "Aborting because the target branch "
+            + str(to_BRANCH_URL)
+            + " to sync into was not found: ",
+            branch_check_response,
+        )
+        exit(-1)
+    target_type = "existing_branch"
+
 ##################
-if OUTPUT == "xata":
+# A plan only reads from the target, which is created by the copy
+if OUTPUT == "xata" and target_type == "unidentified" and not PLAN:
     # If we are writting to a different database, either in the same workspace or in another one, we require that the target db does not exist
     if FROM_WORKSPACE != TO_WORKSPACE or FROM_DATABASE != TO_DATABASE:
         db_create_response, errors = put(
@@ -364,6 +1023,9 @@ if OUTPUT == "xata":
             payload={"region": TO_REGION, "branchName": TO_BRANCH},
             ERROR_FILE=ERROR_FILE,
         )
+        if db_create_response is None:
+            print("Aborting because the target database could not be created.")
+            exit(-1)
         if db_create_response.status_code == 422:
             print(
                 "Aborting because the target database",
@@ -391,7 +1053,7 @@ if OUTPUT == "xata":
             ERROR_FILE=ERROR_FILE,
             host_header=destination_host_header,
         )
-        if branch_check_response.status_code != 404:
+        if branch_check_response is None or branch_check_response.status_code != 404:
             print(
                 "Aborting because we couldn't verify the target branch "
                 + str(to_BRANCH_URL)
@@ -421,17 +1083,55 @@ print("\n>>> Xata Replay tool <<<\n")
 # List parameters
 print("Using configuration:")
 print(
-    " Concurrent writers per table:",
+    " Engine:",
+    ENGINE,
+    "\n Concurrency (sizes the writer pool shared by all tables):",
     CONCURRENT_CONSUMERS,
+    "\n Shared writers:",
+    WRITERS if WRITERS is not None else "concurrency times the number of tables",
+    "\n Worker processes:",
+    PROCESSES,
     "\n Bulk size:",
     BULK_SIZE,
+    "\n Bulk bytes limit:",
+    BULK_BYTES if BULK_BYTES > 0 else "none",
     "\n Page scroll size:",
     PAGE_SIZE,
+    "\n Scroll partitions per table:",
+    PARTITIONS,
+    "\n Pages prefetched per cursor:",
+    PREFETCH,
     "\n Inflight records queue size:",
     MAX_QUEUE_SIZE,
+    "\n Max requests per second per host:",
+    MAX_REQUEST_RATE,
+    "\n Request compression:",
+    COMPRESSION,
+    "\n JSON codec:",
+    JSON_CODEC,
+    "\n File transfer threads:",
+    FILE_CONCURRENCY if FILE_CONCURRENCY > 0 else "attachments are not copied",
+    "\n Max retries per request:",
+    MAX_RETRIES,
     "\n Error logs written to:",
     ERROR_FILE,
+    "\n Failed batches written to:",
+    DEAD_LETTER_FILE,
 )
+if OUTPUT == "xata" and not VERIFY and not PLAN:
+    print(" Progress saved to:", STATE_FILE)
+    print(
+        " Records copied:",
+        "updated since the last run in " + SYNC_FILE if INCREMENTAL else "all",
+    )
+    if DELETE_MISSING:
+        print(" Records missing from the source are deleted from the target")
+if ENGINE == "asyncio":
+    print(" Max requests in flight:", MAX_INFLIGHT_REQUESTS)
+if METRICS_FILE != "":
+    print(" Metrics written to:", "stdout" if METRICS_FILE == "-" else METRICS_FILE, "every", METRICS_INTERVAL, "seconds")
+if PROMETHEUS_PORT > 0:
+    print(" Prometheus metrics served at: http://127.0.0.1:" + str(PROMETHEUS_PORT) + "/metrics")
 
 # Copy schema
 print("\nApplying schema:")
@@ -442,12 +1142,16 @@ from_schema_raw, errors = get(
     ERROR_FILE=ERROR_FILE,
     host_header=source_host_header,
 )
+if from_schema_raw is None or from_schema_raw.status_code != 200:
+    print("Aborting because the schema could not be retrieved from", from_BRANCH_URL)
+    exit(-1)
 from_schema = from_schema_raw.json()
 tables_migration = {}
 tables_migration["operations"] = []
 columns_migration = {}
 columns_migration["operations"] = []
 tables = []
+schema_columns = {}
 schema_links = {}
 schema_files = {}
 if len(from_schema["schema"]["tables"]) == 0:
@@ -460,6 +1164,7 @@ if len(from_schema["schema"]["tables"]) == 0:
 
 # Create tables and columns in two sequential migration requests
 for table in from_schema["schema"]["tables"]:
+    schema_columns[table["name"]] = {}
     schema_links[table["name"]] = {}
     schema_files[table["name"]] = {}
     tables.append(table["name"])
@@ -468,6 +1173,7 @@ for table in from_schema["schema"]["tables"]:
         columns_migration["operations"].append(
             {"addColumn": {"table": table["name"], "column": column}}
         )
+        schema_columns[table["name"]][column["name"]] = column
         # Column types that require special handling in record response: link
         if column["type"] == "link":
             schema_links[table["name"]][column["name"]] = column
@@ -475,6 +1181,241 @@ for table in from_schema["schema"]["tables"]:
         if column["type"] == "file" or column["type"] == "file[]":
             schema_files[table["name"]][column["name"]] = column
 
+if VERIFY:
+    to_schema_raw, errors = get(
+        apikey=to_XATA_API_KEY,
+        urlPath=to_BRANCH_URL,
+        ERROR_FILE=ERROR_FILE,
+        host_header=destination_host_header,
+    )
+    if to_schema_raw is None or to_schema_raw.status_code != 200:
+        print("Aborting because the schema could not be retrieved from", to_BRANCH_URL)
+        exit(-1)
+    to_schema = to_schema_raw.json()
+    if from_schema["schema"] == to_schema["schema"]:
+        print("- Source and target schemas are identical")
+    else:
+        print("- Source and target schemas differ, the records are compared on the source schema")
+    print("\n>>> VERIFYING TABLE DATA <<<\n")
+    # A few tables are verified at once, each scanned on both sides with a read ahead thread per scan
+    configure_sessions(min(len(tables), COUNT_CONCURRENCY) * (4 if PREFETCH > 0 else 2))
+    verify_start = datetime.now()
+    verify_results = verify(
+        tables,
+        {"key": from_XATA_API_KEY, "url": from_BRANCH_URL, "host_header": source_host_header},
+        {"key": to_XATA_API_KEY, "url": to_BRANCH_URL, "host_header": destination_host_header},
+        PAGE_SIZE,
+        {
+            table: query_columns(table, schema_columns, schema_links, schema_files)
+            for table in tables
+        },
+        schema_links,
+        schema_files,
+        ERROR_FILE,
+        VERIFY_PREFIX_LENGTH,
+        PREFETCH,
+    )
+    verified = from_schema["schema"] == to_schema["schema"]
+    for table in tables:
+        result = verify_results[table]
+        table_verified = (
+            result["complete"]
+            and result["mismatched_buckets"] == 0
+            and result["source"] == result["target"]
+        )
+        verified = verified and table_verified
+        print(
+            table,
+            ":",
+            result["source"],
+            "records in source,",
+            result["target"],
+            "in target,",
+            result["buckets"] - result["mismatched_buckets"],
+            "/",
+            result["buckets"],
+            "buckets match",
+            "[Identical]" if table_verified else "[Differs]",
+        )
+        if not result["complete"]:
+            print("  Scroll aborted, check error log", ERROR_FILE)
+        for kind in ("missing", "extra", "different"):
+            if len(result[kind]) > 0:
+                print(
+                    "  " + str(len(result[kind])),
+                    kind,
+                    "records in target:",
+                    ", ".join(result[kind][:10]) + (", ..." if len(result[kind]) > 10 else ""),
+                )
+    print("Elapsed:", datetime.now() - verify_start)
+    if verified:
+        print("Source and target branches are identical.")
+        exit(0)
+    print("Source and target branches differ, record ids are listed in the error log", ERROR_FILE)
+    exit(1)
+
+if PLAN:
+    # The target gets the schema of the source, links are only deferred when copying to Xata
+    if OUTPUT == "xata":
+        table_dependencies, deferred_links = compute_table_dependencies(from_schema)
+    else:
+        table_dependencies = {table: [] for table in tables}
+        deferred_links = {table: {} for table in tables}
+    table_categories = compute_table_link_depth(from_schema)
+    plan_writers = WRITERS
+    if plan_writers is None:
+        plan_writers = min(CONCURRENT_CONSUMERS * len(tables), MAX_WRITERS)
+    plan_file_tables = []
+    if FILE_CONCURRENCY > 0:
+        plan_file_tables = [table for table in tables if len(schema_files[table]) > 0]
+    # An incremental sync only copies the records updated since the previous run
+    table_since = {}
+    if INCREMENTAL:
+        try:
+            previous_marks = load_marks(SYNC_FILE)
+        except Exception as e:
+            print("Cannot read sync file", SYNC_FILE, str(e))
+            exit(-1)
+        if previous_marks is not None:
+            if (
+                previous_marks["from"] != from_BRANCH_URL
+                or previous_marks["to"] != to_BRANCH_URL
+            ):
+                print("Aborting because the sync file", SYNC_FILE, "was saved by another run.")
+                exit(-1)
+            table_since = {
+                table: previous_marks["tables"].get(table) for table in tables
+            }
+    plan_source = {
+        "key": from_XATA_API_KEY,
+        "url": from_BRANCH_URL,
+        "host_header": source_host_header,
+    }
+    plan_target = None
+    if OUTPUT == "xata":
+        plan_target = {
+            "key": to_XATA_API_KEY,
+            "url": to_BRANCH_URL,
+            "host_header": destination_host_header,
+        }
+    print("\n>>> REPLAY PLAN <<<\n")
+    print("Tables in copy order:")
+    table_category = {
+        table: category
+        for category in table_categories
+        for table in table_categories[category]
+    }
+    for table in table_order(tables, table_dependencies):
+        line = [" " + table, ":", table_category[table], "(" + LINK_DEPTH[table_category[table]] + ")"]
+        if len(table_dependencies[table]) > 0:
+            line += ["after", ", ".join(sorted(table_dependencies[table]))]
+        if len(deferred_links[table]) > 0:
+            line += ["| links backfilled:", ", ".join(sorted(deferred_links[table]))]
+        print(*line)
+    print("\nCounting records and probing latency with", CONCURRENT_CONSUMERS, "requests in flight")
+    table_plan_counts = count_tables(
+        tables,
+        plan_source,
+        ERROR_FILE,
+        table_since,
+        deferred_links,
+        plan_file_tables,
+        schema_files,
+    )
+    probed = probe(
+        tables,
+        plan_source,
+        plan_target,
+        PAGE_SIZE,
+        {
+            table: query_columns(table, schema_columns, schema_links, schema_files)
+            for table in tables
+        },
+        schema_links,
+        schema_files,
+        plan_file_tables,
+        ERROR_FILE,
+        CONCURRENT_CONSUMERS,
+    )
+    planned = estimate(
+        tables,
+        table_dependencies,
+        table_plan_counts,
+        probed,
+        plan_source,
+        plan_target,
+        PAGE_SIZE,
+        BULK_SIZE,
+        BULK_BYTES,
+        PARTITIONS,
+        plan_writers,
+        FILE_CONCURRENCY,
+        MAX_REQUEST_RATE,
+        BACKFILL,
+    )
+    print("\nTables:")
+    for table in table_order(tables, table_dependencies):
+        counts = table_plan_counts[table]
+        sample = probed["tables"].get(table)
+        line = [
+            " " + table,
+            ":",
+            counts["records"] if counts["records"] is not None else "unknown number of",
+            "records" + ("" if table_since.get(table) is None else " updated since " + table_since[table]) + ",",
+            str(round(sample["record_bytes"])) if sample is not None else "unknown",
+            "bytes per record,",
+            planned["tables"][table]["queries"],
+            "queries,",
+            planned["tables"][table]["bulks"],
+            "bulk writes",
+        ]
+        if len(deferred_links[table]) > 0:
+            line += ["|", counts["backfill"], "records with links to backfill in", planned["tables"][table]["backfill_writes"], "requests"]
+        if table in plan_file_tables:
+            line += ["|", planned["tables"][table]["files"], "files"]
+        print(*line)
+    print("\nLatency:")
+    if probed["read_latency"] is None:
+        print(" The source could not be read, check error log", ERROR_FILE)
+        exit(-1)
+    print(
+        " Query page of",
+        probed["page_records"],
+        "records:",
+        round(probed["read_latency"] * 1000),
+        "ms measured,",
+        "source round trip",
+        round((probed["source_round_trip"] or 0) * 1000),
+        "ms",
+    )
+    if plan_target is not None:
+        print(
+            " Bulk write of",
+            BULK_SIZE,
+            "records:",
+            round(
+                ((probed["target_round_trip"] or 0) + BULK_SIZE * planned["record_latency"])
+                * 1000
+            ),
+            "ms estimated from the target round trip of",
+            round((probed["target_round_trip"] or 0) * 1000),
+            "ms",
+        )
+    print("\nEstimate:")
+    print(" Source requests:", planned["source_requests"])
+    print(" Target requests:", planned["target_requests"])
+    print(" Copy:", timedelta(seconds=round(planned["copy_seconds"])), "with", plan_writers, "writers")
+    if planned["backfill_seconds"] > 0:
+        print(" Links backfill:", timedelta(seconds=round(planned["backfill_seconds"])))
+    if planned["file_seconds"] > 0:
+        print(" Attachments:", timedelta(seconds=round(planned["file_seconds"])), "with", FILE_CONCURRENCY, "file transfer threads")
+    if planned["rate_seconds"] >= planned["copy_seconds"] + planned["backfill_seconds"] + planned["file_seconds"]:
+        print(" Limited by the request rate of", MAX_REQUEST_RATE, "requests per second per host")
+    print(" Total:", timedelta(seconds=round(planned["total_seconds"])))
+    if any(table_plan_counts[table]["records"] is None for table in tables):
+        print("Tables of unknown size are left out of the estimate, check error log", ERROR_FILE)
+    exit(0)
+
 if OUTPUT == "xata":
     print("- Creating schema in target", to_BRANCH_URL)
     # Create a new database and initialize tables and table schema
@@ -487,7 +1428,10 @@ if OUTPUT == "xata":
             ERROR_FILE=ERROR_FILE,
             host_header=destination_host_header,
         )
-        if tables_migration_response.json()["status"] != "completed":
+        if (
+            tables_migration_response is None
+            or tables_migration_response.json()["status"] != "completed"
+        ):
             print(
                 "Error when creating tables. Unexpected status in /schema/update API response."
             )
@@ -499,7 +1443,10 @@ if OUTPUT == "xata":
             ERROR_FILE=ERROR_FILE,
             host_header=destination_host_header,
         )
-        if columns_migration_response.json()["status"] != "completed":
+        if (
+            columns_migration_response is None
+            or columns_migration_response.json()["status"] != "completed"
+        ):
             print(
                 "Error when applying schema to tables. Unexpected status in /schema/update API response."
             )
@@ -517,7 +1464,8 @@ if OUTPUT == "xata":
             host_header=destination_host_header,
         )
         if (
-            branch_create_response.status_code != 201
+            branch_create_response is None
+            or branch_create_response.status_code != 201
             or branch_create_response.json()["status"] != "completed"
         ):
             print(
@@ -529,6 +1477,11 @@ if OUTPUT == "xata":
                 branch_create_response,
             )
             exit(-1)
+    # The target branch and its schema were created by the interrupted run
+    elif target_type == "resumed":
+        print("- Resuming into the existing target", to_BRANCH_URL)
+    elif target_type == "existing_branch":
+        print("- Syncing into the existing target", to_BRANCH_URL)
     else:
         print(
             "Aborting: Could not identify the target branch. It does not appear to be a new branch in a new or an existing database."
@@ -541,9 +1494,19 @@ if OUTPUT == "xata":
         ERROR_FILE=ERROR_FILE,
         host_header=destination_host_header,
     )
+    if to_schema_raw is None or to_schema_raw.status_code != 200:
+        print("Aborting because the schema could not be retrieved from", to_BRANCH_URL)
+        exit(-1)
     to_schema = to_schema_raw.json()
     if from_schema["schema"] == to_schema["schema"]:
         print("- Schema has been copied successfully")
+    elif target_type == "existing_branch":
+        print(
+            "Aborting because the schema of the target",
+            to_BRANCH_URL,
+            "differs from the source, incremental syncs do not migrate the schema.",
+        )
+        exit(-1)
 elif OUTPUT == "file":
     print("- Writing schema to", OUTPUT_PATH + "schema.json")
     with open(OUTPUT_PATH + "schema.json", "w") as f:
@@ -560,338 +1523,718 @@ elif OUTPUT == "file":
                         f.write(str(column["name"]) + ",")
                     else:
                         f.write(str(column["name"]) + "\n")
-# Category 1: tables without links
-# Category 2: tables with links to tables without links
-# Category 3: tables with links to table with links. Category 3 tables require a second pass, meaning we index them without links and after all tables have been indexed, we create links.
-table_categories = compute_table_link_depth(to_schema)
-
-# We ingest tables from category 1 and 2 in this order, so that links of tables in category 2 can be created.
-# Category 3 is not handled yet
-category_order = ["category1", "category2", "category3"]
-table_queues = {}
+# Tables are copied as soon as the tables they link to have been copied. Links between tables of a cycle (including a table linking to itself) cannot be created in one pass: the tables of a cycle are copied without those links, which are backfilled once all the tables of the cycle have been copied.
+# Links are not backfilled when writing to file, all tables are written at once with their links.
+if OUTPUT == "xata":
+    table_dependencies, deferred_links = compute_table_dependencies(to_schema)
+else:
+    table_dependencies = {table: [] for table in tables}
+    deferred_links = {table: {} for table in tables}
+
+# Writers are shared by all tables, by default as many as the tables would get with their own writers.
+if WRITERS is None:
+    WRITERS = min(CONCURRENT_CONSUMERS * len(tables), MAX_WRITERS)
+# Attachments are copied for the tables with file or file[] columns, once their records are written
+file_tables = []
+if FILE_CONCURRENCY > 0:
+    file_tables = [table for table in tables if len(schema_files[table]) > 0]
+# Size the keep-alive connection pools to the number of threads that can use a host at once: the writers, the scroll partitions of every table, the file transfers, plus the record counts.
+configure_sessions(WRITERS + PARTITIONS * len(tables) + FILE_CONCURRENCY + COUNT_CONCURRENCY)
+
+# The links of cycles are kept locally during the copy for the atomic and transaction backfills, the bulk rewrite needs entire records and scrolls the source again
+link_store = None
+use_link_store = BACKFILL != "bulk_rewrite" and any(
+    len(deferred_links[table]) > 0 for table in tables
+)
+if use_link_store:
+    try:
+        if os.path.dirname(LINK_STORE_FILE) != "":
+            os.makedirs(os.path.dirname(LINK_STORE_FILE), exist_ok=True)
+        # Links left by another run would be backfilled again, only a resumed run keeps them
+        if not RESUME:
+            remove_store(LINK_STORE_FILE)
+        link_store = LinkStore(LINK_STORE_FILE)
+    except Exception as e:
+        print("Cannot create link store", LINK_STORE_FILE, str(e))
+        exit(-1)
+
+# Records already in the target are upserted: in incremental syncs, and in resumed runs that send again the pages written after the last save
+UPSERT = RESUME or INCREMENTAL
+
+# Highest update times of the source tables before they are copied, saved once the run completes so that the next incremental sync starts from them
+table_since = {}
+table_marks = {}
+if RESUME:
+    table_since = checkpoint.state["run"]["since"]
+    table_marks = checkpoint.state["run"]["marks"]
+elif OUTPUT == "xata":
+    if INCREMENTAL:
+        try:
+            previous_marks = load_marks(SYNC_FILE)
+        except Exception as e:
+            print("Cannot read sync file", SYNC_FILE, str(e))
+            exit(-1)
+        if previous_marks is None:
+            print("- No previous run found in", SYNC_FILE + ", all records will be synced")
+        elif (
+            previous_marks["from"] != from_BRANCH_URL
+            or previous_marks["to"] != to_BRANCH_URL
+        ):
+            print(
+                "Aborting because the sync file",
+                SYNC_FILE,
+                "was saved by a run from",
+                previous_marks["from"],
+                "to",
+                previous_marks["to"],
+            )
+            exit(-1)
+        else:
+            table_since = {
+                table: previous_marks["tables"].get(table) for table in tables
+            }
+    source_marks = map_concurrently(
+        lambda table: high_water_mark(
+            from_XATA_API_KEY, from_BRANCH_URL, table, ERROR_FILE, source_host_header
+        ),
+        tables,
+    )
+    for table in tables:
+        mark = source_marks[table]
+        table_marks[table] = mark if mark is not None else table_since.get(table)
+
+if OUTPUT == "xata" and checkpoint is None:
+    try:
+        checkpoint = Checkpoint.create(
+            STATE_FILE,
+            {
+                "from": from_BRANCH_URL,
+                "to": to_BRANCH_URL,
+                "backfill": BACKFILL,
+                "link_store_file": LINK_STORE_FILE,
+                "incremental": INCREMENTAL,
+                "delete_missing": DELETE_MISSING,
+                "since": table_since,
+                "marks": table_marks,
+            },
+        )
+    except Exception as e:
+        print("Cannot create state file", STATE_FILE, str(e))
+        exit(-1)
+
+
+
+def table_events():
+    # Tables of other worker processes are waited for across processes
+    if PROCESSES > 1:
+        return {table: process_context.Event() for table in tables}
+    return {table: Event() for table in tables}
+
+
+table_writers = {}
 table_threads = {}
-reporting_queue = Queue(len(tables))
+copied = table_events()
+# Worker processes of the last run or follow round, and their final statistics
+workers = []
+worker_stats = []
+# Tables without changes in a follow round, and the time each table was last written
+skipped_tables = set()
+synced_at = {}
+# Record counts are used for progress and to schedule the largest tables first. They are requested while the copy starts, and reported as they arrive.
+table_counts = {}
+# The reporting queue is not bounded, writers never wait for the reporter
+reporting_queue = Queue()
+counter = Thread(
+    target=record_counter,
+    args=(
+        reporting_queue,
+        table_counts,
+        tables,
+        from_XATA_API_KEY,
+        from_BRANCH_URL,
+        ERROR_FILE,
+        source_host_header,
+        table_since,
+    ),
+)
+counter.start()
+# Totals of the reports read by the reporter, for the metrics and the run summary
+run_metrics = metrics.RunMetrics(tables)
 reporter = Thread(
     target=reporter,
     args=(
         reporting_queue,
         tables,
-        table_categories,
+        table_dependencies,
+        deferred_links,
         from_XATA_API_KEY,
         from_BRANCH_URL,
         ERROR_FILE,
-        CONCURRENT_CONSUMERS,
+        table_counts,
         source_host_header,
         OUTPUT,
         OUTPUT_FORMAT,
         OUTPUT_PATH,
+        REPORT_INTERVAL,
+        file_tables,
+        HEADLESS,
+        run_metrics,
     ),
 )
 reporter.start()
-for category in category_order:
-    # Logic for replaying data to Xata
-    if OUTPUT == "xata":
-        # Expect all threads of the current table category to complete before starting the next category
-        if category == "category1" or category == "category2":
-            for table in table_categories[category]:
-                table_queues[table] = Queue(MAX_QUEUE_SIZE)
-                table_threads[table] = {}
-                table_threads[table]["consumers"] = {}
-                for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                    table_threads[table]["consumers"][str(consumer_iterator)] = Thread(
-                        target=consumer,
-                        args=(
-                            table_queues[table],
-                            reporting_queue,
-                            BULK_SIZE,
-                            to_XATA_API_KEY,
-                            to_BRANCH_URL,
-                            table,
-                            to_schema,
-                            schema_links,
-                            schema_files,
-                            table_categories,
-                            OUTPUT,
-                            OUTPUT_FORMAT,
-                            OUTPUT_PATH,
-                            ERROR_FILE,
-                            destination_host_header,
-                        ),
-                    )
-                    table_threads[table]["consumers"][str(consumer_iterator)].start()
-                table_threads[table]["producer"] = Thread(
-                    target=producer,
-                    args=(
-                        table_queues[table],
-                        PAGE_SIZE,
-                        from_XATA_API_KEY,
-                        from_BRANCH_URL,
-                        table,
-                        schema_links,
-                        schema_files,
-                        ERROR_FILE,
-                        source_host_header,
-                    ),
-                )
-                table_threads[table]["producer"].start()
-            for table in table_categories[category]:
-                for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                    table_threads[table]["consumers"][str(consumer_iterator)].join()
-                table_threads[table]["producer"].join()
-        elif category == "category3":
-            for table in table_categories[category]:
-                # First pass: write category 3 table content without creating links
-                table_queues[table] = Queue(MAX_QUEUE_SIZE)
-                table_threads[table] = {}
-                table_threads[table]["consumers"] = {}
-                for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                    table_threads[table]["consumers"][str(consumer_iterator)] = Thread(
-                        target=consumer,
-                        args=(
-                            table_queues[table],
-                            reporting_queue,
-                            BULK_SIZE,
-                            to_XATA_API_KEY,
-                            to_BRANCH_URL,
-                            table,
-                            to_schema,
-                            schema_links,
-                            schema_files,
-                            table_categories,
-                            OUTPUT,
-                            OUTPUT_FORMAT,
-                            OUTPUT_PATH,
-                            ERROR_FILE,
-                            destination_host_header,
-                            "no_links",
-                        ),
-                    )
-                    table_threads[table]["consumers"][str(consumer_iterator)].start()
-                table_threads[table]["producer"] = Thread(
-                    target=producer,
-                    args=(
-                        table_queues[table],
-                        PAGE_SIZE,
-                        from_XATA_API_KEY,
-                        from_BRANCH_URL,
-                        table,
-                        schema_links,
-                        schema_files,
-                        ERROR_FILE,
-                        source_host_header,
-                    ),
-                )
-                table_threads[table]["producer"].start()
-            for table in table_categories[category]:
-                for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                    table_threads[table]["consumers"][str(consumer_iterator)].join()
-                table_threads[table]["producer"].join()
-            if BACKFILL == "atomic_update":
-                # Second pass: update links in category 3 tables with an atomic request per record.
-                for table in table_categories[category]:
-                    table_queues[table] = Queue(MAX_QUEUE_SIZE)
-                    table_threads[table] = {}
-                    table_threads[table]["consumers"] = {}
-                    for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                        table_threads[table]["consumers"][str(consumer_iterator)] = (
-                            Thread(
-                                target=consumer,
-                                args=(
-                                    table_queues[table],
-                                    reporting_queue,
-                                    BULK_SIZE,
-                                    to_XATA_API_KEY,
-                                    to_BRANCH_URL,
-                                    table,
-                                    to_schema,
-                                    schema_links,
-                                    schema_files,
-                                    table_categories,
-                                    OUTPUT,
-                                    OUTPUT_FORMAT,
-                                    OUTPUT_PATH,
-                                    ERROR_FILE,
-                                    destination_host_header,
-                                    "only_links",
-                                ),
-                            )
-                        )
-                        table_threads[table]["consumers"][
-                            str(consumer_iterator)
-                        ].start()
-                    table_threads[table]["producer"] = Thread(
-                        target=producer,
-                        args=(
-                            table_queues[table],
-                            PAGE_SIZE,
-                            from_XATA_API_KEY,
-                            from_BRANCH_URL,
-                            table,
-                            schema_links,
-                            schema_files,
-                            ERROR_FILE,
-                            source_host_header,
-                            "only_links",
-                        ),
-                    )
-                    table_threads[table]["producer"].start()
-                for table in table_categories[category]:
-                    for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                        table_threads[table]["consumers"][str(consumer_iterator)].join()
-                    table_threads[table]["producer"].join()
-            elif BACKFILL == "bulk_transaction":
-                # Second pass: update links in category 3 tables with bulk updates using transactions
-                for table in table_categories[category]:
-                    table_queues[table] = Queue(MAX_QUEUE_SIZE)
-                    table_threads[table] = {}
-                    table_threads[table]["consumers"] = {}
-                    for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                        table_threads[table]["consumers"][str(consumer_iterator)] = (
-                            Thread(
-                                target=consumer,
-                                args=(
-                                    table_queues[table],
-                                    reporting_queue,
-                                    BULK_SIZE,
-                                    to_XATA_API_KEY,
-                                    to_BRANCH_URL,
-                                    table,
-                                    to_schema,
-                                    schema_links,
-                                    schema_files,
-                                    table_categories,
-                                    OUTPUT,
-                                    OUTPUT_FORMAT,
-                                    OUTPUT_PATH,
-                                    ERROR_FILE,
-                                    destination_host_header,
-                                    "bulk_links_transaction",
-                                ),
-                            )
-                        )
-                        table_threads[table]["consumers"][
-                            str(consumer_iterator)
-                        ].start()
-                    table_threads[table]["producer"] = Thread(
-                        target=producer,
-                        args=(
-                            table_queues[table],
-                            PAGE_SIZE,
-                            from_XATA_API_KEY,
-                            from_BRANCH_URL,
-                            table,
-                            schema_links,
-                            schema_files,
-                            ERROR_FILE,
-                            source_host_header,
-                            "only_links",
-                        ),
-                    )
-                    table_threads[table]["producer"].start()
-                for table in table_categories[category]:
-                    for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                        table_threads[table]["consumers"][str(consumer_iterator)].join()
-                    table_threads[table]["producer"].join()
-            elif BACKFILL == "bulk_rewrite":
-                # Second pass: update links in category 3 tables by rewritting the entire record in bulks including links.
-                for table in table_categories[category]:
-                    table_queues[table] = Queue(MAX_QUEUE_SIZE)
-                    table_threads[table] = {}
-                    table_threads[table]["consumers"] = {}
-                    for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                        table_threads[table]["consumers"][str(consumer_iterator)] = (
-                            Thread(
-                                target=consumer,
-                                args=(
-                                    table_queues[table],
-                                    reporting_queue,
-                                    BULK_SIZE,
-                                    to_XATA_API_KEY,
-                                    to_BRANCH_URL,
-                                    table,
-                                    to_schema,
-                                    schema_links,
-                                    schema_files,
-                                    table_categories,
-                                    OUTPUT,
-                                    OUTPUT_FORMAT,
-                                    OUTPUT_PATH,
-                                    ERROR_FILE,
-                                    destination_host_header,
-                                    "full",
-                                    "with_links",
-                                ),
-                            )
-                        )
-                        table_threads[table]["consumers"][
-                            str(consumer_iterator)
-                        ].start()
-                    table_threads[table]["producer"] = Thread(
-                        target=producer,
-                        args=(
-                            table_queues[table],
-                            PAGE_SIZE,
-                            from_XATA_API_KEY,
-                            from_BRANCH_URL,
-                            table,
-                            schema_links,
-                            schema_files,
-                            ERROR_FILE,
-                            source_host_header,
-                            "full",
-                            "with_links",
-                        ),
-                    )
-                    table_threads[table]["producer"].start()
-                for table in table_categories[category]:
-                    for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                        table_threads[table]["consumers"][str(consumer_iterator)].join()
-                    table_threads[table]["producer"].join()
-    # Logic for writting to files on disk
-    elif OUTPUT == "file":
-        for table in table_categories[category]:
-            table_queues[table] = Queue(MAX_QUEUE_SIZE)
-            table_threads[table] = {}
-            table_threads[table]["consumers"] = {}
-            for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                table_threads[table]["consumers"][str(consumer_iterator)] = Thread(
-                    target=consumer,
-                    args=(
-                        table_queues[table],
-                        reporting_queue,
-                        BULK_SIZE,
-                        to_XATA_API_KEY,
-                        to_BRANCH_URL,
-                        table,
-                        to_schema,
-                        schema_links,
-                        schema_files,
-                        table_categories,
-                        OUTPUT,
-                        OUTPUT_FORMAT,
-                        OUTPUT_PATH,
-                        ERROR_FILE,
-                        destination_host_header,
-                    ),
-                )
-                table_threads[table]["consumers"][str(consumer_iterator)].start()
-            table_threads[table]["producer"] = Thread(
-                target=producer,
-                args=(
-                    table_queues[table],
-                    PAGE_SIZE,
-                    from_XATA_API_KEY,
-                    from_BRANCH_URL,
-                    table,
-                    schema_links,
-                    schema_files,
-                    ERROR_FILE,
-                    source_host_header,
-                ),
+metrics_stop = Event()
+if METRICS_FILE != "":
+    metrics_emitter = Thread(
+        target=metrics.emitter,
+        args=(run_metrics, METRICS_FILE, METRICS_INTERVAL, metrics_stop),
+    )
+    metrics_emitter.start()
+metrics_server = None
+if PROMETHEUS_PORT > 0:
+    try:
+        metrics_server = metrics.serve(run_metrics, PROMETHEUS_PORT)
+    except OSError as e:
+        print("Cannot serve metrics on port", PROMETHEUS_PORT, str(e))
+telemetry_stop = Event()
+if TELEMETRY_FILE != "":
+    telemetry_dumper = Thread(
+        target=telemetry.dumper,
+        args=(TELEMETRY_FILE, TELEMETRY_INTERVAL, telemetry_stop),
+    )
+    telemetry_dumper.start()
+checkpoint_stop = Event()
+if checkpoint is not None:
+    checkpoint_saver = Thread(
+        target=checkpoint.saver, args=(CHECKPOINT_INTERVAL, checkpoint_stop)
+    )
+    checkpoint_saver.start()
+
+
+# Run a producer for one pass over the table, and expect all of its batches to be written by the shared writers before returning
+def run_table(
+    table,
+    phase="copy",
+    consumer_mode="full",
+    records_type="all",
+    producer_mode="full",
+    fetch_records="all",
+    links=None,
+):
+    if table in skipped_tables:
+        return
+    # Passes completed by an interrupted run are only reported
+    for status_report in resumed_reports(
+        checkpoint, table, phase, report_key(consumer_mode, records_type)
+    ):
+        reporting_queue.put(status_report)
+    if checkpoint is not None and checkpoint.done(table, phase):
+        return
+    table_writers[table] = TableWriter(
+        writer_pool,
+        table_counts,
+        MAX_QUEUE_SIZE,
+        reporting_queue,
+        BULK_SIZE,
+        to_XATA_API_KEY,
+        to_BRANCH_URL,
+        table,
+        to_schema,
+        deferred_links,
+        OUTPUT,
+        OUTPUT_FORMAT,
+        OUTPUT_PATH,
+        ERROR_FILE,
+        destination_host_header,
+        consumer_mode,
+        records_type,
+        DEAD_LETTER_FILE,
+        BULK_BYTES,
+        link_store,
+        checkpoint,
+        UPSERT,
+    )
+    if producer_mode == "only_links" and link_store is not None:
+        store_producer(
+            table_writers[table], link_store, table, PAGE_SIZE, checkpoint, phase
+        )
+    else:
+        producer(
+            table_writers[table],
+            PAGE_SIZE,
+            from_XATA_API_KEY,
+            from_BRANCH_URL,
+            table,
+            links if links is not None else schema_links,
+            schema_files,
+            ERROR_FILE,
+            source_host_header,
+            producer_mode,
+            fetch_records,
+            PARTITIONS,
+            PREFETCH,
+            schema_columns,
+            checkpoint,
+            phase,
+            table_since.get(table),
+        )
+    table_writers[table].finished.wait()
+    if checkpoint is not None:
+        checkpoint.finish(table, phase)
+    synced_at[table] = datetime.now()
+
+
+# Copy the attachments of a table once its records are all written, the files are streamed by the shared file pool
+def run_files(table):
+    if table in skipped_tables or table not in file_tables:
+        return
+    copy_files(
+        file_pool,
+        reporting_queue,
+        table,
+        PAGE_SIZE,
+        schema_links,
+        schema_files,
+        ERROR_FILE,
+        DEAD_LETTER_FILE,
+        checkpoint,
+        "files",
+        table_since.get(table),
+        PREFETCH,
+    )
+    synced_at[table] = datetime.now()
+
+
+def new_file_pool(concurrency):
+    if len(file_tables) == 0:
+        return None
+    return FilePool(
+        concurrency,
+        {"key": from_XATA_API_KEY, "url": from_BRANCH_URL, "host_header": source_host_header},
+        {"key": to_XATA_API_KEY, "url": to_BRANCH_URL, "host_header": destination_host_header},
+        ERROR_FILE,
+    )
+
+
+# Wait for the tables the links point to, copy the table, then backfill the links of cycles once the other tables of the cycle have been copied. The attachments are copied last.
+def schedule_table(table):
+    for dependency in table_dependencies[table]:
+        copied[dependency].wait()
+    if len(deferred_links[table]) == 0:
+        run_table(table)
+        copied[table].set()
+        run_files(table)
+        return
+    # First pass: write the table content without the links of the cycle
+    run_table(table, "copy", "no_links")
+    copied[table].set()
+    for column in deferred_links[table]:
+        copied[deferred_links[table][column]["link"]["table"]].wait()
+    # Second pass: backfill the links of the cycle, with the atomic and transaction methods only the deferred link columns are scrolled
+    consumer_mode, records_type, producer_mode, fetch_records = backfill_modes(BACKFILL)
+    run_table(
+        table,
+        "backfill",
+        consumer_mode,
+        records_type,
+        producer_mode,
+        fetch_records,
+        deferred_links if producer_mode == "only_links" else schema_links,
+    )
+    run_files(table)
+
+
+# Copy the tables assigned to a forked worker process with its own writers, reporting to the main process over the worker queue
+def run_worker(worker_tables, workers, worker_queue):
+    global checkpoint, link_store, reporting_queue, writer_pool, file_pool
+    reset_after_fork()
+    # Ctrl-C is handled by the main process, the tables of the worker finish writing
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Thread(target=watch_parent, args=(os.getppid(),), daemon=True).start()
+    worker_writers = max(1, round(WRITERS * len(worker_tables) / len(tables)))
+    configure_limiters(MAX_REQUEST_RATE / workers)
+    worker_files = max(1, round(FILE_CONCURRENCY * len(worker_tables) / len(tables)))
+    configure_sessions(worker_writers + PARTITIONS * len(worker_tables) + worker_files)
+    reporting_queue = ReportSender(worker_queue)
+    if checkpoint is not None:
+        checkpoint = WorkerCheckpoint(worker_tables, worker_queue, checkpoint.state)
+    if link_store is not None:
+        link_store = LinkStore(LINK_STORE_FILE)
+    worker_stop = Event()
+    senders = []
+    if checkpoint is not None:
+        senders.append(
+            Thread(target=checkpoint.saver, args=(CHECKPOINT_INTERVAL, worker_stop))
+        )
+    if TELEMETRY_FILE != "":
+        senders.append(
+            Thread(
+                target=telemetry_sender,
+                args=(worker_queue, TELEMETRY_INTERVAL, worker_stop),
+            )
+        )
+    if METRICS_FILE != "" or PROMETHEUS_PORT > 0:
+        senders.append(
+            Thread(
+                target=gauge_sender,
+                args=(worker_queue, REPORT_INTERVAL, worker_stop),
             )
-            table_threads[table]["producer"].start()
-        for table in table_categories[category]:
-            for consumer_iterator in range(CONCURRENT_CONSUMERS):
-                table_threads[table]["consumers"][str(consumer_iterator)].join()
-            table_threads[table]["producer"].join()
+        )
+    for sender in senders:
+        sender.start()
+    writer_pool = WriterPool(worker_writers)
+    file_pool = new_file_pool(worker_files)
+    for table in worker_tables:
+        table_threads[table] = Thread(target=schedule_table, args=(table,))
+        table_threads[table].start()
+    for table in worker_tables:
+        table_threads[table].join()
+    writer_pool.stop()
+    if file_pool is not None:
+        file_pool.stop()
+    worker_stop.set()
+    for sender in senders:
+        sender.join()
+    if checkpoint is not None:
+        checkpoint.save()
+    if link_store is not None:
+        link_store.close(remove=False)
+    worker_queue.put(
+        (
+            "stats",
+            os.getpid(),
+            process_stats(
+                {table: synced_at[table] for table in worker_tables if table in synced_at}
+            ),
+        )
+    )
+
+
+# Run the passes of all tables with the selected engine, each table starts once its dependencies have been copied
+def replay():
+    global writer_pool, file_pool, workers, worker_queue, worker_stats
+    if ENGINE == "asyncio":
+        file_pool = new_file_pool(FILE_CONCURRENCY)
+        asyncio.run(
+            replay_tables(
+                tables,
+                reporting_queue,
+                MAX_QUEUE_SIZE,
+                PAGE_SIZE,
+                BULK_SIZE,
+                WRITERS,
+                MAX_INFLIGHT_REQUESTS,
+                from_XATA_API_KEY,
+                from_BRANCH_URL,
+                to_XATA_API_KEY,
+                to_BRANCH_URL,
+                schema_links,
+                schema_files,
+                table_dependencies,
+                deferred_links,
+                ERROR_FILE,
+                source_host_header,
+                destination_host_header,
+                BACKFILL,
+                DEAD_LETTER_FILE,
+                PARTITIONS,
+                PREFETCH,
+                schema_columns,
+                BULK_BYTES,
+                table_counts,
+                link_store,
+                checkpoint,
+                table_since,
+                skipped_tables,
+                synced_at,
+                file_pool,
+                file_tables,
+                UPSERT,
+            )
+        )
+        if file_pool is not None:
+            file_pool.stop()
+    elif PROCESSES > 1:
+        # Each table is copied by a single worker, the main process reports and saves the progress of all of them. Tables are balanced between workers on the record counts that arrive within ASSIGNMENT_WAIT, the copy does not wait for the others.
+        counter.join(ASSIGNMENT_WAIT)
+        assignment = assign_tables(tables, dict(table_counts), PROCESSES)
+        worker_queue = process_context.Queue()
+        workers = [
+            process_context.Process(
+                target=run_worker,
+                args=(worker_tables, len(assignment), worker_queue),
+                daemon=True,
+            )
+            for worker_tables in assignment
+        ]
+        worker_stats = []
+        for worker in workers:
+            worker.start()
+        collect(worker_queue, workers, reporting_queue, checkpoint, synced_at, worker_stats)
+        for worker in workers:
+            worker.join()
+    else:
+        writer_pool = WriterPool(WRITERS)
+        file_pool = new_file_pool(FILE_CONCURRENCY)
+        # Every table starts at once and waits for its own dependencies only. The counts are not known yet, the writers give the largest tables priority once they are.
+        for table in tables:
+            table_threads[table] = Thread(target=schedule_table, args=(table,))
+            table_threads[table].start()
+        for table in tables:
+            table_threads[table].join()
+        writer_pool.stop()
+        if file_pool is not None:
+            file_pool.stop()
+
+
+replay()
+# The link store and the state are kept until all passes are done, an incomplete run can be resumed
+completed = True
+if checkpoint is not None:
+    checkpoint_stop.set()
+    checkpoint_saver.join()
+    completed = checkpoint.complete()
+if link_store is not None:
+    link_store.close(remove=completed)
 reporter.join()
+counter.join()
+if not completed:
+    print(
+        "\nSome table scrolls did not complete, resume the run with --resume --state_file",
+        STATE_FILE,
+    )
+elif OUTPUT == "xata":
+    if DELETE_MISSING:
+        print("\nDeleting records missing from the source:")
+        for table in tables:
+            deleted = delete_missing(
+                from_XATA_API_KEY,
+                from_BRANCH_URL,
+                to_XATA_API_KEY,
+                to_BRANCH_URL,
+                table,
+                PAGE_SIZE,
+                BULK_SIZE,
+                ERROR_FILE,
+                DEAD_LETTER_FILE,
+                source_host_header,
+                destination_host_header,
+            )
+            if deleted is None:
+                print("-", table, ": the record ids could not be listed, no records deleted")
+            else:
+                print("-", table, ":", deleted, "records deleted")
+    # The next incremental sync starts from the update times reached before this run
+    save_marks(
+        SYNC_FILE, {"from": from_BRANCH_URL, "to": to_BRANCH_URL, "tables": table_marks}
+    )
+    print("\nNext incremental sync starts from the update times saved to", SYNC_FILE)
+
+
+def follow_round():
+    # One incremental pass over the tables whose highest update time moved since the previous round. Returns the time the marks were read and the totals written per table.
+    global checkpoint, copied, reporting_queue, link_store, table_since, UPSERT
+    round_start = datetime.now()
+    marks = {}
+    source_marks = map_concurrently(
+        lambda table: high_water_mark(
+            from_XATA_API_KEY, from_BRANCH_URL, table, ERROR_FILE, source_host_header
+        ),
+        tables,
+    )
+    for table in tables:
+        mark = source_marks[table]
+        # Update times are ISO 8601 strings of the same format, compared as text. The mark only moves forward, the highest update time drops when the last updated records are deleted.
+        if mark is not None and (table_marks[table] is None or mark > table_marks[table]):
+            marks[table] = mark
+        else:
+            marks[table] = table_marks[table]
+    skipped_tables.clear()
+    skipped_tables.update(table for table in tables if marks[table] == table_marks[table])
+    if len(skipped_tables) == len(tables):
+        return round_start, {}
+    table_since = dict(table_marks)
+    UPSERT = True
+    copied = table_events()
+    reporting_queue = Queue()
+    checkpoint = Checkpoint.create(
+        STATE_FILE,
+        {
+            "from": from_BRANCH_URL,
+            "to": to_BRANCH_URL,
+            "backfill": BACKFILL,
+            "link_store_file": LINK_STORE_FILE,
+            "incremental": True,
+            "delete_missing": False,
+            "since": table_since,
+            "marks": marks,
+        },
+    )
+    if use_link_store:
+        remove_store(LINK_STORE_FILE)
+        link_store = LinkStore(LINK_STORE_FILE)
+    replay()
+    if link_store is not None:
+        link_store.close()
+    # Tables whose scrolls did not complete are polled again from their previous mark
+    for table in tables:
+        if table not in skipped_tables and all(
+            checkpoint.done(table, phase) for phase in checkpoint.state["tables"][table]
+        ):
+            table_marks[table] = marks[table]
+    checkpoint.complete()
+    save_marks(
+        SYNC_FILE, {"from": from_BRANCH_URL, "to": to_BRANCH_URL, "tables": table_marks}
+    )
+    return round_start, drain_reports(reporting_queue)
+
+
+# Keep the target in sync with the source until interrupted, polling the update time of every table
+if FOLLOW and completed:
+    print("\n>>> FOLLOWING CHANGES <<<\n")
+    print("Polling the source every", FOLLOW_INTERVAL, "seconds, stop with Ctrl-C.")
+    follow_stop = Event()
+    while True:
+        try:
+            polled = datetime.now()
+            round_start, round_totals = follow_round()
+            run_metrics.update(round_totals)
+            for table in tables:
+                if table in skipped_tables:
+                    continue
+                # Replication lag: time from reading the update time of the source table until its changes were written to the target
+                lag = (synced_at[table] - round_start).total_seconds()
+                line = [
+                    datetime.now().isoformat(timespec="seconds"),
+                    table,
+                    ":",
+                    round_totals.get(table, {}).get("records", 0),
+                    "records synced",
+                ]
+                if round_totals.get(table, {}).get("links", 0) > 0:
+                    line += ["and", round_totals[table]["links"], "links backfilled"]
+                if round_totals.get(table, {}).get("files", 0) > 0:
+                    line += ["and", round_totals[table]["files"], "files copied"]
+                line += ["| Replication lag:", str(round(lag, 1)) + "s"]
+                if round_totals.get(table, {}).get("errors", {}) != {}:
+                    line += ["Errors:", round_totals[table]["errors"]]
+                if round_totals.get(table, {}).get("failed", 0) > 0:
+                    line += ["| Dead-lettered:", round_totals[table]["failed"]]
+                print(*line)
+            follow_stop.wait(
+                max(FOLLOW_INTERVAL - (datetime.now() - polled).total_seconds(), 0)
+            )
+        except KeyboardInterrupt:
+            if PROCESSES > 1:
+                # Worker processes interrupted in the middle of a round finish writing, their messages are still applied
+                if len(workers) > 0:
+                    collect(
+                        worker_queue,
+                        workers,
+                        reporting_queue,
+                        checkpoint,
+                        synced_at,
+                        worker_stats,
+                    )
+                    for worker in workers:
+                        worker.join()
+            elif ENGINE == "threads":
+                # Tables interrupted in the middle of a round finish writing before the writers stop
+                for table in table_threads:
+                    table_threads[table].join()
+                writer_pool.stop()
+                if file_pool is not None:
+                    file_pool.stop()
+            print("\nStopped following changes, the next run can start from", SYNC_FILE)
+            break
+if TELEMETRY_FILE != "":
+    telemetry_stop.set()
+    telemetry_dumper.join()
+if METRICS_FILE != "":
+    metrics_stop.set()
+    metrics_emitter.join()
+if metrics_server is not None:
+    metrics_server.shutdown()
+if SUMMARY_FILE != "":
+    metrics.write_summary(SUMMARY_FILE, run_metrics, completed)
+
+print("\nRequest telemetry:")
+endpoint_stats = telemetry.snapshot()["endpoints"]
+for endpoint in endpoint_stats:
+    print(
+        "-",
+        endpoint,
+        ":",
+        endpoint_stats[endpoint]["requests"],
+        "requests, latency p50",
+        endpoint_stats[endpoint]["latency_ms"]["p50"],
+        "ms p99",
+        endpoint_stats[endpoint]["latency_ms"]["p99"],
+        "ms, retries",
+        str(endpoint_stats[endpoint]["retries"]) + ", throttled for",
+        str(round(endpoint_stats[endpoint]["throttle_wait_ms"] / 1000, 1)) + "s",
+    )
+if TELEMETRY_FILE != "":
+    print(" Telemetry written to:", TELEMETRY_FILE)
+if SUMMARY_FILE != "":
+    print(" Run summary written to:", SUMMARY_FILE)
+
+if deadletters.count() > 0:
+    print(
+        "\n"
+        + str(deadletters.count()),
+        "failed batches were written to",
+        DEAD_LETTER_FILE + ".",
+        "Send them again with --replay_dead_letters",
+        DEAD_LETTER_FILE,
+    )
+
+# Worker processes report the statistics of their own connections, rates and circuits
+print("\nConnection pools:")
+for pool_stats in merge_stats(
+    [session_stats()] + [stats["sessions"] for stats in worker_stats],
+    ["connections", "requests", "pool_size"],
+):
+    print(
+        "-",
+        pool_stats["base_url"],
+        pool_stats["host_header"],
+        ":",
+        pool_stats["requests"],
+        "requests over",
+        pool_stats["connections"],
+        "connections (pool size",
+        str(pool_stats["pool_size"]) + ")",
+    )
+for circuit_stats in merge_stats(
+    [breaker_stats()] + [stats["breakers"] for stats in worker_stats], ["trips"]
+):
+    if circuit_stats["trips"] > 0:
+        print(
+            "-",
+            circuit_stats["base_url"],
+            circuit_stats["host_header"],
+            ": circuit breaker opened",
+            circuit_stats["trips"],
+            "times after consecutive failures",
+        )
+throttled_hosts = [
+    rate_stats
+    for rate_stats in merge_stats(
+        [stats["limiters"] for stats in worker_stats] or [limiter_stats()],
+        ["rate", "throttled"],
+    )
+    if rate_stats["throttled"] > 0
+]
+if len(throttled_hosts) > 0:
+    print("\nRequest rates:")
+for rate_stats in throttled_hosts:
+    print(
+        "-",
+        rate_stats["base_url"],
+        rate_stats["host_header"],
+        ": throttled",
+        rate_stats["throttled"],
+        "times, request rate settled at",
+        round(rate_stats["rate"], 1),
+        "per second",
+    )